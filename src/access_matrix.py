@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Author     : Ting Li <liting0612 At gmail dot com>
+Description: Builds, saves and loads the matrix of dataset access series aligned on the global week grid of the conference count series.
+"""
+
+import numpy
+from week_calendar import get_calendar
+
+
+def build_access_matrix(lst_dataset_week_naccess, offsets, nweeks):
+    ''' Place the access series of each dataset in a row of a matrix, whose columns are the weeks of the global week grid
+    input:
+    lst_dataset_week_naccess: a list of dicts, each for a dataset and with keys 'dataset_dbs', 'length', 'tstamp', and 'naccess'
+    offsets: the column on the global week grid of the first week of each dataset, as a list of integers
+    nweeks: the number of weeks in the global week grid, as an integer
+    output:
+    naccess: a 2d array of float64, with a row for each dataset and a column for each week; the weeks before the start and after the end of a dataset are 0
+    starts: the column of the first week of each dataset, as an array of integers
+    lengths: the number of weeks of each dataset on the grid, as an array of integers
+    '''
+
+    naccess = numpy.zeros((len(lst_dataset_week_naccess), nweeks))
+    starts = numpy.zeros(len(lst_dataset_week_naccess), dtype=numpy.int32)
+    lengths = numpy.zeros(len(lst_dataset_week_naccess), dtype=numpy.int32)
+    for i in range(0, len(lst_dataset_week_naccess)):
+        series = lst_dataset_week_naccess[i]['naccess']
+        start = offsets[i]
+        # clip the part of the series outside of the grid
+        begin = max(start, 0)
+        end = min(start + len(series), nweeks)
+        if end > begin:
+            naccess[i, begin:end] = series[begin - start:end - start]
+        starts[i] = begin
+        lengths[i] = max(end - begin, 0)
+    return naccess, starts, lengths
+
+
+def save_access_matrix(filename, naccess, weeks, datasets, dbses, starts, lengths):
+    ''' Save an access matrix and its row and column labels to a compressed .npz file
+    input:
+    filename: output file
+    naccess: a 2d array, with a row for each dataset and a column for each week
+    weeks: the week ordinal of each column, as a list
+    datasets, dbses: the dataset and dbs of each row, as lists
+    starts, lengths: the first column and the number of weeks of each row
+    '''
+
+    numpy.savez_compressed(filename,
+                           naccess=numpy.asarray(naccess, dtype=numpy.float32),
+                           week=numpy.asarray(weeks, dtype=numpy.int32),
+                           tstamp=get_calendar().to_windows(weeks),
+                           dataset=numpy.asarray(datasets),
+                           dbs=numpy.asarray(dbses),
+                           start=numpy.asarray(starts, dtype=numpy.int32),
+                           length=numpy.asarray(lengths, dtype=numpy.int32))
+
+
+def load_access_matrix(filename):
+    ''' Load an access matrix saved by save_access_matrix
+    input:
+    filename: a .npz file
+    output:
+    a dict with keys 'naccess', 'week', 'tstamp', 'dataset', 'dbs', 'start' and 'length'
+    '''
+
+    npz = numpy.load(filename)
+    out = dict((key, npz[key]) for key in npz.files)
+    npz.close()
+    return out
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Author     : Ting Li <liting0612 At gmail dot com>
+Description: Runs every pipeline stage on synthetic data at several scales, and records the wall time, the rows per second and the peak memory of each stage to a JSON history, to spot regressions and scaling limits.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+from collections import OrderedDict
+
+SRCDIR = os.path.dirname(os.path.abspath(__file__))
+
+# the stages: name, script and arguments (formatted with the data and output dirs), and the manifest count of their input rows
+STAGES = [
+    ('cms_conf_parser', 'cms_conf_parser.py', '--indump {data}/cms_conf.csv.gz --inschema {data}/schema --outdir {out}/conf', 'conf_records'),
+    ('select', 'select.py', '--indir {data}/dataframes --attr tier --attrval 1 --outdir {out}/select', 'access_rows'),
+    ('merge_access_conf', 'merge_access_conf.py', '--indir {data}/dataframes --inconf {out}/conf/cms_conf_ct_future.csv.gz --outdir {out}/merged', 'access_rows'),
+    ('time_series', 'time_series.py', '--indir {data}/dataframes --inconf {out}/conf/cms_conf_ct_perweek.csv.gz --outdir {out}/time_series', 'access_rows'),
+    ('model', 'model.py', '--learner RandomForestClassifier --train {data}/model/train.csv.gz --newdata {data}/model/test.csv.gz --predict {out}/model.predictions --rank none', 'train_rows'),
+]
+
+
+def run_stage(cmd, logfile):
+    ''' Run a command, and measure its wall time and the peak memory of its process
+    input:
+    cmd: the command, as a list of strings
+    logfile: a file for the output of the command
+    output:
+    returncode, wall time in seconds, CPU time in seconds, and peak resident memory in MB
+    '''
+
+    with open(logfile, 'w') as log:
+        time0 = time.time()
+        # stages which plot run headless, on the non-interactive Agg backend
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT,
+                                env=dict(os.environ, MPLBACKEND='Agg'))
+        # wait4 gives the resource usage of this very child
+        pid, status, rusage = os.wait4(proc.pid, 0)
+        wall = time.time() - time0
+    returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    # ru_maxrss is in kB on Linux
+    return returncode, wall, rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss / 1024.
+
+
+def stage_spans(filename):
+    ''' The wall time of each top level span in the profile of a stage, summed over the spans with the same name
+    input:
+    filename: the JSON file written by the --profile option of the stage
+    output:
+    an OrderedDict of span name to wall time in seconds, empty if the file is missing
+    '''
+
+    spans = OrderedDict()
+    if not os.path.isfile(filename):
+        return spans
+    with open(filename) as istream:
+        for rec in json.load(istream)['spans']:
+            if rec['parent'] is None:
+                spans[rec['name']] = spans.get(rec['name'], 0.) + rec['wall']
+    return spans
+
+
+def git_revision():
+    ''' The git commit of the source dir, if any
+    output:
+    a commit hash, or None
+    '''
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=SRCDIR, stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='''Runs every pipeline stage on synthetic data at several scales, and records the wall time, the rows per second and the peak memory of each stage to a JSON history.
+At scale s, the synthetic data have s times the base number of datasets. The data of a scale are generated once by synth.py and reused by later runs with the same parameters.
+
+Example:
+benchmark.py --workdir bench --scales 1,10,100 --datasets 100 --weeks 156 --history bench_history.json
+benchmark.py --workdir bench --scales 1 --stages select,merge_access_conf --history bench_history.json
+''', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--workdir', dest='workdir', help='a dir for the synthetic data and the outputs of the stages')
+    parser.add_argument('--scales', dest='scales', default='1,10,100', help='a comma separated list of scale factors, default 1,10,100')
+    parser.add_argument('--datasets', dest='datasets', type=int, default=100, help='the number of datasets at scale 1, default 100')
+    parser.add_argument('--weeks', dest='weeks', type=int, default=156, help='the number of weeks, default 156; cms_conf_parser.py and time_series.py need about 100 weeks or more')
+    parser.add_argument('--cols', dest='cols', type=int, default=10, help='the number of extra columns of the access files, default 10')
+    parser.add_argument('--sparsity', dest='sparsity', type=float, default=0.2, help='the sparsity of the access files, default 0.2')
+    parser.add_argument('--seed', dest='seed', type=int, default=12345, help='the seed of the synthetic data, default 12345')
+    parser.add_argument('--stages', dest='stages', default=','.join(s[0] for s in STAGES), help='a comma separated list of stages to run, default all: ' + ','.join(s[0] for s in STAGES))
+    parser.add_argument('--history', dest='history', default='bench_history.json', help='the JSON file of the benchmark history, the results of this run are appended to it')
+    args = parser.parse_args()
+
+    history = []
+    if os.path.isfile(args.history):
+        with open(args.history) as istream:
+            history = json.load(istream)
+    stages = [s for s in STAGES if s[0] in args.stages.split(',')]
+    run = OrderedDict([('time', time.strftime('%Y-%m-%d %H:%M:%S')), ('host', socket.gethostname()),
+                       ('revision', git_revision()), ('results', [])])
+
+    for scale in [int(s) for s in args.scales.split(',')]:
+        # 1. the synthetic data of the scale
+        data = os.path.join(args.workdir, 'data-%dx%d-%d-%d-%s-%d' % (args.datasets * scale, args.weeks, args.cols, args.seed, args.sparsity, scale))
+        if not os.path.isfile(os.path.join(data, 'manifest.json')):
+            print 'generating', data
+            subprocess.check_call([sys.executable, os.path.join(SRCDIR, 'synth.py'), '--outdir', data, '--datasets', str(args.datasets * scale),
+                                   '--weeks', str(args.weeks), '--cols', str(args.cols), '--sparsity', str(args.sparsity), '--seed', str(args.seed)])
+        with open(os.path.join(data, 'manifest.json')) as istream:
+            manifest = json.load(istream)
+        out = os.path.join(args.workdir, 'out-%d' % scale)
+        for sub in ['conf', 'select', 'merged', 'time_series']:
+            if not os.path.exists(os.path.join(out, sub)):
+                os.makedirs(os.path.join(out, sub))
+
+        # 2. run the stages in order, later stages read the outputs of earlier ones
+        for name, script, argfmt, rowkey in stages:
+            profile = os.path.join(out, name + '.profile.json')
+            cmd = [sys.executable, os.path.join(SRCDIR, script)] + argfmt.format(data=data, out=out).split() + ['--profile', profile]
+            returncode, wall, cpu, rss = run_stage(cmd, os.path.join(out, name + '.log'))
+            rows = manifest[rowkey]
+            result = OrderedDict([('stage', name), ('scale', scale), ('rows', rows), ('returncode', returncode),
+                                  ('wall', wall), ('cpu', cpu), ('rows_per_s', rows / wall if wall > 0 else None), ('max_rss_mb', rss),
+                                  ('spans', stage_spans(profile))])
+            run['results'].append(result)
+
+            # compare with the last successful run of the same stage and scale
+            previous = [r for h in history for r in h['results'] if r['stage'] == name and r['scale'] == scale and r['returncode'] == 0]
+            change = ''
+            if previous and returncode == 0:
+                change = ', wall x%.2f, rss x%.2f vs last run' % (wall / previous[-1]['wall'], rss / previous[-1]['max_rss_mb'])
+            status = 'ok' if returncode == 0 else 'FAILED (%d), see %s' % (returncode, os.path.join(out, name + '.log'))
+            print '%-18s %4dx %10d rows %9.2f s %12.0f rows/s %8.1f MB %s%s' % (name, scale, rows, wall, result['rows_per_s'] or 0, rss, status, change)
+
+    history.append(run)
+    with open(args.history, 'w') as ostream:
+        json.dump(history, ostream, indent=2)
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Author     : Ting Li <liting0612 At gmail dot com>
+Description: Evaluates many prediction files written by model.py against the true access of the datasets, and writes one summary table with a row for each prediction file.
+"""
+
+import os
+import argparse
+import multiprocessing
+from collections import OrderedDict
+import numpy
+import pandas
+from scipy.stats import rankdata
+from pairkey import pair_key, sum_by_key, sorted_join
+from fileio import read_csv, data_files
+from week_calendar import get_calendar
+from instrument import span, start_profiler, add_profile_arguments
+
+
+def load_truth(truth_files, threshold=0):
+    ''' Read the true access of datasets from one or more files, either test sets with a binary target column, or weekly dataframe files with a naccess column, whose access counts are summed over the files
+    input:
+    truth_files: a list of csv(.gz) files, each with dataset and dbs columns, and a target or a naccess column, and optionally a size column
+    threshold: a dataset is accessed if its summed naccess is above this value; a target column is used as is
+    output:
+    keys: the sorted unique (dataset, dbs) keys, as made by pairkey.pair_key
+    labels: 1 for the accessed datasets, 0 otherwise, as an array
+    sizes: the largest size of each dataset in the files, nan if there is no size column
+    '''
+
+    keys, hits, sizes = [], [], []
+    for truth_file in truth_files:
+        header = read_csv(truth_file, nrows=0).columns
+        col = 'target' if 'target' in header else 'naccess'
+        usecols = ['dataset', 'dbs', col] + (['size'] if 'size' in header else [])
+        df = read_csv(truth_file, usecols=usecols)
+        keys.append(pair_key(df['dataset'].values, df['dbs'].values))
+        if col == 'target':
+            # a positive target counts as an access above any threshold
+            hits.append(numpy.where(df['target'].values > 0, numpy.inf, 0))
+        else:
+            hits.append(df['naccess'].values)
+        sizes.append(df['size'].values if 'size' in header else numpy.full(len(df), numpy.nan))
+    keys = numpy.concatenate(keys)
+    ukeys, naccess = sum_by_key(keys, numpy.concatenate(hits))
+    usizes = numpy.full(len(ukeys), numpy.nan)
+    numpy.fmax.at(usizes, numpy.searchsorted(ukeys, keys), numpy.concatenate(sizes).astype(numpy.float64))
+    return ukeys, (naccess > threshold).astype(numpy.int8), usizes
+
+
+def auc_score(labels, scores):
+    ''' The area under the ROC curve, from the ranks of the scores (Mann-Whitney U statistic), ties getting average ranks
+    input:
+    labels: an array of 0/1 labels
+    scores: an array of prediction scores
+    output:
+    auc: a float, nan if all labels are the same
+    '''
+
+    npos = labels.sum()
+    nneg = len(labels) - npos
+    if npos == 0 or nneg == 0:
+        return numpy.nan
+    ranks = rankdata(scores)
+    return (ranks[labels == 1].sum() - npos * (npos + 1) / 2.) / (npos * nneg)
+
+
+def calibration(labels, scores, bins=10):
+    ''' Compare the mean prediction with the observed access rate in equal width bins of predictions in [0, 1]
+    input:
+    labels: an array of 0/1 labels
+    scores: an array of predictions, clipped to [0, 1]
+    bins: the number of bins
+    output:
+    table: a data frame with the count, the mean prediction and the access rate of each non empty bin
+    ece: the expected calibration error, i.e. the mean over rows of the gap between mean prediction and access rate of their bin
+    '''
+
+    scores = numpy.clip(scores, 0, 1)
+    idx = numpy.minimum((scores * bins).astype(numpy.int64), bins - 1)
+    counts = numpy.bincount(idx, minlength=bins).astype(numpy.float64)
+    nonempty = counts > 0
+    mean_pred = numpy.bincount(idx, weights=scores, minlength=bins)[nonempty] / counts[nonempty]
+    rate = numpy.bincount(idx, weights=labels, minlength=bins)[nonempty] / counts[nonempty]
+    table = pandas.DataFrame(OrderedDict([('bin', numpy.arange(bins)[nonempty]), ('count', counts[nonempty].astype(numpy.int64)),
+                                          ('mean_prediction', mean_pred), ('access_rate', rate)]))
+    ece = (counts[nonempty] * numpy.abs(mean_pred - rate)).sum() / counts.sum()
+    return table, ece
+
+
+def evaluate(pred_file, truth, topk, cutoff=0.5, bins=10):
+    ''' Join a prediction file to the true access on (dataset, dbs), and compute all the metrics at once
+    input:
+    pred_file: a csv file with dataset, dbs and prediction columns, as written by model.py
+    truth: the keys, labels and sizes returned by load_truth; the datasets which are not in truth are not accessed
+    topk: a list of integers, the numbers of top predicted datasets for precision@k and recall@k
+    cutoff: the datasets with a prediction at or above it are predicted as accessed
+    bins: the number of calibration bins
+    output:
+    row: an ordered dict of the metrics
+    table: the calibration table of the file
+    '''
+
+    keys, labels, sizes = truth
+    pred = read_csv(pred_file, usecols=['dataset', 'dbs', 'prediction'])
+    scores = pred['prediction'].values.astype(numpy.float64)
+    index = sorted_join(pair_key(pred['dataset'].values, pred['dbs'].values), keys)
+    found = index >= 0
+    y = numpy.zeros(len(pred), dtype=numpy.int8)
+    y[found] = labels[index[found]]
+    size = numpy.full(len(pred), numpy.nan)
+    size[found] = sizes[index[found]]
+    predicted = scores >= cutoff
+    npos = y.sum()
+
+    row = OrderedDict([('file', pred_file), ('nrows', len(pred)), ('npositive', npos), ('matched', found.sum())])
+    row['auc'] = auc_score(y, scores)
+    tp = float((predicted & (y == 1)).sum())
+    row['accuracy'] = (predicted == (y == 1)).mean() if len(y) else numpy.nan
+    row['precision'] = tp / predicted.sum() if predicted.any() else numpy.nan
+    row['recall'] = tp / npos if npos else numpy.nan
+    row['f1'] = 2 * tp / (predicted.sum() + npos) if predicted.sum() + npos else numpy.nan
+
+    # hits among the k highest predictions, ties in input order
+    order = numpy.argsort(-scores, kind='mergesort')
+    cumhits = numpy.cumsum(y[order])
+    for k in topk:
+        kk = min(k, len(y))
+        row['precision@%d' % k] = cumhits[kk - 1] / float(kk) if kk else numpy.nan
+        row['recall@%d' % k] = cumhits[kk - 1] / float(npos) if kk and npos else numpy.nan
+
+    row['brier'] = ((numpy.clip(scores, 0, 1) - y) ** 2).mean() if len(y) else numpy.nan
+    table, row['ece'] = calibration(y, scores, bins)
+    table.insert(0, 'file', pred_file)
+
+    # the share of the accessed bytes on the datasets predicted as accessed, and the share of the bytes predicted as accessed which are accessed
+    wsize = numpy.nan_to_num(size)
+    accessed_bytes = (wsize * y).sum()
+    placed_bytes = (wsize * predicted).sum()
+    row['byte_hit_rate'] = (wsize * y * predicted).sum() / accessed_bytes if accessed_bytes > 0 else numpy.nan
+    row['byte_precision'] = (wsize * y * predicted).sum() / placed_bytes if placed_bytes > 0 else numpy.nan
+    return row, table
+
+
+# the truth of each set of files, loaded once per worker process
+_truth = {}
+
+
+def evaluate_task(args):
+    ''' Evaluate one prediction file in a worker process, see evaluate
+    input:
+    args: a tuple of the prediction file, the list of its truth files, threshold, topk, cutoff and bins
+    output:
+    the row and the calibration table returned by evaluate
+    '''
+
+    pred_file, truth_files, threshold, topk, cutoff, bins = args
+    key = (tuple(truth_files), threshold)
+    if key not in _truth:
+        _truth[key] = load_truth(truth_files, threshold)
+    return evaluate(pred_file, _truth[key], topk, cutoff, bins)
+
+
+def following_weeks(pred_file, truth_dir, nweeks):
+    ''' Find the files of the weeks after the week of a prediction file
+    input:
+    pred_file: a file whose name contains a YYYYMMDD-YYYYMMDD week window
+    truth_dir: a dir of weekly files whose names contain their week window
+    nweeks: the number of following weeks
+    output:
+    truth_files: a list of the files found, possibly fewer than nweeks, None if the name of the prediction file has no week window
+    '''
+
+    calendar = get_calendar()
+    weeks = {}
+    for fname in os.listdir(truth_dir):
+        if fname.endswith('.gzi'):
+            continue
+        try:
+            weeks[calendar.filename_ordinal(fname)] = os.path.join(truth_dir, fname)
+        except (AttributeError, KeyError):
+            continue
+    try:
+        week = calendar.filename_ordinal(os.path.basename(pred_file))
+    except (AttributeError, KeyError):
+        return None
+    return [weeks[w] for w in range(week + 1, week + 1 + nweeks) if w in weeks]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='''Evaluates many prediction files written by model.py against the true access of the datasets, and writes one summary table with a row for each prediction file.
+The true access is given either by test set files with a target column, or by weekly dataframe files with a naccess column.
+
+Example:
+check_prediction.py --fin testset/dataframe-20140507-20140513.csv.gz --fpred "predictions/*.predictions" --outfile summary.csv
+check_prediction.py --truth-dir datasets --weeks 2 --fpred "predictions/pred-*.csv" --topk 100,1000 --outfile summary.csv
+''', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--fpred', dest='fpred', help='a comma separated list of prediction files or of glob patterns')
+    parser.add_argument('--fin', dest='fin', default='', help='a comma separated list of truth files, used for all prediction files')
+    parser.add_argument('--truth-dir', dest='truth_dir', default='', help='''a dir of weekly truth files; the truth of a prediction file is the --weeks files after the week window in its name''')
+    parser.add_argument('--weeks', dest='weeks', type=int, default=1, help='the number of following weeks of truth of a prediction file, default 1')
+    parser.add_argument('--threshold', dest='threshold', type=float, default=0, help='a dataset is accessed if its naccess summed over the truth files is above it, default 0')
+    parser.add_argument('--cutoff', dest='cutoff', type=float, default=0.5, help='a dataset is predicted as accessed if its prediction is at or above it, default 0.5')
+    parser.add_argument('--topk', dest='topk', default='100,1000', help='a comma separated list of k for precision@k and recall@k, default 100,1000')
+    parser.add_argument('--bins', dest='bins', type=int, default=10, help='the number of calibration bins, default 10')
+    parser.add_argument('--njobs', dest='njobs', type=int, default=-1, help='the number of worker processes, default all cores')
+    parser.add_argument('--outfile', dest='outfile', default='prediction_summary.csv', help='the output csv file of the metrics of each prediction file')
+    parser.add_argument('--calibration-file', dest='calibration_file', default='', help='an optional output csv file of the calibration bins of each prediction file')
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    start_profiler(args.profile, args.profile_hot)
+
+    # 1. find the prediction files and their truth files
+    pred_files = []
+    for pattern in args.fpred.split(','):
+        pred_files += sorted(data_files(pattern)) or [pattern]
+    topk = [int(k) for k in args.topk.split(',') if k]
+    tasks = []
+    for pred_file in pred_files:
+        if args.fin:
+            truth_files = args.fin.split(',')
+        else:
+            truth_files = following_weeks(pred_file, args.truth_dir, args.weeks)
+            if truth_files is None:
+                print 'WARNING: no week window in the name of %s, skipped' % pred_file
+                continue
+            if len(truth_files) < args.weeks:
+                print 'WARNING: %d of %d weeks of truth found for %s' % (len(truth_files), args.weeks, pred_file)
+            if not truth_files:
+                continue
+        tasks.append((pred_file, truth_files, args.threshold, topk, args.cutoff, args.bins))
+    print 'nb of prediction files:', len(pred_files), ', evaluated:', len(tasks)
+
+    # 2. evaluate the files in parallel
+    njobs = multiprocessing.cpu_count() if args.njobs < 0 else args.njobs
+    # the files evaluated in worker processes are profiled as a whole
+    with span('evaluate', rows=len(tasks), njobs=njobs):
+        if njobs > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(min(njobs, len(tasks)))
+            results = pool.map(evaluate_task, tasks)
+            pool.close()
+            pool.join()
+        else:
+            results = [evaluate_task(task) for task in tasks]
+
+    # 3. write out the summary table, and the calibration tables
+    summary = pandas.DataFrame([row for row, table in results])
+    summary.to_csv(args.outfile, index=False)
+    print summary.to_string(index=False)
+    if args.calibration_file:
+        pandas.concat([table for row, table in results]).to_csv(args.calibration_file, index=False)
+
+if __name__ == '__main__':
+
+    main()
@@ -8,10 +8,12 @@ Description: Parses the conference data dump file into a conference count time s
 import argparse
 import datetime
 import re
-import gzip
 import collections
 import csv
 import ordereddict
+from week_calendar import mycalendar, mine_to_gregorian, get_calendar
+from instrument import span, start_profiler, add_profile_arguments
+from fileio import open_read, open_write, with_codec_extension, add_codec_arguments
 
 def type_db2py(dbtype):
     """ convert from db types to python types
@@ -92,7 +94,7 @@ def parse_dataframe_by_match_record(fdataframe, attribute2type):
     schema = attribute2type.keys()
 
     # dataframe
-    text = gzip.open(fdataframe).read()
+    text = open_read(fdataframe).read()
 
     # parse the conference records in dataframe file
     
@@ -179,61 +181,40 @@ def count_confs_by_week(grouped):
 
 
 ########### group and count confs by self-defined weeks, where the first week in a year starts from jan 1 and the last week has more than 7 days to include Dec 31 (and 30)
-
-def mycalendar(date):
-    ''' convert from Gregorian Calendar date to (year, week, day) starting from Jan 1
-    '''
-    year = date.year
-    delta = date - datetime.date(date.year, 1, 1)
-    week = delta.days / 7 + 1
-    day = delta.days % 7 + 1
-    if week == 53: # when date is the last one or two days where there are less than 7 days left to form a week
-        week -= 1
-        day += 7
-    return (year,week,day)
-
-def mine_to_gregorian(my_year, my_week, my_day):
-    '''Gregorian calendar date for the given year, week and day starting from Jan 1'''
-    year_start = datetime.date(my_year, 1, 1)
-    return year_start + datetime.timedelta(days=my_day-1, weeks=my_week-1)
-
+########### the self-defined weeks are given by their ordinals in the shared week calendar
 
 def group_confs_by_myweek(confs_list):
     ''' Group the confs by self-defined week
     Input: 
     confs_list: a list of dictionaries, each represents a conf
     output: 
-    grouped: a dict of (week, list of confs), 
+    grouped: a dict of (week ordinal, list of confs), 
     '''
 
+    calendar = get_calendar()
     # grouped = collections.OrderedDict()
     grouped = ordereddict.OrderedDict()
     for conf in confs_list:
-        yearweek = mycalendar(conf['CONF_START'])[0:2]
-        # print yearweek, type(yearweek)
-        grouped.setdefault(yearweek, []).append(conf)
+        week = calendar.date_ordinal(conf['CONF_START'])
+        grouped.setdefault(week, []).append(conf)
     return grouped
 
 
 def count_confs_by_myweek(grouped):
     ''' Count the confs by self-def week
     Input: 
-    grouped: a dict of (week, list of confs), 
+    grouped: a dict of (week ordinal, list of confs), 
     output: 
-    confct_by_wk: a list of [week, conf ct]
+    confct_by_wk: a list of [week ordinal, conf ct]
     '''
     
-    startyearweek = grouped.keys()[0]
-    endyearweek = grouped.keys()[-1]
+    calendar = get_calendar()
+    startyearweek = calendar.yearweek(min(grouped.keys()))
+    endweek = max(grouped.keys())
+    # assume the conferences are given starting from the first week of a year
     confct_by_wk = []
-    # for week in range(startyearweek[1], datetime.date(startyearweek[0], 12, 28).isocalendar()[1]+1): # assume the conferences are given starting from the earlies week when there is a conference.
-    for week in range(1, mycalendar(datetime.date(startyearweek[0], 12, 28))[1]+1):      # assume the conferences are given starting from the first week of a year
-        confct_by_wk.append([(startyearweek[0], week), len(grouped.setdefault((startyearweek[0], week), []))])
-    for year in range(startyearweek[0]+1, endyearweek[0]):
-        for week in range(1, mycalendar(datetime.date(year, 12, 28))[1]+1):
-            confct_by_wk.append([(year, week), len(grouped.setdefault((year, week), []))])
-    for week in range(1, endyearweek[1]+1):
-        confct_by_wk.append([(endyearweek[0], week), len(grouped.setdefault((endyearweek[0], week), []))])
+    for week in range(calendar.yearweek_ordinal(startyearweek[0], 1), endweek + 1):
+        confct_by_wk.append([week, len(grouped.get(week, []))])
 
     return confct_by_wk
 
@@ -289,7 +270,10 @@ cms_conf_ct_perweek.csv.gz: a csv.gz file for output conference count per week t
 cms_conf_ct_future.csv.gz: a csv.gz file for output conference count up to some future weeks, 
 cms_conf_parsed.csv.gz: a csv.gz file for output parsed conference records: with the schema as columns, conference records as rows (sorted by date), with the attributes in each record delimited by TAB. I.e. reorganize cms_conf.csv.gz in a cleaner way.
 ''')
+    add_profile_arguments(parser)
+    add_codec_arguments(parser)
     args = parser.parse_args()
+    start_profiler(args.profile, args.profile_hot)
 
 
     # 1. parse the data frame into list of conf dicts
@@ -298,7 +282,9 @@ cms_conf_parsed.csv.gz: a csv.gz file for output parsed conference records: with
     # print attribute2type
 
     # parsing dataframe by matching each record and field.  allow PRES_TITLE field span more than one lines, and assume other fields can't span more than one line
-    confs_list = parse_dataframe_by_match_record(args.indump, attribute2type)    
+    with span('parse_dump', file=args.indump) as rec:
+        confs_list = parse_dataframe_by_match_record(args.indump, attribute2type)
+        rec['rows'] = len(confs_list)
 
     # Output the parsed result
 
@@ -312,16 +298,18 @@ cms_conf_parsed.csv.gz: a csv.gz file for output parsed conference records: with
 
     schema = attribute2type.keys()
     confs_list = sorted(confs_list, key=lambda k: k['CONF_START'])  # sort confs by date, for later grouping by week
-    csvfile = gzip.open(args.outdir + '/cms_conf_parsed.csv.gz', 'w')
-    writer = csv.DictWriter(csvfile, fieldnames=schema,  delimiter='\t')
-    csvfile.write(','.join(schema) + '\n')
-    writer.writerows(confs_list)
-    csvfile.close()
+    with span('write_parsed', rows=len(confs_list)):
+        csvfile = open_write(with_codec_extension(args.outdir + '/cms_conf_parsed.csv.gz', args.codec), args.codec, args.level, args.threads)
+        writer = csv.DictWriter(csvfile, fieldnames=schema,  delimiter='\t')
+        csvfile.write(','.join(schema) + '\n')
+        writer.writerows(confs_list)
+        csvfile.close()
 
 
     # 2. group confs by week
     # grouped = group_confs_by_week(confs_list)
-    grouped = group_confs_by_myweek(confs_list)
+    with span('group_by_week', rows=len(confs_list)):
+        grouped = group_confs_by_myweek(confs_list)
     
     # # output the grouped result
     # print "****group confs*****"
@@ -333,54 +321,42 @@ cms_conf_parsed.csv.gz: a csv.gz file for output parsed conference records: with
 
     # 3. count confs by week
     # confct_by_wk = count_confs_by_week(grouped)
-    confct_by_wk = count_confs_by_myweek(grouped)
+    with span('count_by_week'):
+        confct_by_wk = count_confs_by_myweek(grouped)
     
     # # output the conf ct per week
     # print "******count confs by week********"
     # for week, ct in confct_by_wk:
     #     print week, ct
 
-    csvfile = gzip.open(args.outdir + '/cms_conf_ct_perweek.csv.gz', 'w')
+    calendar = get_calendar()
+    csvfile = open_write(with_codec_extension(args.outdir + '/cms_conf_ct_perweek.csv.gz', args.codec), args.codec, args.level, args.threads)
     csvfile.write('tstamp,confct\n')
     for i in range(0,len(confct_by_wk)):
-        # for week, ct in confct_by_wk:
-    #     csvfile.write('{}-{},{}\n'.format(week, ct))
-        if confct_by_wk[i][0][1] == 52:
-            csvfile.write('{0}-{1},{2}\n'.format(mine_to_gregorian(confct_by_wk[i][0][0], confct_by_wk[i][0][1], 1).strftime('%Y%m%d'), datetime.date(confct_by_wk[i][0][0], 12, 31).strftime('%Y%m%d'), confct_by_wk[i][1]))
-        else:
-            csvfile.write('{0}-{1},{2}\n'.format(mine_to_gregorian(confct_by_wk[i][0][0], confct_by_wk[i][0][1], 1).strftime('%Y%m%d'), mine_to_gregorian(confct_by_wk[i][0][0], confct_by_wk[i][0][1], 7).strftime('%Y%m%d'), confct_by_wk[i][1]))
+        csvfile.write('{0},{1}\n'.format(calendar.window(confct_by_wk[i][0]), confct_by_wk[i][1]))
     csvfile.close()
 
     # 4. count confs in certain nb of future weeks, from each week
     # periods=[1,2,4,6,10,15,20,25,30,35,40,45,50,55,60,65,70,75,80,85] # for next few weeks
     periods=[1,2,4,6,10,15,20,25,30,35,40,45,50,55,60,65,70] # for next few weeks
-    confct_future = count_confs_in_future(confct_by_wk, periods)
+    with span('count_in_future', rows=len(confct_by_wk)):
+        confct_future = count_confs_in_future(confct_by_wk, periods)
         
     # print "***************"
     # for item in confct_future:
     #     print item
 
-    csvfile = gzip.open(args.outdir + '/cms_conf_ct_future.csv.gz', 'w')
+    csvfile = open_write(with_codec_extension(args.outdir + '/cms_conf_ct_future.csv.gz', args.codec), args.codec, args.level, args.threads)
     header = 'tstamp,0wk'
     for i in range(0, len(periods)):
         header = header + ',' + str(periods[i]) + 'wk'
     csvfile.write(header + '\n')
     for i in range(0,len(confct_future)):
-        # csvfile.write('{},{},{},{},{},{},{}\n'.format(iso_to_gregorian(confct_by_wk[i][0][0], confct_by_wk[i][0][1], 1).strftime('%Y%m%d'), iso_to_gregorian(confct_by_wk[i][0][0], confct_by_wk[i][0][1], 7).strftime('%Y%m%d'), confct_by_wk[i][1], confct_future[i][1], confct_future[i][2], confct_future[i][3], confct_future[i][4])) 
-        if confct_by_wk[i][0][1] == 52:
-            csvfile.write('{0}-{1}'.format(
-                    mine_to_gregorian(confct_by_wk[i][0][0], confct_by_wk[i][0][1], 1).strftime('%Y%m%d'), datetime.date(confct_by_wk[i][0][0], 12, 31).strftime('%Y%m%d')))
-            csvfile.write(',' + str(confct_by_wk[i][1]))
-            for j in range(1,len(confct_future[i])):
-                csvfile.write(',' + str(confct_future[i][j]))
-            csvfile.write('\n')
-        else:
-            csvfile.write('{0}-{1}'.format(
-                    mine_to_gregorian(confct_by_wk[i][0][0], confct_by_wk[i][0][1], 1).strftime('%Y%m%d'), mine_to_gregorian(confct_by_wk[i][0][0], confct_by_wk[i][0][1], 7).strftime('%Y%m%d')))
-            csvfile.write(',' + str(confct_by_wk[i][1]))
-            for j in range(1,len(confct_future[i])):
-                csvfile.write(',' + str(confct_future[i][j]))
-            csvfile.write('\n')
+        csvfile.write(calendar.window(confct_by_wk[i][0]))
+        csvfile.write(',' + str(confct_by_wk[i][1]))
+        for j in range(1,len(confct_future[i])):
+            csvfile.write(',' + str(confct_future[i][j]))
+        csvfile.write('\n')
     csvfile.close()
 
 if __name__ == '__main__':
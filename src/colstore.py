@@ -0,0 +1,380 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Author     : Ting Li <liting0612 At gmail dot com>
+Description: A week-partitioned columnar store of the dataset access files: one dir per week with one .npy file per column, dictionary encoded low-cardinality columns, and a catalog of the partitions, the schema and per-column statistics.
+             Readers load only the columns they need, and skip the weeks and rows excluded by predicates on the columns or on the week window (tstamp).
+"""
+
+import os
+import re
+import json
+import shutil
+import operator
+import argparse
+from collections import OrderedDict
+import numpy
+import pandas
+from vocabulary import CategoricalEncoder
+from week_calendar import get_calendar
+from fileio import read_csv, open_write, data_files
+from instrument import span, start_profiler, add_profile_arguments
+
+CATALOG_VERSION = 1
+
+# the columns with fewer distinct codes than this in a partition have the list of their codes in its statistics
+MAX_STATS_CODES = 256
+
+# the comparison operators of predicates, which apply to scalars and elementwise to arrays
+OPERATORS = OrderedDict([('==', operator.eq), ('!=', operator.ne), ('<=', operator.le),
+                         ('>=', operator.ge), ('<', operator.lt), ('>', operator.gt)])
+
+
+def is_store(path):
+    ''' Whether a path is the dir of a columnar store '''
+
+    return os.path.isfile(os.path.join(path, 'catalog.json'))
+
+
+def parse_where(text):
+    ''' Parse predicates on columns, such as 'tier==1,size>=1000,tstamp>=20140101'
+    input:
+    text: a comma separated list of predicates <column><operator><value>, with operators ==, !=, <, <=, >, >=
+    output:
+    a list of (column, operator, value as a string), which all hold for the selected rows
+    '''
+
+    where = []
+    for pred in [p.strip() for p in (text or '').split(',') if p.strip()]:
+        match = re.match(r'^(\w+)\s*(==|!=|<=|>=|<|>)\s*(.*)$', pred)
+        if not match:
+            raise ValueError('cannot parse predicate %s' % pred)
+        where.append(match.groups())
+    return where
+
+
+def filter_frame(xdf, where):
+    ''' The rows of a data frame satisfying all the predicates, for the text files read without a store
+    input:
+    xdf: a data frame
+    where: a list of (column, operator, value as a string), from parse_where
+    output:
+    a data frame
+    '''
+
+    mask = numpy.ones(len(xdf), dtype=bool)
+    for col, op, value in where:
+        values = xdf[col]
+        if values.dtype.kind in 'iuf':
+            value = float(value)
+        mask &= numpy.asarray(OPERATORS[op](values, value), dtype=bool)
+    return xdf[mask]
+
+
+def smallest_int_type(vmin, vmax):
+    ''' The smallest signed integer dtype holding the values from vmin to vmax '''
+
+    for dtype in [numpy.int8, numpy.int16, numpy.int32]:
+        info = numpy.iinfo(dtype)
+        if vmin >= info.min and vmax <= info.max:
+            return dtype
+    return numpy.int64
+
+
+def to_text(values):
+    ''' Format column values as the strings of the csv files: integral floats without '.0', and nan as an empty string
+    input:
+    values: an array
+    output:
+    a list of strings
+    '''
+
+    if values.dtype.kind in 'iub':
+        return [str(v) for v in values.tolist()]
+    elif values.dtype.kind == 'f':
+        text = []
+        for v in values.tolist():
+            if v != v:
+                text.append('')
+            elif v == int(v) and abs(v) < 1e16:
+                text.append(str(int(v)))
+            else:
+                text.append(repr(v))
+        return text
+    return [str(v) for v in values]
+
+
+def write_csv(data, filename, codec=None, level=None, threads=0):
+    ''' Write columns to a csv file, in the text format of the dataset access files
+    input:
+    data: an OrderedDict of column name to an array of values, or to a list of strings
+    filename: output file
+    codec, level, threads: the compression of the output file, see fileio.open_write
+    '''
+
+    texts = [to_text(values) if isinstance(values, numpy.ndarray) else values for values in data.values()]
+    csvfile = open_write(filename, codec, level, threads)
+    csvfile.write(','.join(data.keys()) + '\n')
+    for row in zip(*texts):
+        csvfile.write(','.join(row) + '\n')
+    csvfile.close()
+
+
+class ColumnStore(object):
+    ''' A week-partitioned columnar store in a dir, with its catalog in catalog.json and the vocabularies of its dictionary encoded columns in dict/
+    input:
+    path: the dir of the store, created at the first ingest
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.encoder = CategoricalEncoder(os.path.join(path, 'dict'))
+        self.catalog = OrderedDict([('version', CATALOG_VERSION), ('schema', []), ('partitions', [])])
+        if is_store(path):
+            with open(os.path.join(path, 'catalog.json')) as istream:
+                self.catalog = json.load(istream, object_pairs_hook=OrderedDict)
+            if self.catalog['version'] != CATALOG_VERSION:
+                raise ValueError('store %s has catalog version %s, expected %s' % (path, self.catalog['version'], CATALOG_VERSION))
+
+    def columns(self):
+        ''' The names of the columns, in the order of the first ingested file '''
+
+        return [col['name'] for col in self.catalog['schema']]
+
+    def kind(self, column):
+        ''' The kind of a column: 'dict' for dictionary encoded, 'int' or 'float' '''
+
+        for col in self.catalog['schema']:
+            if col['name'] == column:
+                return col['kind']
+        raise KeyError('no column %s in store %s' % (column, self.path))
+
+    def save(self):
+        ''' Write the catalog and the vocabularies, the catalog last and atomically '''
+
+        self.encoder.save()
+        tmp = os.path.join(self.path, 'catalog.json.tmp%s' % os.getpid())
+        with open(tmp, 'w') as ostream:
+            json.dump(self.catalog, ostream, indent=1)
+        os.rename(tmp, os.path.join(self.path, 'catalog.json'))
+
+    def ingest(self, filename, dict_cols):
+        ''' Add a weekly access file as the partition of its week, unless the partition is up to date with the file
+        input:
+        filename: a dataset access file, whose name contains its week window
+        dict_cols: the columns to dictionary encode, besides the non numeric ones
+        output:
+        the catalog record of the partition, None if it was up to date
+        '''
+
+        window = get_calendar().window(get_calendar().filename_ordinal(filename))
+        stat = os.stat(filename)
+        parts = self.catalog['partitions']
+        for part in parts:
+            if part['window'] == window and part['size'] == stat.st_size and part['mtime'] == stat.st_mtime:
+                return None
+
+        xdf = read_csv(filename)
+        header = list(xdf.columns)
+        if not len(xdf):
+            # an empty file says nothing about the types of its columns
+            xdf = xdf[[]]
+        schema = OrderedDict((col['name'], col) for col in self.catalog['schema'])
+        for col in xdf.columns:
+            if col not in schema:
+                kind = 'dict' if col in dict_cols or xdf[col].dtype.kind not in 'iuf' else ('int' if xdf[col].dtype.kind in 'iu' else 'float')
+                schema[col] = OrderedDict([('name', col), ('kind', kind)])
+        self.catalog['schema'] = schema.values()
+
+        # write the columns of the partition to a temporary dir, renamed at the end
+        pdir = os.path.join(self.path, window)
+        tmp = '%s.tmp%s' % (pdir, os.getpid())
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        stats = OrderedDict()
+        for col in xdf.columns:
+            kind = schema[col]['kind']
+            values = xdf[col].values
+            if kind == 'dict':
+                values = self.encoder.vocab(col).encode(values)
+                values = values.astype(smallest_int_type(0, len(self.encoder.vocab(col))))
+                codes = numpy.unique(values)
+                stats[col] = OrderedDict([('min', int(codes[0]) if len(codes) else None), ('max', int(codes[-1]) if len(codes) else None),
+                                          ('codes', codes.tolist() if len(codes) <= MAX_STATS_CODES else None)])
+            else:
+                if kind == 'int' and values.dtype.kind == 'f':
+                    # an integer column with missing values in this file
+                    schema[col]['kind'] = kind = 'float'
+                if kind == 'int' and len(values):
+                    values = values.astype(smallest_int_type(values.min(), values.max()))
+                elif kind == 'float':
+                    values = values.astype(numpy.float64)
+                present = values[~numpy.isnan(values)] if kind == 'float' else values
+                stats[col] = OrderedDict([('min', present.min().item() if len(present) else None),
+                                          ('max', present.max().item() if len(present) else None),
+                                          ('nulls', int(len(values) - len(present)))])
+            numpy.save(os.path.join(tmp, '%s.npy' % col), values)
+        if os.path.isdir(pdir):
+            shutil.rmtree(pdir)
+        os.rename(tmp, pdir)
+
+        part = OrderedDict([('window', window), ('source', os.path.basename(filename)), ('size', stat.st_size), ('mtime', stat.st_mtime),
+                            ('rows', len(xdf)), ('columns', header), ('stats', stats)])
+        parts[:] = sorted([p for p in parts if p['window'] != window] + [part], key=lambda p: p['window'])
+        return part
+
+    def typed_value(self, column, value):
+        ''' A predicate value as a string converted to the type of the values of a column '''
+
+        if column == 'tstamp':
+            return value
+        kind = self.kind(column)
+        if kind == 'dict':
+            index = self.encoder.vocab(column).index
+            kind = 'int' if index.dtype.kind in 'iu' else ('float' if index.dtype.kind == 'f' else 'str')
+        if kind == 'int':
+            return int(value)
+        elif kind == 'float':
+            return float(value)
+        return value
+
+    def dictionary_mask(self, column, op, value):
+        ''' Whether each value of the dictionary of a column satisfies a predicate, to be indexed by the codes of the column '''
+
+        values = numpy.asarray(self.encoder.vocab(column).index.values)
+        return numpy.asarray(OPERATORS[op](values, value), dtype=bool)
+
+    def may_match(self, part, column, op, value):
+        ''' Whether a partition may have rows satisfying a predicate, by its week window and column statistics '''
+
+        if not part['rows']:
+            return False
+        if column == 'tstamp':
+            # week windows compare as strings, a predicate value such as 20140101 compares with their first day
+            return bool(OPERATORS[op](part['window'][:len(value)], value))
+        if column not in part['stats']:
+            # the missing column is read as 0
+            return bool(OPERATORS[op](0, value))
+        stats = part['stats'][column]
+        if stats['min'] is None:
+            return False
+        if self.kind(column) == 'dict':
+            if stats['codes'] is None:
+                return True
+            return bool(self.dictionary_mask(column, op, value)[stats['codes']].any())
+        vmin, vmax = stats['min'], stats['max']
+        if op == '==':
+            return vmin <= value <= vmax
+        elif op == '!=':
+            return not vmin == vmax == value
+        elif op in ('<', '<='):
+            return bool(OPERATORS[op](vmin, value))
+        return bool(OPERATORS[op](vmax, value))
+
+    def partitions(self, where=()):
+        ''' The catalog records of the partitions which may have rows satisfying all the predicates, in week order
+        input:
+        where: a list of (column, operator, value as a string), from parse_where
+        '''
+
+        where = [(col, op, self.typed_value(col, value)) for col, op, value in where]
+        return [part for part in self.catalog['partitions'] if all(self.may_match(part, col, op, value) for col, op, value in where)]
+
+    def load(self, part, column):
+        ''' The stored array of a column of a partition, memory-mapped; zeros for a column missing in the partition '''
+
+        if column not in part['columns']:
+            return numpy.zeros(part['rows'], dtype=numpy.int8)
+        return numpy.load(os.path.join(self.path, part['window'], '%s.npy' % column), mmap_mode='r')
+
+    def read_partition(self, part, columns=None, where=()):
+        ''' Read columns of the rows of a partition satisfying all the predicates
+        input:
+        part: the catalog record of a partition
+        columns: the columns to read, all of them if None
+        where: a list of (column, operator, value as a string), from parse_where
+        output:
+        an OrderedDict of column name to array of values, dictionary encoded columns being decoded
+        '''
+
+        columns = self.columns() if columns is None else columns
+        if not part['rows']:
+            return OrderedDict((col, numpy.zeros(0)) for col in columns)
+        mask = None
+        for col, op, value in where:
+            value = self.typed_value(col, value)
+            if col == 'tstamp':
+                match = numpy.full(part['rows'], self.may_match(part, col, op, value), dtype=bool)
+            elif self.kind(col) == 'dict' and col in part['columns']:
+                match = self.dictionary_mask(col, op, value)[self.load(part, col)]
+            else:
+                match = OPERATORS[op](self.load(part, col), value)
+            mask = match if mask is None else mask & match
+        data = OrderedDict()
+        for col in columns:
+            values = self.load(part, col)
+            if mask is not None:
+                values = values[mask]
+            if self.kind(col) == 'dict' and col in part['columns']:
+                values = numpy.asarray(self.encoder.vocab(col).index.values)[values]
+            data[col] = numpy.asarray(values)
+        return data
+
+    def read_frame(self, columns=None, where=()):
+        ''' Read columns of the rows of all the partitions satisfying all the predicates, into one data frame in week order '''
+
+        columns = self.columns() if columns is None else columns
+        frames = [pandas.DataFrame(self.read_partition(part, columns, where), columns=columns) for part in self.partitions(where)]
+        if not frames:
+            return pandas.DataFrame(columns=columns)
+        return pandas.concat(frames, ignore_index=True)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='''Ingest weekly dataset access files into a week-partitioned columnar store, or show the catalog of a store.
+Files already ingested and unchanged since are skipped, so the command can be rerun as new weeks arrive.
+The store can be given instead of a dir of dataframe files to select.py, merge_access_conf.py and time_series.py, and instead of a train or new data file to model.py.
+
+Example:
+colstore.py --indir original --store original.store --dict-cols dbs,era,tier
+colstore.py --store original.store --show
+''', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--indir', dest='indir', default='', help='a dir containing the dataframe* files of the dataset access data')
+    parser.add_argument('--store', dest='store', help='the dir of the columnar store')
+    parser.add_argument('--dict-cols', dest='dict_cols', default='dbs,era,tier', help='a comma separated list of columns to dictionary encode, besides the non numeric ones, default dbs,era,tier')
+    parser.add_argument('--show', dest='show', action='store_true', default=False, help='print the schema, partitions and column statistics of the store')
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    start_profiler(args.profile, args.profile_hot)
+
+    store = ColumnStore(args.store)
+    if args.indir:
+        if not os.path.isdir(args.store):
+            os.makedirs(args.store)
+        dict_cols = [col for col in args.dict_cols.split(',') if col]
+        ningested = 0
+        for filename in sorted(data_files(args.indir + '/dataframe*')):
+            with span('ingest', file=os.path.basename(filename)) as rec:
+                part = store.ingest(filename, dict_cols)
+                rec['rows'] = part['rows'] if part else 0
+            if part:
+                ningested += 1
+        store.save()
+        print 'ingested', ningested, 'files, the store has', len(store.catalog['partitions']), 'weeks'
+
+    if args.show:
+        parts = store.catalog['partitions']
+        print 'weeks:', len(parts), 'from', parts[0]['window'] if parts else None, 'to', parts[-1]['window'] if parts else None
+        print 'rows:', sum(p['rows'] for p in parts)
+        print 'column kind min max nulls dictionary'
+        for col in store.catalog['schema']:
+            stats = [p['stats'][col['name']] for p in parts if col['name'] in p['stats'] and p['stats'][col['name']]['min'] is not None]
+            vocab = len(store.encoder.vocab(col['name'])) if col['kind'] == 'dict' else ''
+            print col['name'], col['kind'], min(s['min'] for s in stats) if stats else None, max(s['max'] for s in stats) if stats else None, \
+                sum(s.get('nulls', 0) for s in stats), vocab
+
+if __name__ == '__main__':
+
+    main()
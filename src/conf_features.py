@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Author     : Ting Li <liting0612 At gmail dot com>
+Description: Computes conference count features of dataset access records, such as the counts in past and future windows, exponentially decayed counts, and the counts at the best cross correlation lag of an attribute value, from the weekly conference count series kept as arrays.
+"""
+
+import re
+import csv
+import datetime
+from collections import OrderedDict
+import numpy
+from scipy.signal import lfilter
+from week_calendar import get_calendar
+from fileio import open_read
+
+# the kinds of features, and whether their argument is a number of weeks
+KINDS = OrderedDict([('past', True), ('future', True), ('decay', True), ('lag', True), ('bestlag', False)])
+
+
+def parse_features(text):
+    ''' Parse a list of features, such as 'past:4,future:10,decay:2,lag:-3,bestlag:tier,future:4:CONF'
+    input:
+    text: a comma separated list of <kind>:<argument>[:<conference category>], with kinds
+    past:N, the conferences in the N weeks before the week of a record;
+    future:N, the conferences in the N weeks after it, as in cms_conf_ct_future.csv.gz;
+    decay:H, the conferences of the week and of all the weeks before, weighted by 0.5 ** (weeks before / H);
+    lag:L, the conferences in the week L weeks after (L > 0) or -L weeks before (L < 0);
+    bestlag:attr, the conferences at the lag of the best cross correlation of the attribute value of a record, from time_series.py --group-by attr
+    output:
+    a list of (column name, kind, argument, category or None)
+    '''
+
+    features = []
+    for spec in [s.strip() for s in (text or '').split(',') if s.strip()]:
+        fields = spec.split(':')
+        if len(fields) not in (2, 3) or fields[0] not in KINDS:
+            raise ValueError('cannot parse feature %s, expected <kind>:<argument>[:<category>] with kind in %s' % (spec, ', '.join(KINDS)))
+        kind, arg = fields[0], fields[1]
+        category = fields[2] if len(fields) == 3 else None
+        if KINDS[kind]:
+            arg = float(arg) if kind == 'decay' else int(arg)
+            if kind in ('past', 'future') and arg < 1 or kind == 'decay' and arg <= 0:
+                raise ValueError('the argument of feature %s must be positive' % spec)
+        if kind == 'lag':
+            name = 'conf_lag%d' % arg if arg >= 0 else 'conf_lagm%d' % -arg
+        elif kind == 'decay':
+            name = 'conf_decay%s' % re.sub(r'\.0$', '', str(arg))
+        elif kind == 'bestlag':
+            name = 'conf_bestlag_%s' % arg
+        else:
+            name = 'conf_%s%d' % (kind, arg)
+        if category:
+            name += '_' + category
+        features.append((name, kind, arg, category))
+    return features
+
+
+def read_conf_series(filename):
+    ''' Read the weekly conference counts from the first count column of a conference count file, cms_conf_ct_perweek.csv.gz or cms_conf_ct_future.csv.gz
+    input:
+    filename: a conference count file with a tstamp column
+    output:
+    first: the week ordinal of the first week of the series
+    counts: an array of float64 of the conferences of each week from the first, 0 for the weeks missing in the file
+    '''
+
+    csvfile = open_read(filename)
+    reader = csv.reader(csvfile)
+    reader.next()
+    rows = [(row[0], row[1]) for row in reader]
+    csvfile.close()
+    weeks = get_calendar().ordinals([row[0] for row in rows])
+    first = int(weeks.min())
+    counts = numpy.zeros(weeks.max() - first + 1)
+    counts[weeks - first] = [float(row[1]) for row in rows]
+    return first, counts
+
+
+def read_category_series(filename, first, nweeks, attr='CONF_CATEGORY'):
+    ''' Count the conference records of each category in each week, from the parsed conference records
+    input:
+    filename: cms_conf_parsed.csv.gz written by cms_conf_parser.py, with a comma separated header and TAB separated records
+    first: the week ordinal of the first week of the series
+    nweeks: the number of weeks of the series
+    attr: the attribute of the category
+    output:
+    a dict of category to an array of float64 of its records in each week; records outside the series are left out
+    '''
+
+    calendar = get_calendar()
+    csvfile = open_read(filename)
+    header = csvfile.readline().rstrip('\n').split(',')
+    reader = csv.DictReader(csvfile, fieldnames=header, delimiter='\t')
+    weeks = {}
+    for row in reader:
+        week = calendar.date_ordinal(datetime.datetime.strptime(row['CONF_START'], '%Y-%m-%d').date())
+        weeks.setdefault(row[attr], []).append(week - first)
+    csvfile.close()
+    categories = {}
+    for category, offsets in weeks.items():
+        offsets = numpy.array(offsets)
+        offsets = offsets[(offsets >= 0) & (offsets < nweeks)]
+        categories[category] = numpy.bincount(offsets, minlength=nweeks).astype(numpy.float64)
+    return categories
+
+
+def read_best_lags(filename, attr):
+    ''' Read the lags of the best cross correlation of the values of an attribute
+    input:
+    filename: max_crosscorr_lags_per_group.csv.gz written by time_series.py --group-by
+    attr: the attribute, such as tier
+    output:
+    a dict of attribute value to lag in weeks
+    '''
+
+    csvfile = open_read(filename)
+    lags = dict((row['value'], int(row['lag'])) for row in csv.DictReader(csvfile) if row['attr'] == attr)
+    csvfile.close()
+    return lags
+
+
+def shifted(counts, offsets):
+    ''' The counts at an array of offsets, nan for the offsets outside the series '''
+
+    inside = (offsets >= 0) & (offsets < len(counts))
+    values = numpy.full(len(offsets), numpy.nan)
+    values[inside] = counts[offsets[inside]]
+    return values
+
+
+class ConfFeatures(object):
+    ''' The conference count features of every week, computed once over the whole series with cumulative sums and filters
+    input:
+    first: the week ordinal of the first week of the series
+    counts: the conferences of each week, as an array
+    features: a list of features, from parse_features
+    categories: a dict of category to the conferences of the category in each week, needed by the features of a category
+    lags: a dict of attribute to a dict of attribute value to lag, needed by the bestlag features
+    '''
+
+    def __init__(self, first, counts, features, categories=None, lags=None):
+        self.first = first
+        self.features = features
+        self.lags = lags or {}
+        self.series = {}
+        self.tables = {}
+        weeks = numpy.arange(len(counts))
+        for name, kind, arg, category in features:
+            if category is None:
+                series = counts
+            elif categories is not None:
+                series = categories.get(category, numpy.zeros(len(counts)))
+            else:
+                raise ValueError('feature %s needs the parsed conference records' % name)
+            self.series[name] = series
+            if kind == 'bestlag':
+                if arg not in self.lags:
+                    raise ValueError('feature %s needs the best lags of %s' % (name, arg))
+                continue
+            # the sums over windows are differences of the cumulative sums, nan where a window is not inside the series
+            cumsum = numpy.concatenate([[0.], numpy.cumsum(series)])
+            if kind in ('past', 'future'):
+                start = weeks - arg if kind == 'past' else weeks + 1
+                end = start + arg
+                table = numpy.full(len(series), numpy.nan)
+                inside = (start >= 0) & (end <= len(series))
+                table[inside] = cumsum[end[inside]] - cumsum[start[inside]]
+            elif kind == 'decay':
+                table = lfilter([1.], [1., -0.5 ** (1. / arg)], series)
+            else:
+                table = shifted(series, weeks + arg)
+            self.tables[name] = table
+
+    def columns(self):
+        ''' The names of the feature columns, in the order of the features '''
+
+        return [feature[0] for feature in self.features]
+
+    def attributes(self):
+        ''' The attributes of the records needed by the bestlag features '''
+
+        return sorted(set(arg for name, kind, arg, category in self.features if kind == 'bestlag'))
+
+    def for_week(self, week, nrows, attrs=None):
+        ''' The features of the records of a week
+        input:
+        week: the week ordinal of the records
+        nrows: the number of records
+        attrs: a dict of attribute to the array of its values as strings in the records, needed by the bestlag features
+        output:
+        an OrderedDict of column name to array of float64, nan where a window is not inside the series
+        '''
+
+        offset = week - self.first
+        data = OrderedDict()
+        for name, kind, arg, category in self.features:
+            if kind == 'bestlag':
+                # one lag per distinct value of the attribute, nan for the values without a lag
+                values, inverse = numpy.unique(numpy.asarray(attrs[arg], dtype=str), return_inverse=True)
+                known = numpy.array([value in self.lags[arg] for value in values], dtype=bool)
+                lags = numpy.array([self.lags[arg].get(value, 0) for value in values], dtype=numpy.int64)
+                data[name] = shifted(self.series[name], offset + lags[inverse])
+                data[name][~known[inverse]] = numpy.nan
+            elif 0 <= offset < len(self.tables[name]):
+                data[name] = numpy.full(nrows, self.tables[name][offset])
+            else:
+                data[name] = numpy.full(nrows, numpy.nan)
+        return data
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+#pylint: disable=
+"""
+File       : feature_hashing.py
+Author     : Ting <liting0612 AT gmail dot com>
+Description: Hashing of high-cardinality categorical columns and their
+             crosses into fixed-width sparse feature matrices
+"""
+
+# NumPy, SciPy and pandas
+import numpy as np
+import scipy.sparse as sp
+import pandas as pd
+
+# sklearn modules
+from sklearn.utils import murmurhash3_32
+
+def hash_column(name, vals):
+    """
+    Return 32-bit hashes of "name=value" strings of given values. The
+    hash is murmurhash3 with a fixed seed, so it is stable across runs
+    and machines, and it is computed once per distinct value.
+    """
+    codes, uniques = pd.factorize(np.asarray(vals))
+    hashes = np.array([murmurhash3_32('%s=%s' % (name, val), seed=0, positive=True) \
+            for val in uniques], dtype=np.int64)
+    out = np.empty(len(codes), dtype=np.int64)
+    out[codes >= 0] = hashes[codes[codes >= 0]]
+    # NAs have code -1 and all share one hash
+    out[codes < 0] = murmurhash3_32('%s=' % name, seed=0, positive=True)
+    return out
+
+def mix(hashes, other):
+    "Combine two arrays of 32-bit hashes into hashes of their pairs"
+    val = (hashes * 0x01000193) ^ other
+    val &= 0xffffffff
+    # finalizer of murmurhash3, to spread the bits of the combination
+    val ^= val >> 16
+    val = (val * 0x85ebca6b) & 0xffffffff
+    val ^= val >> 13
+    val = (val * 0xc2b2ae35) & 0xffffffff
+    val ^= val >> 16
+    return val
+
+class FeatureHasher(object):
+    """
+    Map given categorical columns, and crosses of them, of a data frame
+    into a sparse CSR matrix with 2**nbits columns. Each column and each
+    cross sets one entry per row, with sign +1/-1 taken from the hash if
+    alternate_sign is set, so that collisions cancel out on average.
+    """
+    def __init__(self, cols, crosses=None, nbits=20, alternate_sign=True):
+        self.cols = list(cols)
+        self.crosses = [list(cross) for cross in crosses or []]
+        self.nbits = nbits
+        self.alternate_sign = alternate_sign
+
+    @property
+    def n_features(self):
+        "Number of columns of hashed matrices"
+        return 1 << self.nbits
+
+    def hashed_columns(self):
+        "Return all columns used by hasher"
+        cols = list(self.cols)
+        for cross in self.crosses:
+            cols += [col for col in cross if col not in cols]
+        return cols
+
+    def transform(self, xdf):
+        "Return CSR matrix of hashed features of given data frame"
+        cache = {}
+        def column(col):
+            if  col not in cache:
+                cache[col] = hash_column(col, xdf[col].values)
+            return cache[col]
+        hashes = [column(col) for col in self.cols]
+        for cross in self.crosses:
+            val = column(cross[0])
+            for col in cross[1:]:
+                val = mix(val, column(col))
+            hashes.append(val)
+        nrows = len(xdf)
+        if  not hashes:
+            return sp.csr_matrix((nrows, self.n_features), dtype=np.float32)
+        hashes = np.column_stack(hashes)
+        indices = (hashes & (self.n_features - 1)).ravel()
+        if  self.alternate_sign:
+            data = np.where((hashes >> 31).ravel() & 1, -1., 1.).astype(np.float32)
+        else:
+            data = np.ones(indices.shape, dtype=np.float32)
+        indptr = np.arange(0, nrows*hashes.shape[1] + 1, hashes.shape[1])
+        mat = sp.csr_matrix((data, indices, indptr), shape=(nrows, self.n_features))
+        mat.sum_duplicates()
+        return mat
+
+def hashed_matrix(xdf, hasher, scaler=None):
+    """
+    Return CSR matrix of dense numeric columns of given data frame,
+    scaled by given fitted scaler if any, followed by hashed features of
+    hasher columns. Hashed columns are not used as numeric columns.
+    """
+    dense = xdf.drop(hasher.hashed_columns(), axis=1).values.astype(np.float32)
+    if  scaler is not None:
+        dense = scaler.transform(dense)
+    return sp.hstack([sp.csr_matrix(dense), hasher.transform(xdf)], format='csr')
@@ -0,0 +1,508 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Author     : Ting Li <liting0612 At gmail dot com>
+Description: Opens the input and output files of the scripts with the compression codec given by their magic bytes or extension: gzip, bz2, zstd, lz4 or none. zstd and lz4 need the zstandard and lz4 packages, and are only used when they are installed.
+             gzip files can be written as a series of gzip members of whole lines, compressed by a pool of threads, with an index of the members in a .gzi file next to them; zcat reads them as usual,
+             and the index lets readers decompress the members on several threads, split a file into parts, or start at any uncompressed offset.
+"""
+
+import os
+import io
+import bz2
+import zlib
+import glob
+import bisect
+import argparse
+import gzip
+from collections import deque
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+
+# the extension, the magic bytes at the start of a file, and the default level of each codec
+CODECS = {
+    'gzip': ('.gz', '\x1f\x8b', 9),
+    'bz2': ('.bz2', 'BZh', 9),
+    'zstd': ('.zst', '\x28\xb5\x2f\xfd', 3),
+    'lz4': ('.lz4', '\x04\x22\x4d\x18', 0),
+    'none': ('', None, None),
+}
+
+# the uncompressed size of the members of block gzip files
+BLOCK_SIZE = 1 << 20
+
+
+def codec_from_extension(filename):
+    ''' The codec of a file name by its extension
+    input:
+    filename: a file name
+    output:
+    the codec name, 'none' for an extension of no codec
+    '''
+
+    for codec, (ext, magic, level) in CODECS.items():
+        if ext and filename.endswith(ext):
+            return codec
+    return 'none'
+
+
+def detect_codec(filename):
+    ''' The codec of an existing file by its first bytes, or by its extension if the file is missing or empty
+    input:
+    filename: a file name
+    output:
+    the codec name
+    '''
+
+    if os.path.isfile(filename):
+        with open(filename, 'rb') as istream:
+            head = istream.read(4)
+        if head:
+            for codec, (ext, magic, level) in CODECS.items():
+                if magic and head.startswith(magic):
+                    return codec
+            return 'none'
+    return codec_from_extension(filename)
+
+
+def with_codec_extension(filename, codec):
+    ''' A file name with its codec extension replaced by that of another codec, e.g. for a .csv.gz output written with zstd
+    input:
+    filename: a file name
+    codec: the codec of the output, None to keep the file name
+    output:
+    the file name for the codec
+    '''
+
+    if not codec:
+        return filename
+    ext = CODECS[codec_from_extension(filename)][0]
+    if ext:
+        filename = filename[:-len(ext)]
+    return filename + CODECS[codec][0]
+
+
+def check_codec(codec):
+    ''' Raise an exception if a codec is unknown, or needs a package which is not installed '''
+
+    if codec not in CODECS:
+        raise ValueError('unknown codec %s, use one of %s' % (codec, ', '.join(sorted(CODECS))))
+    if codec == 'zstd' and zstandard is None:
+        raise ImportError('the zstd codec needs the zstandard package')
+    if codec == 'lz4' and lz4frame is None:
+        raise ImportError('the lz4 codec needs the lz4 package')
+
+
+class StreamWriter(object):
+    ''' A writable file over a compressing stream writer, which closes the underlying file with the stream '''
+
+    def __init__(self, writer, ostream):
+        self.writer = writer
+        self.ostream = ostream
+
+    def write(self, data):
+        self.writer.write(data)
+
+    def close(self):
+        self.writer.flush(zstandard.FLUSH_FRAME)
+        self.ostream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class StreamReader(io.BufferedReader):
+    ''' A buffered readable file over a decompressing stream reader, which closes the underlying file with the stream '''
+
+    def __init__(self, reader, istream):
+        io.BufferedReader.__init__(self, reader)
+        self.istream = istream
+
+    def close(self):
+        try:
+            io.BufferedReader.close(self)
+        finally:
+            self.istream.close()
+
+
+def compress_member(data, level):
+    ''' Compress a block of data into a complete gzip member '''
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress_member(data):
+    ''' Decompress a complete gzip member '''
+
+    return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+
+
+def index_name(filename):
+    ''' The name of the block index file of a block gzip file '''
+
+    return filename + '.gzi'
+
+
+def data_files(pattern):
+    ''' The files matching a glob pattern, without the block index files
+    input:
+    pattern: a glob pattern, such as indir/dataframe*
+    output:
+    a list of file names
+    '''
+
+    return [filename for filename in glob.glob(pattern) if not filename.endswith('.gzi')]
+
+
+def write_index(filename, index):
+    ''' Write the block index of a block gzip file
+    input:
+    filename: the block gzip file
+    index: a list of (compressed offset, uncompressed offset) of the start of each member, and of the end of the file
+    '''
+
+    with open(index_name(filename), 'w') as ostream:
+        ostream.write('coffset,uoffset\n')
+        for coffset, uoffset in index:
+            ostream.write('%d,%d\n' % (coffset, uoffset))
+
+
+def read_index(filename):
+    ''' Read the block index of a block gzip file
+    input:
+    filename: the block gzip file
+    output:
+    a list of (compressed offset, uncompressed offset) of the start of each member, and of the end of the file;
+    None if the file has no index, or if the index does not end at the end of the file, e.g. when the file has been rewritten since
+    '''
+
+    if not os.path.isfile(index_name(filename)):
+        return None
+    with open(index_name(filename)) as istream:
+        istream.readline()
+        index = [tuple(int(v) for v in line.split(',')) for line in istream]
+    if not index or index[-1][0] != os.path.getsize(filename):
+        return None
+    return index
+
+
+def thread_pool(threads):
+    ''' A pool of threads; multiprocessing is imported here, as it imports the standard select module, which select.py hides when the scripts import this module '''
+
+    from multiprocessing.pool import ThreadPool
+    return ThreadPool(threads)
+
+
+class BlockGzipWriter(object):
+    ''' A writable file of gzip members of whole lines, of about block_size bytes before compression, compressed by a pool of threads;
+    the index of the members is written at close
+    input:
+    filename: the output file
+    level: the compression level
+    threads: the number of compression threads
+    block_size: the uncompressed size of a member; a member ends at the end of the first line past this size
+    '''
+
+    def __init__(self, filename, level=9, threads=2, block_size=BLOCK_SIZE):
+        self.filename = filename
+        self.level = level
+        self.block_size = block_size
+        self.ostream = open(filename, 'wb')
+        self.pool = thread_pool(threads)
+        # at most two members per thread are waiting to be written, which bounds the memory
+        self.max_pending = 2 * threads
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+        # whether the buffer holds a line end; only the new data of a write is scanned for one, so a long line is not scanned again on every write
+        self.lines = False
+        self.index = [(0, 0)]
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.lines = self.lines or '\n' in data
+        if self.buffered >= self.block_size and self.lines:
+            self.flush_block()
+
+    def flush_block(self, final=False):
+        ''' Send the buffered data to the compression threads, as members of whole lines of about block_size bytes, and the rest of the data if final '''
+
+        data = ''.join(self.buffer)
+        start = 0
+        while len(data) - start >= self.block_size:
+            # the end of the first line past the block size, or of the last line of the data
+            cut = data.find('\n', start + self.block_size - 1) + 1 or data.rfind('\n', start) + 1
+            if cut <= start:
+                # a single line longer than a block, kept until its end is written
+                break
+            self.send_member(data[start:cut])
+            start = cut
+        # an empty file is still a valid gzip file, of one empty member
+        if final and (start < len(data) or len(self.index) == 1 and not self.pending):
+            self.send_member(data[start:])
+            start = len(data)
+        rest = data[start:]
+        self.buffer = [rest] if rest else []
+        self.buffered = len(rest)
+        self.lines = '\n' in rest
+
+    def send_member(self, data):
+        ''' Send a member to the compression threads, writing the oldest ones when too many are waiting '''
+
+        self.pending.append((len(data), self.pool.apply_async(compress_member, (data, self.level))))
+        while len(self.pending) > self.max_pending:
+            self.write_member()
+
+    def write_member(self):
+        ''' Write the oldest compressed member, waiting for its compression to end '''
+
+        size, result = self.pending.popleft()
+        member = result.get()
+        self.ostream.write(member)
+        self.index.append((self.index[-1][0] + len(member), self.index[-1][1] + size))
+
+    def close(self):
+        self.flush_block(final=True)
+        while self.pending:
+            self.write_member()
+        self.pool.close()
+        self.pool.join()
+        self.ostream.close()
+        write_index(self.filename, self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BlockGzipReader(object):
+    ''' A readable file of a range of the members of a block gzip file, decompressed ahead by a pool of threads
+    input:
+    filename: the block gzip file
+    index: its block index, from read_index
+    threads: the number of decompression threads
+    start, stop: the range of members to read, by default all of them
+    '''
+
+    def __init__(self, filename, index, threads=2, start=0, stop=None):
+        self.istream = open(filename, 'rb')
+        self.index = index
+        self.pool = thread_pool(threads)
+        self.max_pending = 2 * threads
+        self.start = start
+        self.stop = len(index) - 1 if stop is None else stop
+        self.lines = self.iter_lines()
+
+    def iter_blocks(self):
+        ''' Generate the decompressed members in order, the next ones being decompressed meanwhile '''
+
+        pending = deque()
+        self.istream.seek(self.index[self.start][0])
+        for i in range(self.start, self.stop):
+            data = self.istream.read(self.index[i + 1][0] - self.index[i][0])
+            pending.append(self.pool.apply_async(decompress_member, (data,)))
+            if len(pending) > self.max_pending:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def iter_lines(self):
+        ''' Generate the lines of the members, which hold whole lines '''
+
+        for block in self.iter_blocks():
+            lines = block.split('\n')
+            for line in lines[:-1]:
+                yield line + '\n'
+            if lines[-1]:
+                yield lines[-1]
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self.lines)
+
+    def readline(self):
+        return next(self.lines, '')
+
+    def read(self):
+        return ''.join(self.lines)
+
+    def close(self):
+        self.pool.close()
+        self.istream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def split_blocks(index, nparts):
+    ''' Split the members of a block gzip file into ranges of about the same uncompressed size, for reading one file by several workers
+    input:
+    index: the block index of the file
+    nparts: the number of ranges
+    output:
+    a list of (start, stop) ranges of members, for the start and stop arguments of BlockGzipReader; the first range holds the header line
+    '''
+
+    uoffsets = [uoffset for coffset, uoffset in index]
+    bounds = [bisect.bisect_left(uoffsets, uoffsets[-1] * i / float(nparts)) for i in range(0, nparts)] + [len(index) - 1]
+    bounds = sorted(set(min(b, len(index) - 1) for b in bounds))
+    return [(bounds[i], bounds[i + 1]) for i in range(0, len(bounds) - 1)]
+
+
+def read_at(filename, offset, size=-1, index=None):
+    ''' Read from an uncompressed offset of a block gzip file, decompressing only the members from the one holding the offset
+    input:
+    filename: the block gzip file
+    offset: the uncompressed offset
+    size: the number of bytes to read, -1 for all up to the end of the file
+    index: the block index of the file, read from its .gzi file if not given
+    output:
+    the bytes read
+    '''
+
+    index = index or read_index(filename)
+    if index is None:
+        raise IOError('%s has no block index %s' % (filename, index_name(filename)))
+    first = max(bisect.bisect_right([uoffset for coffset, uoffset in index], offset) - 1, 0)
+    chunks = []
+    nread = 0
+    skip = offset - index[first][1]
+    with open(filename, 'rb') as istream:
+        istream.seek(index[first][0])
+        for i in range(first, len(index) - 1):
+            block = decompress_member(istream.read(index[i + 1][0] - index[i][0]))[skip:]
+            skip = 0
+            chunks.append(block)
+            nread += len(block)
+            if size >= 0 and nread >= size:
+                break
+    data = ''.join(chunks)
+    return data if size < 0 else data[:size]
+
+
+def open_read(filename, threads=0):
+    ''' Open a file for reading, decompressed with the codec detected from its first bytes
+    input:
+    filename: a file name
+    threads: the number of threads decompressing a block gzip file with a block index, 0 to read it as a plain gzip file
+    output:
+    a file object, whose lines are those of the decompressed file
+    '''
+
+    codec = detect_codec(filename)
+    check_codec(codec)
+    if codec == 'gzip':
+        index = read_index(filename) if threads > 0 else None
+        if index is not None:
+            return BlockGzipReader(filename, index, threads)
+        return gzip.open(filename, 'rb')
+    elif codec == 'bz2':
+        return bz2.BZ2File(filename, 'rb')
+    elif codec == 'zstd':
+        istream = open(filename, 'rb')
+        return StreamReader(zstandard.ZstdDecompressor().stream_reader(istream), istream)
+    elif codec == 'lz4':
+        return lz4frame.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def open_write(filename, codec=None, level=None, threads=0):
+    ''' Open a file for writing, compressed with a codec
+    input:
+    filename: a file name
+    codec: the codec, None for the codec of the file name extension
+    level: the compression level, None for the default level of the codec
+    threads: the number of threads compressing a gzip file into a block gzip file with a block index, 0 for a plain gzip file
+    output:
+    a file object
+    '''
+
+    codec = codec or codec_from_extension(filename)
+    check_codec(codec)
+    if level is None:
+        level = CODECS[codec][2]
+    # the block index of an earlier version of the file would not match it
+    if os.path.isfile(index_name(filename)):
+        os.remove(index_name(filename))
+    if codec == 'gzip':
+        if threads > 0:
+            return BlockGzipWriter(filename, level, threads)
+        return gzip.open(filename, 'wb', level)
+    elif codec == 'bz2':
+        return bz2.BZ2File(filename, 'wb', compresslevel=level)
+    elif codec == 'zstd':
+        ostream = open(filename, 'wb')
+        return StreamWriter(zstandard.ZstdCompressor(level=level).stream_writer(ostream), ostream)
+    elif codec == 'lz4':
+        return lz4frame.open(filename, 'wb', compression_level=level)
+    return open(filename, 'wb')
+
+
+def csv_source(filename):
+    ''' The arguments of pandas.read_csv for a file: pandas decompresses gzip and bz2 itself, other codecs are read through open_read
+    input:
+    filename: a file name
+    output:
+    (file name or file object, pandas compression)
+    '''
+
+    codec = detect_codec(filename)
+    if codec in ('gzip', 'bz2'):
+        return filename, codec
+    elif codec == 'none':
+        return filename, None
+    return open_read(filename), None
+
+
+def read_csv(filename, **kwargs):
+    ''' pandas.read_csv of a file compressed with any codec
+    input:
+    filename: a file name
+    kwargs: the other arguments of pandas.read_csv
+    output:
+    a data frame, or a reader of data frames if chunksize is given
+    '''
+
+    import pandas
+    source, compression = csv_source(filename)
+    return pandas.read_csv(source, compression=compression, **kwargs)
+
+
+def codec_argument(codec):
+    ''' The type of the --codec option, which rejects the codecs whose package is not installed before any work is done '''
+
+    try:
+        check_codec(codec)
+    except (ValueError, ImportError) as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return codec
+
+
+def add_codec_arguments(parser):
+    ''' Add the --codec and --level options of the output files to an argparse parser '''
+
+    parser.add_argument('--codec', dest='codec', default='gzip', type=codec_argument, help='the compression codec of the output files, default gzip; the file extensions follow the codec, e.g. .csv.zst for zstd')
+    parser.add_argument('--level', dest='level', type=int, default=None, help='the compression level of the output files, default 9 for gzip, 3 for zstd, 0 for lz4 and 9 for bz2')
+    parser.add_argument('--threads', dest='threads', type=int, default=0, help='''the number of threads compressing gzip outputs into blocks with a .gzi block index, and decompressing inputs with a block index, default 0:
+plain single stream gzip; zcat reads both''')
@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Author     : Ting Li <liting0612 At gmail dot com>
+Description: Forecasts the access counts of each dataset in the next weeks, by an autoregressive model with conference count lead terms fitted for all datasets at once.
+"""
+
+import os
+import csv
+import argparse
+import numpy
+from access_matrix import load_access_matrix
+from week_calendar import get_calendar
+from fileio import open_read, open_write, with_codec_extension, add_codec_arguments
+from instrument import span, start_profiler, add_profile_arguments
+
+
+def design(naccess, confct, rows, weeks, order, leads):
+    ''' Build the regressors of the autoregressive model at given weeks of given datasets
+    input:
+    naccess: a 2d array, with a row for each dataset and a column for each week
+    confct: the conference count series on the same week grid, as an array; weeks beyond it have 0 conferences
+    rows: the row of each dataset, as an array of shape (g,)
+    weeks: the columns of the weeks to predict, as an array of shape (g, m)
+    order: the number of past weeks of access counts
+    leads: the number of current and future weeks of conference counts
+    output:
+    x: an array of shape (g, m, 1 + order + leads), with an intercept, the access counts of the past weeks, and the conference counts of the current and future weeks
+    '''
+
+    confct = numpy.concatenate([confct, numpy.zeros(leads)])
+    x = numpy.empty(weeks.shape + (1 + order + leads,))
+    x[:, :, 0] = 1
+    for i in range(1, order + 1):
+        x[:, :, i] = naccess[rows[:, None], weeks - i]
+    for j in range(0, leads):
+        x[:, :, 1 + order + j] = confct[weeks + j]
+    return x
+
+
+def fit_ar(naccess, confct, first, end, order, leads, ridge=1e-3, min_samples=10):
+    ''' Fit the autoregressive model of each dataset by least squares, solved as one batch for all datasets with the same history length
+    input:
+    naccess: a 2d array, with a row for each dataset and a column for each week
+    confct: the conference count series on the same week grid, as an array
+    first: the column of the first week of each dataset, as an array
+    end: the column after the last week of the history used for fitting
+    order, leads: as in design
+    ridge: the ridge penalty added to the normal equations, for the datasets whose regressors are collinear
+    min_samples: the datasets with fewer weeks to fit get a persistence model, i.e. the forecast is the last access count
+    output:
+    coefs: a 2d array with a row of 1 + order + leads coefficients for each dataset
+    rmse: the root mean squared residual of each dataset, nan for persistence models
+    '''
+
+    nparams = 1 + order + leads
+    coefs = numpy.zeros((naccess.shape[0], nparams))
+    coefs[:, 1] = 1 # persistence, for the datasets with too short a history
+    rmse = numpy.full(naccess.shape[0], numpy.nan)
+
+    # the weeks to predict start after the first order weeks of each dataset, so the history length fixes the number of samples
+    nsamples = end - (first + order)
+    for m in numpy.unique(nsamples):
+        if m < max(min_samples, nparams):
+            continue
+        rows = numpy.where(nsamples == m)[0]
+        weeks = (first[rows] + order)[:, None] + numpy.arange(m)[None, :]
+        x = design(naccess, confct, rows, weeks, order, leads)
+        y = naccess[rows[:, None], weeks]
+
+        # batched normal equations, one small system per dataset
+        xtx = numpy.einsum('gmk,gml->gkl', x, x) + ridge * numpy.eye(nparams)[None, :, :]
+        xty = numpy.einsum('gmk,gm->gk', x, y)
+        beta = numpy.linalg.solve(xtx, xty[:, :, None])[:, :, 0]
+        coefs[rows] = beta
+        residuals = y - numpy.einsum('gmk,gk->gm', x, beta)
+        rmse[rows] = numpy.sqrt((residuals ** 2).mean(axis=1))
+    return coefs, rmse
+
+
+def forecast_ar(naccess, confct, coefs, end, horizon, order, leads):
+    ''' Forecast the access counts of all datasets in the horizon weeks from a given week, feeding the forecasts back as past access counts
+    input:
+    naccess: a 2d array, with a row for each dataset and a column for each week
+    confct: the conference count series on the same week grid, as an array
+    coefs: the coefficients of each dataset, as returned by fit_ar
+    end: the column of the first week to forecast
+    horizon: the number of weeks to forecast
+    order, leads: as in design
+    output:
+    forecasts: a 2d array of shape (nb of datasets, horizon), clipped at 0
+    '''
+
+    rows = numpy.arange(naccess.shape[0])
+    # the history followed by the forecasts, so that a forecast is used as a past access count of the later weeks
+    series = numpy.concatenate([naccess[:, :end], numpy.zeros((naccess.shape[0], horizon))], axis=1)
+    # the whole conference calendar is kept for the lead terms of the later weeks, 0 only past its end
+    confct = numpy.concatenate([confct, numpy.zeros(max(end + horizon - len(confct), 0))])
+    for h in range(0, horizon):
+        weeks = numpy.full((len(rows), 1), end + h, dtype=numpy.int64)
+        x = design(series, confct, rows, weeks, order, leads)[:, 0, :]
+        series[:, end + h] = numpy.maximum((x * coefs).sum(axis=1), 0)
+    return series[:, end:]
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='''Forecasts the access counts of each dataset in the next weeks, by an autoregressive model with conference count lead terms fitted for all datasets at once.
+
+Example:
+forecast.py --inmatrix datasets/time_series_matrix.npz --inconf cms_conf_ct_perweek.csv.gz --order 4 --leads 4 --horizon 4 --outfile forecasts.csv.gz
+forecast.py --inmatrix datasets/time_series_matrix.npz --inconf cms_conf_ct_perweek.csv.gz --holdout 4 --horizon 4
+''', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--inmatrix', dest='inmatrix', help='a .npz file for the matrix of dataset access series on the global week grid, written by time_series.py')
+    parser.add_argument('--inconf', dest='inconf', help='a csv.gz file for the input conference count per week data')
+    parser.add_argument('--order', dest='order', type=int, default=4, help='the number of past weeks of access counts in the model, default 4')
+    parser.add_argument('--leads', dest='leads', type=int, default=4, help='the number of current and future weeks of conference counts in the model, default 4')
+    parser.add_argument('--horizon', dest='horizon', type=int, default=4, help='the number of weeks to forecast, default 4')
+    parser.add_argument('--holdout', dest='holdout', type=int, default=0, help='''if positive, leave out this many last weeks of the access data when fitting, and compare the forecasts of those weeks with the true access counts
+and with the last access count, instead of writing forecasts''')
+    parser.add_argument('--outfile', dest='outfile', help='a csv.gz file for the output forecasts of each dataset, with a column for each week ahead')
+    add_profile_arguments(parser)
+    add_codec_arguments(parser)
+    args = parser.parse_args()
+    start_profiler(args.profile, args.profile_hot)
+
+    calendar = get_calendar()
+
+    # 1. read in the access series and the conference count series, on the same week grid
+    with span('read', file=os.path.basename(args.inmatrix)) as rec:
+        matrix = load_access_matrix(args.inmatrix)
+        rec['rows'] = len(matrix['dataset'])
+    naccess = matrix['naccess'].astype(numpy.float64)
+    csvfile = open_read(args.inconf)
+    reader = csv.DictReader(csvfile)
+    confct = dict((calendar.ordinal(dct['tstamp']), float(dct['confct'])) for dct in reader)
+    csvfile.close()
+    grid = matrix['week']
+    # the conference counts after the access data are kept for the lead terms
+    confct = numpy.array([confct.get(week, 0.) for week in range(grid[0], max(max(confct.keys()) + 1, grid[-1] + 1))])
+
+    # the history of all datasets ends with the last week of the access data, a missing week of a dataset being 0 access
+    keep = matrix['length'] > 0
+    end = (matrix['start'] + matrix['length'])[keep].max()
+    first = matrix['start']
+    if args.holdout > 0:
+        end -= args.holdout
+
+    # 2. fit all the datasets, and forecast
+    with span('fit', rows=len(naccess)):
+        coefs, rmse = fit_ar(naccess, confct, first, end, args.order, args.leads)
+    fitted = ~numpy.isnan(rmse) & keep
+    print 'nb of datasets:', keep.sum(), ', fitted:', fitted.sum(), ', with persistence forecasts:', (keep & ~fitted).sum()
+    print 'median in-sample rmse:', numpy.median(rmse[fitted]) if fitted.any() else None
+    with span('forecast', rows=len(naccess)):
+        forecasts = forecast_ar(naccess, confct, coefs, end, args.horizon, args.order, args.leads)
+
+    # 3. evaluate on the holdout weeks, or write out the forecasts
+    if args.holdout > 0:
+        nweeks = min(args.holdout, args.horizon)
+        truth = naccess[keep, end:end + nweeks]
+        persistence = numpy.repeat(naccess[keep, end - 1][:, None], nweeks, axis=1)
+        print '********************'
+        print 'Mean absolute error per week ahead, autoregressive model vs last access count:'
+        for h in range(0, nweeks):
+            print '%dwk: %f %f' % (h + 1, numpy.abs(forecasts[keep, h] - truth[:, h]).mean(), numpy.abs(persistence[:, h] - truth[:, h]).mean())
+    else:
+        print 'forecast weeks:', ' '.join(calendar.to_windows(grid[0] + end + numpy.arange(args.horizon)))
+        csvfile = open_write(with_codec_extension(args.outfile, args.codec), args.codec, args.level, args.threads)
+        csvfile.write('dataset,dbs,' + ','.join(str(h + 1) + 'wk' for h in range(0, args.horizon)) + '\n')
+        for i in numpy.where(keep)[0]:
+            csvfile.write(matrix['dataset'][i] + ',' + matrix['dbs'][i] + ',' + ','.join(str(v) for v in forecasts[i]) + '\n')
+        csvfile.close()
+
+if __name__ == '__main__':
+
+    main()
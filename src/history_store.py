@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Author     : Ting Li <liting0612 At gmail dot com>
+Description: Keeps the access history of each (dataset, dbs) in a store updated one week at a time, and adds history features, such as the access counts of the last weeks, the weeks since the last access, an EWMA and a trend slope, to dataset access records.
+"""
+
+import os
+import csv
+import argparse
+from collections import OrderedDict
+import numpy
+from pairkey import pair_key, sum_by_key, sorted_join
+from week_calendar import get_calendar
+from fileio import open_read, data_files, with_codec_extension, add_codec_arguments
+from colstore import ColumnStore, is_store, write_csv
+from instrument import span, start_profiler, add_profile_arguments
+
+# the week of the keys never accessed, far enough in the past to fall out of every window
+NEVER = -(1 << 30)
+
+
+class HistoryStore(object):
+    ''' The access history of each (dataset, dbs) key, as sorted arrays saved in one .npz file.
+    Each key keeps its access counts of the last weeks in a ring of columns indexed by week ordinal modulo the ring size, and the week of its last record;
+    an update only touches the keys of the new week, the columns of the weeks without records being cleared when the key is next updated or skipped when it is read
+    input:
+    filename: the .npz file of the store, created at the first save
+    windows: the lengths in weeks of the access count sums, used only when the store is created
+    alpha: the smoothing factor of the EWMA of the weekly access counts, used only when the store is created
+    trend: the number of weeks of the trend slope, used only when the store is created
+    '''
+
+    def __init__(self, filename, windows=(1, 4, 12, 52), alpha=0.3, trend=12):
+        self.filename = filename
+        if os.path.isfile(filename):
+            state = numpy.load(filename)
+            self.windows = [int(w) for w in state['windows']]
+            self.alpha = float(state['alpha'])
+            self.trend = int(state['trend'])
+            self.week = int(state['week'])
+            self.keys = state['keys']
+            self.ring = state['ring']
+            self.last = state['last']
+            self.last_access = state['last_access']
+            self.ewma = state['ewma']
+            return
+        self.windows = sorted(windows)
+        self.alpha = alpha
+        self.trend = trend
+        self.week = NEVER
+        self.keys = numpy.zeros(0, dtype=numpy.int64)
+        self.ring = numpy.zeros((0, max(self.windows + [self.trend])), dtype=numpy.float32)
+        self.last = numpy.zeros(0, dtype=numpy.int32)
+        self.last_access = numpy.zeros(0, dtype=numpy.int32)
+        self.ewma = numpy.zeros(0)
+
+    def save(self):
+        ''' Write the store, atomically '''
+
+        tmp = '%s.tmp%s.npz' % (self.filename, os.getpid())
+        numpy.savez(tmp, windows=numpy.array(self.windows), alpha=self.alpha, trend=self.trend, week=self.week,
+                    keys=self.keys, ring=self.ring, last=self.last, last_access=self.last_access, ewma=self.ewma)
+        os.rename(tmp, self.filename)
+
+    def add_keys(self, keys):
+        ''' Add new keys, keeping all the arrays sorted by key
+        input:
+        keys: unique keys, not in the store
+        '''
+
+        if not len(keys):
+            return
+        order = numpy.argsort(numpy.concatenate([self.keys, keys]), kind='mergesort')
+        self.keys = numpy.concatenate([self.keys, keys])[order]
+        self.ring = numpy.concatenate([self.ring, numpy.zeros((len(keys), self.ring.shape[1]), dtype=self.ring.dtype)])[order]
+        self.last = numpy.concatenate([self.last, numpy.full(len(keys), NEVER, dtype=numpy.int32)])[order]
+        self.last_access = numpy.concatenate([self.last_access, numpy.full(len(keys), NEVER, dtype=numpy.int32)])[order]
+        self.ewma = numpy.concatenate([self.ewma, numpy.zeros(len(keys))])[order]
+
+    def ring_weeks(self, week):
+        ''' The week ordinal held by each ring column, for the ring ending at a week '''
+
+        size = self.ring.shape[1]
+        return week - (week - numpy.arange(size)) % size
+
+    def update(self, week, keys, naccess):
+        ''' Add the access records of a week, later than all the weeks already in the store
+        input:
+        week: the week ordinal of the records
+        keys: the (dataset, dbs) keys of the records, from pairkey.pair_key, possibly repeated
+        naccess: the access counts of the records
+        output:
+        the number of distinct keys of the week
+        '''
+
+        if week <= self.week:
+            raise ValueError('week %s is not after the last week %s of the history store %s' % (get_calendar().window(week), get_calendar().window(self.week), self.filename))
+        ukeys, counts = sum_by_key(keys, naccess)
+        index = sorted_join(ukeys, self.keys)
+        self.add_keys(ukeys[index < 0])
+        index = sorted_join(ukeys, self.keys)
+
+        # clear the columns of the weeks since the last record of each key, which still hold older weeks
+        weeks = self.ring_weeks(week)
+        last = self.last[index]
+        stale = (weeks[None, :] > last[:, None]) & (weeks[None, :] < week)
+        ring = self.ring[index]
+        ring[stale] = 0
+        ring[:, week % self.ring.shape[1]] = counts
+        self.ring[index] = ring
+
+        # the EWMA decays by 1 - alpha for each week without records
+        gap = numpy.where(last == NEVER, 1, week - last)
+        self.ewma[index] = self.alpha * counts + (1 - self.alpha) ** gap * self.ewma[index]
+        self.last[index] = week
+        accessed = index[counts > 0]
+        self.last_access[accessed] = week
+        self.week = week
+        return len(ukeys)
+
+    def columns(self):
+        ''' The names of the history feature columns '''
+
+        return ['hist_sum%d' % w for w in self.windows] + ['hist_weeks_since', 'hist_ewma', 'hist_trend%d' % self.trend]
+
+    def features(self, keys, week=None):
+        ''' The history features of records, as of the end of a week, from the weeks up to and including it
+        input:
+        keys: the (dataset, dbs) keys of the records, from pairkey.pair_key
+        week: the week ordinal, the last week of the store by default; earlier weeks are not available
+        output:
+        an OrderedDict of column name to array of float64; the weeks since the last access are nan for the keys never accessed
+        '''
+
+        week = self.week if week is None else week
+        if week < self.week:
+            raise ValueError('the history store %s is at week %s, after week %s' % (self.filename, get_calendar().window(self.week), get_calendar().window(week)))
+        index = sorted_join(keys, self.keys)
+        found = index >= 0
+        index = index[found]
+
+        # the ring columns of the weeks after the last record of a key hold older weeks, and are left out
+        weeks = self.ring_weeks(week)
+        last = self.last[index]
+        valid = weeks[None, :] <= last[:, None]
+        ring = numpy.where(valid, self.ring[index], 0)
+        data = OrderedDict()
+        for w in self.windows:
+            data['hist_sum%d' % w] = (ring * (weeks > week - w)[None, :]).sum(axis=1)
+        since = (week - self.last_access[index]).astype(numpy.float64)
+        since[self.last_access[index] == NEVER] = numpy.nan
+        data['hist_weeks_since'] = since
+        data['hist_ewma'] = (1 - self.alpha) ** (week - last) * self.ewma[index]
+
+        # the least squares slope of the weekly counts over the last weeks, the weeks without records counting as 0
+        inside = weeks > week - self.trend
+        x = weeks[inside] - weeks[inside].mean()
+        data['hist_trend%d' % self.trend] = ring[:, inside].dot(x) / (x * x).sum() if len(x) > 1 else numpy.zeros(len(index))
+
+        # the keys without history have no access
+        out = OrderedDict()
+        for col, values in data.items():
+            out[col] = numpy.full(len(keys), numpy.nan if col == 'hist_weeks_since' else 0.)
+            out[col][found] = values
+        return out
+
+
+def weekly_columns(indir, threads=0):
+    ''' The columns of the weekly dataset access files of a dir, or of the partitions of a columnar store, in week order
+    input:
+    indir: a dir of dataframe* files, or a columnar store made by colstore.py
+    threads: the number of threads decompressing a block gzip file
+    output:
+    a generator of (week ordinal, file name, OrderedDict of column name to list of strings or array of values)
+    '''
+
+    calendar = get_calendar()
+    if is_store(indir):
+        store = ColumnStore(indir)
+        for part in store.catalog['partitions']:
+            yield calendar.ordinal(part['window']), part['source'], store.read_partition(part, part['columns'])
+        return
+    for filename in sorted(data_files(indir + '/dataframe*'), key=calendar.filename_ordinal):
+        csvfile = open_read(filename, threads)
+        reader = csv.reader(csvfile)
+        header = reader.next()
+        rows = list(reader)
+        csvfile.close()
+        yield calendar.filename_ordinal(filename), os.path.basename(filename), OrderedDict((col, [row[i] for row in rows]) for i, col in enumerate(header))
+
+
+def record_keys(data):
+    ''' The (dataset, dbs) keys and the access counts of records, from their columns '''
+
+    keys = pair_key(numpy.asarray(data['dataset']).astype(numpy.int64), numpy.asarray(data['dbs']).astype(numpy.int64))
+    naccess = numpy.array([float(v) if v != '' else 0. for v in data['naccess']]) if isinstance(data['naccess'], list) else numpy.nan_to_num(data['naccess'].astype(numpy.float64))
+    return keys, naccess
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='''Keeps the access history of each (dataset, dbs) in a store updated one week at a time, and adds history features to dataset access records:
+hist_sum1, hist_sum4, ...: the access counts summed over the last weeks, including the week of a record;
+hist_weeks_since: the weeks since the last week with access, empty if never accessed;
+hist_ewma: the exponentially weighted moving average of the weekly access counts;
+hist_trend12: the least squares slope of the weekly access counts over the last weeks.
+The weekly files later than the last week of the store are added to it in week order, and the records of each get the features as of the end of their week, written to outdir.
+Rerunning as new weeks arrive only processes the new weeks. A file, such as new data to score, can also get the features as of the last week of the store.
+
+Example:
+history_store.py --indir merged --store history.npz --outdir merged_history
+history_store.py --store history.npz --join test.csv.gz --output test_history.csv.gz
+''', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--indir', dest='indir', default='', help='a dir containing the dataframe* files of the dataset access data, merged or not, or a columnar store of them made by colstore.py')
+    parser.add_argument('--store', dest='store', help='the .npz file of the history store')
+    parser.add_argument('--outdir', dest='outdir', default='', help='a dir for the weekly files of --indir with the history features added, none written if empty')
+    parser.add_argument('--join', dest='join', default='', help='a csv(.gz) file with dataset and dbs columns, to add the history features as of the last week of the store to')
+    parser.add_argument('--output', dest='output', default='', help='the output file of --join')
+    parser.add_argument('--windows', dest='windows', default='1,4,12,52', help='a comma separated list of the lengths in weeks of the access count sums, default 1,4,12,52; only used when the store is created')
+    parser.add_argument('--alpha', dest='alpha', type=float, default=0.3, help='the smoothing factor of the EWMA, default 0.3; only used when the store is created')
+    parser.add_argument('--trend', dest='trend', type=int, default=12, help='the number of weeks of the trend slope, default 12; only used when the store is created')
+    add_profile_arguments(parser)
+    add_codec_arguments(parser)
+    args = parser.parse_args()
+    start_profiler(args.profile, args.profile_hot)
+
+    history = HistoryStore(args.store, [int(w) for w in args.windows.split(',')], args.alpha, args.trend)
+    calendar = get_calendar()
+    if args.outdir and not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+
+    # 1. the new weeks, each joined with the history up to its end and then added to it
+    if args.indir:
+        nweeks = 0
+        for week, source, data in weekly_columns(args.indir, args.threads):
+            if week <= history.week:
+                continue
+            with span('update', merge=True) as rec:
+                keys, naccess = record_keys(data)
+                rec['rows'] = len(keys)
+                history.update(week, keys, naccess)
+            if args.outdir:
+                with span('join', merge=True, rows=len(keys)):
+                    data.update(history.features(keys))
+                with span('write', merge=True, rows=len(keys)):
+                    write_csv(data, with_codec_extension(args.outdir + '/' + source, args.codec), args.codec, args.level, args.threads)
+            nweeks += 1
+        history.save()
+        print 'added', nweeks, 'weeks, the history store is at week', calendar.window(history.week) if history.week != NEVER else None, 'with', len(history.keys), 'datasets'
+
+    # 2. a file joined with the history up to the last week of the store
+    if args.join:
+        with span('join', file=os.path.basename(args.join)) as rec:
+            csvfile = open_read(args.join, args.threads)
+            reader = csv.reader(csvfile)
+            header = reader.next()
+            rows = list(reader)
+            csvfile.close()
+            data = OrderedDict((col, [row[i] for row in rows]) for i, col in enumerate(header))
+            data.update(history.features(pair_key(numpy.array(data['dataset']).astype(numpy.int64), numpy.array(data['dbs']).astype(numpy.int64))))
+            rec['rows'] = len(rows)
+        write_csv(data, with_codec_extension(args.output, args.codec), args.codec, args.level, args.threads)
+
+if __name__ == '__main__':
+
+    main()
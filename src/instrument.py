@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Author     : Ting Li <liting0612 At gmail dot com>
+Description: Records named spans of the stages of a script, with their wall time, CPU time, rows processed, bytes read and written and peak memory, into a JSON file, and optionally profiles the hot span with cProfile.
+"""
+
+import os
+import sys
+import json
+import time
+import pstats
+import socket
+import cProfile
+import resource
+import StringIO
+from contextlib import contextmanager
+from collections import OrderedDict
+
+
+def io_counters():
+    ''' The bytes read and written by this process so far, from /proc/self/io (Linux only)
+    output:
+    (bytes read, bytes written), or (None, None) if they are not available
+    '''
+
+    try:
+        with open('/proc/self/io') as istream:
+            fields = dict(line.split(':') for line in istream)
+        return int(fields['rchar']), int(fields['wchar'])
+    except (IOError, KeyError, ValueError):
+        return None, None
+
+
+def cpu_time():
+    ''' The user and system CPU time of this process so far, in seconds '''
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def max_rss_mb():
+    ''' The peak resident memory of this process so far, in MB (ru_maxrss is in kB on Linux) '''
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+class Profiler(object):
+    ''' A recorder of spans, which does nothing but yield a dict for the span attributes when no output file is given
+    input:
+    filename: the output JSON file, None to disable recording
+    hot: the name of a span to profile with cProfile, None for no profiling
+    '''
+
+    def __init__(self, filename=None, hot=None):
+        self.filename = filename
+        self.hot = hot
+        self.spans = []
+        self.stack = []
+        self.start = time.time()
+        self.merged = {}
+        self.prof = None
+
+    @contextmanager
+    def span(self, name, merge=False, **attrs):
+        ''' Record a span around a block of code; the block can add attributes, such as rows, to the yielded dict
+        input:
+        name: the name of the span, e.g. the stage
+        merge: if True, add the times, rows and bytes to the previous span with the same name and parent instead of recording a new span, for spans in a loop over many items
+        attrs: attributes of the span, e.g. the input file
+        output:
+        a dict of the attributes of the span
+        '''
+
+        rec = OrderedDict([('name', name)])
+        rec.update(attrs)
+        if not self.filename:
+            yield rec
+            return
+        rec['parent'] = self.stack[-1] if self.stack else None
+        self.stack.append(name)
+        prof = None
+        if name == self.hot and self.stack.count(name) == 1:
+            # a single cProfile run accumulates over all the spans of the hot name
+            if self.prof is None:
+                self.prof = cProfile.Profile()
+            prof = self.prof
+            prof.enable()
+        read0, written0 = io_counters()
+        wall0, cpu0 = time.time(), cpu_time()
+        try:
+            yield rec
+        finally:
+            rec['wall'] = time.time() - wall0
+            rec['cpu'] = cpu_time() - cpu0
+            read1, written1 = io_counters()
+            rec['bytes_read'] = read1 - read0 if read0 is not None else None
+            rec['bytes_written'] = written1 - written0 if written0 is not None else None
+            rec['max_rss_mb'] = max_rss_mb()
+            if rec.get('rows') and rec['wall'] > 0:
+                rec['rows_per_s'] = rec['rows'] / rec['wall']
+            if prof is not None:
+                prof.disable()
+            self.stack.pop()
+            if merge:
+                self.merge(rec)
+            else:
+                self.spans.append(rec)
+
+    def merge(self, rec):
+        ''' Add a span to the previous span with the same name and parent, counting the merged spans in 'count' '''
+
+        key = (rec['name'], rec['parent'])
+        prev = self.merged.get(key)
+        if prev is None:
+            rec['count'] = 1
+            self.merged[key] = rec
+            self.spans.append(rec)
+            return
+        prev['count'] += 1
+        for field in ['wall', 'cpu', 'bytes_read', 'bytes_written', 'rows']:
+            if rec.get(field) is not None:
+                prev[field] = (prev.get(field) or 0) + rec[field]
+        prev['max_rss_mb'] = rec['max_rss_mb']
+        if prev.get('rows') and prev['wall'] > 0:
+            prev['rows_per_s'] = prev['rows'] / prev['wall']
+
+    def profile_stats(self, limit=30):
+        ''' The functions with the highest cumulative time in the hot spans, whose full cProfile stats are dumped next to the output file
+        input:
+        limit: the number of functions kept in the JSON output
+        output:
+        the text of the pstats report, or None if the hot span never ran
+        '''
+
+        if self.prof is None:
+            return None
+        self.prof.dump_stats('%s.%s.prof' % (self.filename, self.hot))
+        stream = StringIO.StringIO()
+        stats = pstats.Stats(self.prof, stream=stream)
+        stats.sort_stats('cumulative').print_stats(limit)
+        return stream.getvalue()
+
+    def save(self):
+        ''' Write the spans, with the command line and host, to the output JSON file '''
+
+        if not self.filename:
+            return
+        out = OrderedDict([('script', os.path.basename(sys.argv[0])), ('argv', sys.argv[1:]),
+                           ('host', socket.gethostname()), ('start', time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.start))),
+                           ('wall', time.time() - self.start), ('cpu', cpu_time()), ('max_rss_mb', max_rss_mb()),
+                           ('spans', self.spans), ('hot', self.hot), ('cprofile', self.profile_stats())])
+        with open(self.filename, 'w') as ostream:
+            json.dump(out, ostream, indent=2)
+
+
+# the profiler of the running script, disabled until start_profiler is called
+_profiler = Profiler()
+
+
+def get_profiler():
+    ''' The profiler of the running script '''
+
+    return _profiler
+
+
+def span(name, merge=False, **attrs):
+    ''' A span of the profiler of the running script, see Profiler.span '''
+
+    return _profiler.span(name, merge, **attrs)
+
+
+def start_profiler(filename, hot=None):
+    ''' Enable recording of the spans of the running script, to be written to a JSON file at exit
+    input:
+    filename: the output JSON file, nothing is recorded if empty
+    hot: the name of a span to profile with cProfile
+    '''
+
+    global _profiler
+    _profiler = Profiler(filename or None, hot or None)
+    if filename:
+        import atexit
+        atexit.register(_profiler.save)
+    return _profiler
+
+
+def add_profile_arguments(parser):
+    ''' Add the --profile and --profile-hot options to an argparse parser '''
+
+    parser.add_argument('--profile', dest='profile', default='', help='a JSON file for the wall time, CPU time, rows, bytes and peak memory of each stage')
+    parser.add_argument('--profile-hot', dest='profile_hot', default='', help='the name of a stage to profile with cProfile, whose top functions go to the --profile file')
@@ -9,18 +9,24 @@ Description: Add records from conference counts to dataset access records.
 import os
 import re
 import csv
-import gzip
 import argparse
-import glob
+from week_calendar import get_calendar
+from instrument import span, start_profiler, add_profile_arguments
+from fileio import open_read, open_write, with_codec_extension, data_files, add_codec_arguments
+from colstore import ColumnStore, is_store, write_csv, to_text
+from conf_features import ConfFeatures, parse_features, read_conf_series, read_category_series, read_best_lags
 
-def write_dct_lst(dct_lst, attrs, filename ):
+def write_dct_lst(dct_lst, attrs, filename, codec=None, level=None, threads=0):
     ''' write a list of dictionaries with common attributes to a file, according to specified order of attributes 
     dct_lst: a list of dictionaries
     attrs: a list of attributes' names, in a specified order
     filename: output file
+    codec: the compression codec of the output file, None for that of its extension
+    level: the compression level, None for the default level of the codec
+    threads: the number of threads compressing a block gzip output, 0 for plain gzip
     '''
 
-    csvfile = gzip.open(filename, 'w')
+    csvfile = open_write(filename, codec, level, threads)
     # write header
     csvfile.write(','.join(attrs) + '\n')    
     # write data
@@ -32,57 +38,139 @@ def write_dct_lst(dct_lst, attrs, filename ):
     csvfile.close()
 
 
+def make_features(args):
+    ''' The generator of the conference count features requested by --features, from the weekly series of the first count column of the conference count file
+    input:
+    args: the parsed command line arguments
+    output:
+    a ConfFeatures, or None if no feature is requested
+    '''
+
+    features = parse_features(args.features)
+    if not features:
+        return None
+    first, counts = read_conf_series(args.inconf)
+    categories = None
+    if args.inparsed:
+        categories = read_category_series(args.inparsed, first, len(counts))
+    lags = {}
+    for attr in set(arg for name, kind, arg, category in features if kind == 'bestlag'):
+        if not args.lags:
+            raise ValueError('--lags is needed by the bestlag features')
+        lags[attr] = read_best_lags(args.lags, attr)
+    return ConfFeatures(first, counts, features, categories, lags)
+
+
+def merge_store(args, attrs_inconf, inconf_dct, features=None):
+    ''' Add the conference counts of each week to the records of a columnar store of dataset access files, and write them to one file per week like the text input
+    input:
+    args: the parsed command line arguments
+    attrs_inconf: the names of the conference count attributes
+    inconf_dct: a dict of week ordinal to a dict of the conference count attributes of the week
+    features: the generator of the extra conference count features, or None
+    '''
+
+    store = ColumnStore(args.indir)
+    calendar = get_calendar()
+    for part in store.catalog['partitions']:
+        with span('read', file=part['source'], rows=part['rows']):
+            data = store.read_partition(part, part['columns'])
+        with span('merge', file=part['source'], rows=part['rows']):
+            conf = inconf_dct[calendar.ordinal(part['window'])]
+            for attr in attrs_inconf:
+                data[attr] = [conf[attr]] * part['rows']
+            if features:
+                attrs = dict((attr, to_text(data[attr])) for attr in features.attributes())
+                data.update(features.for_week(calendar.ordinal(part['window']), part['rows'], attrs))
+        with span('write', file=part['source'], rows=part['rows']):
+            write_csv(data, with_codec_extension(args.outdir + '/' + part['source'], args.codec), args.codec, args.level, args.threads)
+
+
 def main():
 
     parser = argparse.ArgumentParser(description='''Add records from conference counts to dataset access records.
 
 Example:
-merge_access_conf.py --indir original    --inconf cms_conf_ct_future.csv.gz --outdir merged''', formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument('--indir', dest='indir', help='a dir containing the csv.gz files for the input dataset access data, assuming the data filenames start with "dataframe" ')
+merge_access_conf.py --indir original    --inconf cms_conf_ct_future.csv.gz --outdir merged
+merge_access_conf.py --indir original    --inconf cms_conf_ct_perweek.csv.gz --outdir merged --features past:4,future:10,decay:2,lag:-3
+merge_access_conf.py --indir original    --inconf cms_conf_ct_perweek.csv.gz --outdir merged --features future:4:CONF,bestlag:tier --inparsed cms_conf_parsed.csv.gz --lags max_crosscorr_lags_per_group.csv.gz''', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--indir', dest='indir', help='a dir containing the csv.gz files for the input dataset access data, assuming the data filenames start with "dataframe", or a columnar store of them made by colstore.py')
     parser.add_argument('--inconf', dest='inconf', help='a csv.gz file for the input conference count data')
     parser.add_argument('--outdir', dest='outdir', help='a dir containing csv.gz files for the output merged data')
+    parser.add_argument('--features', dest='features', default='', help='''a comma separated list of extra conference count features, computed from the weekly counts of the first count column of --inconf:
+past:N, the conferences in the N weeks before the week of a record;
+future:N, the conferences in the N weeks after it;
+decay:H, the conferences of the week and of all the weeks before, weighted by 0.5 ** (weeks before / H);
+lag:L, the conferences in the week L weeks after (L > 0) or -L weeks before (L < 0);
+bestlag:attr, the conferences at the lag of the best cross correlation of the attribute value of a record, read from --lags;
+each feature can be restricted to a conference category, such as future:4:CONF, counted from --inparsed.
+A feature is empty for the records whose window is not inside the conference count series.''')
+    parser.add_argument('--inparsed', dest='inparsed', default='', help='the parsed conference records cms_conf_parsed.csv.gz of cms_conf_parser.py, for the features of a conference category')
+    parser.add_argument('--lags', dest='lags', default='', help='the best cross correlation lags max_crosscorr_lags_per_group.csv.gz of time_series.py --group-by, for the bestlag features')
+    add_profile_arguments(parser)
+    add_codec_arguments(parser)
     args = parser.parse_args()
+    start_profiler(args.profile, args.profile_hot)
 
     # read in the header of conference count data file
-    csvfile = gzip.open(args.inconf)
+    csvfile = open_read(args.inconf)
     attrs_inconf = csvfile.readline().rstrip('\n').split(',')[1:] # a list of attribute names, ignore the first attr "tstamp"
     csvfile.close()
 
     # read in the conference count data
-    csvfile = gzip.open(args.inconf)
+    csvfile = open_read(args.inconf)
     reader = csv.DictReader(csvfile)
     inconf_lst= list(reader) # [ordereddict.OrderedDict(zip(keys,row)) for row in reader ] # # a list of dicts, each for a row in the csv file
     ## inconf_dct = ordereddict.OrderedDict({indic['tstamp']:{k:indic[k] for k in indic if k != 'tstamp'} for indic in inconf_lst}) # convert the list of dicts to a dict with tstamp being the key
     # inconf_dct = ordereddict.OrderedDict((indic['tstamp'],ordereddict.OrderedDict((k,indic[k]) for k in indic if k != 'tstamp')) for indic in inconf_lst) # convert the list of dicts to a dict with tstamp being the key
-    inconf_dct = dict((indic['tstamp'],dict((k,indic[k]) for k in indic if k != 'tstamp')) for indic in inconf_lst) # convert the list of dicts to a dict with tstamp being the key
+    calendar = get_calendar()
+    inconf_dct = dict((calendar.ordinal(indic['tstamp']),dict((k,indic[k]) for k in indic if k != 'tstamp')) for indic in inconf_lst) # convert the list of dicts to a dict with the week ordinal of tstamp being the key
     csvfile.close()
+
+    with span('features'):
+        features = make_features(args)
+    attrs_features = features.columns() if features else []
+
+    if is_store(args.indir):
+        merge_store(args, attrs_inconf, inconf_dct, features)
+        return
     
 
-    dsfilenames = glob.glob(args.indir + '/dataframe*')
+    dsfilenames = data_files(args.indir + '/dataframe*')
     for filename in  dsfilenames:
 
         print filename
 
         # read in the header of dataset access file
-        csvfile = gzip.open(filename)
+        csvfile = open_read(filename)
         attrs_indir = csvfile.readline().rstrip('\n').split(',') # a list of attribute names
         csvfile.close()
         
         # read the dataset access file:
-        csvfile = gzip.open(filename)
-        reader = csv.DictReader(csvfile)
-        indir_lst= list(reader) # a list of dicts, each for a row in the csv file
+        with span('read', file=filename) as rec:
+            csvfile = open_read(filename, args.threads)
+            reader = csv.DictReader(csvfile)
+            indir_lst= list(reader) # a list of dicts, each for a row in the csv file
+            rec['rows'] = len(indir_lst)
         # indir_lst = [ordereddict.OrderedDict(indic) for indic in indir_lst]
         csvfile.close()
 
         # locate the row in conf ct file for the timestamp of the dataset access file, and merge them
-        tstamp = re.search('\d{8}-\d{8}', filename).group()
-        for dct in indir_lst:
-            dct.update(inconf_dct[tstamp])
+        week = calendar.filename_ordinal(filename)
+        with span('merge', file=filename, rows=len(indir_lst)):
+            for dct in indir_lst:
+                dct.update(inconf_dct[week])
+            # the extra features are computed for all the records at once, and formatted like the input values
+            if features:
+                attrs = dict((attr, [dct[attr] for dct in indir_lst]) for attr in features.attributes())
+                for attr, values in features.for_week(week, len(indir_lst), attrs).items():
+                    for dct, value in zip(indir_lst, to_text(values)):
+                        dct[attr] = value
             
         # write merged data to a file
-        attrs = attrs_indir + attrs_inconf
-        write_dct_lst(indir_lst, attrs, args.outdir + '/' +  os.path.basename(filename))
+        attrs = attrs_indir + attrs_inconf + attrs_features
+        with span('write', file=filename, rows=len(indir_lst)):
+            write_dct_lst(indir_lst, attrs, with_codec_extension(args.outdir + '/' +  os.path.basename(filename), args.codec), args.codec, args.level, args.threads)
             
         # # write merged to a file
         # csvfile = gzip.open(args.outdir + '/' +  os.path.basename(filename), 'w')
@@ -12,6 +12,15 @@ import os
 import sys
 import time
 import random
+import threading
+import Queue
+import hashlib
+import shutil
+import itertools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import json as stdjson
+from collections import OrderedDict
 #import pprint
 #try:
 #    import cPickle as pickle
@@ -23,15 +32,25 @@ import numpy as np
 import pandas as pd
 
 # sklearn modules
-from sklearn.cross_validation import train_test_split
+from sklearn.cross_validation import train_test_split, StratifiedKFold, KFold
+from sklearn.base import clone, is_classifier
+from sklearn.ensemble.forest import BaseForest
+from sklearn.grid_search import ParameterGrid
 from sklearn import preprocessing
 from sklearn.metrics.scorer import SCORERS
 from sklearn.pipeline import make_pipeline
 from sklearn import metrics
+from sklearn.utils.validation import has_fit_parameter
 
 # local modules
+from vocabulary import CategoricalEncoder, Vocabulary
+from feature_hashing import FeatureHasher, hashed_matrix
+from instrument import span, start_profiler
+from fileio import open_write, read_csv
+from colstore import ColumnStore, is_store, parse_where, filter_frame
+from sampler import Sampler, parse_ratios, WEIGHT
 from DCAF.ml.utils import OptionParser, normalize, logloss, GLF
-from DCAF.ml.clf import learners, param_search, crossvalidation, print_clf_report
+from DCAF.ml.clf import learners, print_clf_report
 import DCAF.utils.jsonwrapper as json
 
 def files(idir, ext=".csv.gz"):
@@ -45,51 +64,810 @@ def get_auc(labels, predictions):
     auc = metrics.auc(fpr,tpr)
     return auc
 
-def read_data(fname, drops=[], idx=0, limit=-1, scaler=None):
-    "Read and return processed data frame"
-    comp = None
-    if  fname.endswith('.gz'):
-        comp = 'gzip'
-    elif  fname.endswith('.bz2'):
-        comp = 'bz2'
-    if  scaler:
-        print fname, comp, np.float32
-        xdf = pd.read_csv(fname, compression=comp, dtype=np.float32)
+def drop_columns(drops, idcol):
+    """
+    Return list of columns to drop from given comma separated string or
+    list of columns, with idcol which is never a feature
+    """
+    if  isinstance(drops, basestring):
+        drops = drops.split(',')
+    drops = [col for col in drops or [] if col]
+    if  idcol not in drops:
+        drops.append(idcol)
+    return drops
+
+def learner_file(pattern, learner):
+    """
+    Return output file of given learner from given pattern, %s in pattern
+    is replaced by learner, otherwise learner is inserted before the
+    extension, e.g. preds.csv.gz gives preds.<learner>.csv.gz
+    """
+    if  '%s' in pattern:
+        return pattern % learner
+    dirname, fname = os.path.split(pattern)
+    parts = fname.split('.', 1)
+    parts.insert(1, learner)
+    return os.path.join(dirname, '.'.join(parts))
+
+def read_columns(fname, drops=[], scaler=None, dtypes=None):
+    """
+    Return columns to parse from given file, i.e. all but drops, and
+    dtype argument of pd.read_csv: float32 for all columns if scaler
+    is set, otherwise given dtypes map (None lets pandas infer them).
+    The file can also be a columnar store made by colstore.py
+    """
+    if  is_store(fname):
+        header = ColumnStore(fname).columns()
     else:
-        xdf = pd.read_csv(fname, compression=comp)
-    # fill NAs
+        header = read_csv(fname, nrows=0).columns
+    usecols = [col for col in header if col not in drops]
+    if  scaler:
+        return usecols, np.float32
+    if  dtypes:
+        return usecols, dict((k, v) for k, v in dtypes.items() if k in usecols)
+    return usecols, None
+
+# largest integer which float32 holds exactly
+FLOAT32_EXACT = 2**24
+
+def downcast(xdf):
+    """
+    Convert columns of given data frame to int32, float32 or category dtypes.
+    Float columns of integers beyond float32 precision, e.g. ids parsed as
+    floats because of missing values, stay float64.
+    """
+    for col in xdf.columns:
+        kind = xdf[col].dtype.kind
+        if  kind in 'iu':
+            info = np.iinfo(np.int32)
+            if  len(xdf) == 0 or \
+                (xdf[col].min() >= info.min and xdf[col].max() <= info.max):
+                xdf[col] = xdf[col].astype(np.int32)
+        elif kind == 'f':
+            vals = xdf[col].values
+            if  len(vals) and np.nanmax(np.abs(vals)) > FLOAT32_EXACT \
+                and np.array_equal(vals[~np.isnan(vals)], np.floor(vals[~np.isnan(vals)])):
+                continue
+            xdf[col] = xdf[col].astype(np.float32)
+        elif kind == 'O':
+            xdf[col] = xdf[col].astype('category')
+    return xdf
+
+def cache_key(fname, usecols, dtype, where=None):
+    """
+    Return cache key of given file and columns, built from file size,
+    mtime, hash of its first megabyte, column set, dtypes and where
+    predicates if any
+    """
+    stat = os.stat(fname)
+    with open(fname, 'rb') as istream:
+        head = hashlib.md5(istream.read(1024*1024)).hexdigest()
+    if  isinstance(dtype, dict):
+        dtype = sorted((k, str(v)) for k, v in dtype.items())
+    spec = [os.path.abspath(fname), stat.st_size, stat.st_mtime, head,
+            sorted(usecols), str(dtype)]
+    if  where:
+        spec.append(sorted(where))
+    return hashlib.md5(repr(spec)).hexdigest()
+
+def write_cache(xdf, cdir):
+    """
+    Write given data frame into cache directory as one .npy file per
+    column, categorical columns as codes, plus a meta.json description
+    """
+    tmp = '%s.tmp%s' % (cdir, os.getpid())
+    os.makedirs(tmp)
+    meta = {'columns': [], 'nrows': len(xdf)}
+    for idx, col in enumerate(xdf.columns):
+        vals = xdf[col]
+        desc = {'name': col, 'file': '%s.npy' % idx}
+        if  str(vals.dtype) == 'category':
+            desc['categories'] = [str(c) for c in vals.cat.categories]
+            vals = vals.cat.codes
+        np.save(os.path.join(tmp, desc['file']), np.asarray(vals))
+        meta['columns'].append(desc)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as ostream:
+        stdjson.dump(meta, ostream)
+    # rename is atomic, concurrent runs never see a partial cache
+    try:
+        os.rename(tmp, cdir)
+    except OSError:
+        # another run wrote the same cache first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+def load_cache(cdir):
+    """
+    Load data frame from cache directory. Column arrays are read through
+    memory maps, but the data frame holds them in memory since pandas
+    copies columns of the same dtype into one block: the cache saves
+    parsing of the file, not memory
+    """
+    with open(os.path.join(cdir, 'meta.json')) as istream:
+        meta = stdjson.load(istream)
+    data = OrderedDict()
+    for desc in meta['columns']:
+        vals = np.load(os.path.join(cdir, desc['file']), mmap_mode='r')
+        if  'categories' in desc:
+            vals = pd.Categorical.from_codes(vals, desc['categories'])
+        data[str(desc['name'])] = vals
+    return pd.DataFrame(data, columns=[str(d['name']) for d in meta['columns']])
+
+def where_columns(fname, usecols, where):
+    """
+    Return columns of where predicates which given text file has to be
+    read with besides usecols, e.g. dropped ones. The week of a row is
+    only known to a columnar store, so tstamp predicates need one unless
+    the file has a tstamp column
+    """
+    if  not where:
+        return []
+    header = read_csv(fname, nrows=0).columns
+    extra = []
+    for col, _, _ in where:
+        if  col not in header:
+            if  col == 'tstamp':
+                raise Exception("Predicates on tstamp need a columnar store input, %s has no tstamp column" % fname)
+            raise Exception("Unknown column %s of predicates on %s" % (col, fname))
+        if  col not in usecols and col not in extra:
+            extra.append(col)
+    return extra
+
+def process_frame(xdf, usecols, dtype):
+    "Keep file column order, fill NAs and downcast columns of given data frame"
+    xdf = xdf[usecols]
+    if  dtype is not None:
+        xdf = xdf.astype(dtype)
     xdf = xdf.fillna(0)
-    # drop fields
-    if  drops:
-        xdf = xdf.drop(drops, axis=1)
+    return downcast(xdf)
+
+def pop_weights(xdf, clfs):
+    """
+    Remove sample_weight column, of a sampler or written by select.py, from
+    given data frame and return its values, None if there is none. Fails
+    if a learner of given dict of learner names and classifiers cannot be
+    fitted with sample weights
+    """
+    if  WEIGHT not in xdf.columns:
+        return None
+    for name, clf in clfs.items():
+        if  not has_fit_parameter(clf, 'sample_weight'):
+            raise Exception("Learner %s cannot be fitted with sample weights, " \
+                    "sample train data without weights or drop the %s column with --drops" \
+                    % (name, WEIGHT))
+    return xdf.pop(WEIGHT).values
+
+def read_data(fname, drops=[], idx=0, limit=-1, scaler=None, dtypes=None, cache=None, where=None, sampler=None):
+    """
+    Read and return processed data frame. Only columns not in drops are
+    parsed, with float32 dtype if scaler is set, given dtypes map otherwise,
+    and compact int32/float32/category dtypes for the rest. If cache
+    directory is given, the processed data frame is stored there as
+    binary arrays on first read and loaded from them on later reads.
+    Only rows satisfying where predicates (see colstore.parse_where) are
+    kept, tested on parsed values before NAs are filled, even on dropped
+    columns. A columnar store is read column by column, and its partitions
+    and rows are skipped by the predicates before any value is decoded.
+    If sampler is given, the file is read in chunks offered to it, and
+    only its sample is kept, with sample weights in the sample_weight
+    column multiplied into any sample_weight column of the file.
+    """
+    with span('read_data', file=os.path.basename(fname.rstrip('/'))) as rec:
+        if  sampler:
+            # the columns used by the sampler are read even if dropped,
+            # and the sample gets the dtypes of the scaler afterwards
+            keep = [col for col in drops if col not in sampler.columns()]
+            for xdf in read_data_chunks(fname, keep, dtypes=dtypes, where=where):
+                sampler.add(xdf)
+            xdf, weights = sampler.sample()
+            if  not len(weights):
+                raise Exception('No rows sampled from %s' % fname)
+            if  WEIGHT in xdf.columns:
+                weights = weights * xdf[WEIGHT].values
+            xdf = xdf.drop([col for col in xdf.columns if col in drops], axis=1)
+            if  scaler:
+                xdf = xdf.astype(np.float32)
+            xdf[WEIGHT] = weights
+            rec['cached'] = False
+            rec['rows'] = len(xdf)
+            return xdf
+        usecols, dtype = read_columns(fname, drops, scaler, dtypes)
+        if  is_store(fname):
+            xdf = process_frame(ColumnStore(fname).read_frame(usecols, where or []), usecols, dtype)
+            rec['cached'] = False
+            rec['rows'] = len(xdf)
+            if  limit > -1:
+                xdf = xdf[idx:limit]
+            return xdf
+        cdir = None
+        if  cache:
+            cdir = os.path.join(cache, '%s.%s' % (os.path.basename(fname), cache_key(fname, usecols, dtype, where)))
+        rec['cached'] = bool(cdir and os.path.isdir(cdir))
+        if  rec['cached']:
+            xdf = load_cache(cdir)
+        else:
+            xdf = read_csv(fname, usecols=usecols + where_columns(fname, usecols, where), dtype=dtype)
+            if  where:
+                xdf = filter_frame(xdf, where)
+            # keep file column order
+            xdf = xdf[usecols]
+            # fill NAs
+            xdf = xdf.fillna(0)
+            xdf = downcast(xdf)
+            if  cdir:
+                if  not os.path.isdir(cache):
+                    os.makedirs(cache)
+                write_cache(xdf, cdir)
+        rec['rows'] = len(xdf)
     # drop duplicates
 #    xdf = xdf.drop_duplicates(take_last=True, inplace=False)
     if  limit > -1:
         xdf = xdf[idx:limit]
     return xdf
 
-def factorize(col, xdf, sdf=None):
-    "Factorize given column in dataframe"
-    if  sdf:
-        vals = set(xdf[col] + sdf[col])
+def read_data_chunks(fname, drops=[], chunksize=100000, scaler=None, dtypes=None, where=None):
+    """
+    Read given file in chunks of at most chunksize rows and yield
+    processed data frames, so that memory does not depend on file size.
+    Chunks of a columnar store never span two of its week partitions.
+    """
+    usecols, dtype = read_columns(fname, drops, scaler, dtypes)
+    if  is_store(fname):
+        store = ColumnStore(fname)
+        for part in store.partitions(where or []):
+            data = store.read_partition(part, usecols, where or [])
+            for start in range(0, len(data.values()[0]) if data else 0, chunksize):
+                xdf = pd.DataFrame(OrderedDict((col, vals[start:start+chunksize]) for col, vals in data.items()), columns=usecols)
+                yield process_frame(xdf, usecols, dtype)
+        return
+    reader = read_csv(fname, usecols=usecols + where_columns(fname, usecols, where),
+            dtype=dtype, chunksize=chunksize)
+    for xdf in reader:
+        if  where:
+            xdf = filter_frame(xdf, where)
+        yield downcast(xdf[usecols].fillna(0))
+
+def target_classes(train_file_list, tcol, chunksize=100000, where=None):
+    """
+    Return sorted values of target column over all train files, read in
+    chunks of target column only, i.e. all classes which partial_fit has
+    to know on its first call
+    """
+    classes = set()
+    for train_file in train_file_list:
+        usecols, _ = read_columns(train_file)
+        drops = [col for col in usecols if col != tcol]
+        for xdf in read_data_chunks(train_file, drops, chunksize, where=where):
+            classes.update(np.unique(xdf[tcol]).tolist())
+    return np.array(sorted(classes))
+
+def prefetch(iterable, size=2):
+    """
+    Iterate over given iterable in a background thread which stays at most
+    size items ahead, e.g. to decompress and parse the next chunk of data
+    while the current one is used for training
+    """
+    queue = Queue.Queue(maxsize=size)
+    done = object()
+    def worker():
+        try:
+            for item in iterable:
+                queue.put((item, None))
+        except Exception as exc:
+            queue.put((None, exc))
+        queue.put((done, None))
+    thr = threading.Thread(target=worker)
+    thr.daemon = True
+    thr.start()
+    while True:
+        item, exc = queue.get()
+        if  exc is not None:
+            raise exc
+        if  item is done:
+            break
+        yield item
+    thr.join()
+
+def factorize(col, xdf, sdf=None, vdir=None):
+    """
+    Factorize given column in dataframe. Codes come from the vocabulary
+    of the column stored in vdir, which is extended with the values of
+    both data frames, so codes are the same across files and runs.
+    """
+    vocab = Vocabulary(os.path.join(vdir, '%s.json' % col) if vdir else None)
+    if  sdf is not None:
+        vocab.encode(pd.concat([xdf[col], sdf[col]]).values)
+    out = vocab.encode(xdf[col].values)
+    if  vdir:
+        if  not os.path.isdir(vdir):
+            os.makedirs(vdir)
+        vocab.save()
+    return out
+
+def array_key(*arrays):
+    "Return hash of content, shape and dtype of given arrays"
+    md5 = hashlib.md5()
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        md5.update(str((arr.shape, arr.dtype.str)))
+        md5.update(arr.data)
+    return md5.hexdigest()
+
+def parse_grid(grid):
+    """
+    Return parameter grid given as JSON string or JSON file name, a dict
+    of parameter lists or a list of such dicts
+    """
+    if  isinstance(grid, basestring):
+        if  os.path.isfile(grid):
+            with open(grid) as istream:
+                grid = stdjson.load(istream)
+        else:
+            grid = stdjson.loads(grid)
+    return grid
+
+# arrays shared by worker processes, memory-mapped once per process
+_SHARED_DATA = {}
+
+def share_arrays(sdir, **arrays):
+    """
+    Write given arrays once to .npy files in a sub-directory of sdir named
+    by hash of their content, and return this sub-directory. Workers load
+    them with shared_array, memory-mapped, so they share them without copies.
+    """
+    names = sorted(arrays)
+    ddir = os.path.join(sdir, array_key(*[arrays[name] for name in names]))
+    if  not os.path.isdir(ddir):
+        tmp = '%s.tmp%s' % (ddir, os.getpid())
+        os.makedirs(tmp)
+        for name in names:
+            np.save(os.path.join(tmp, '%s.npy' % name), arrays[name])
+        os.rename(tmp, ddir)
+    return ddir
+
+def shared_array(ddir, name):
+    "Return memory-mapped array of given name written by share_arrays"
+    key = (ddir, name)
+    if  key not in _SHARED_DATA:
+        _SHARED_DATA[key] = np.load(os.path.join(ddir, '%s.npy' % name), mmap_mode='r')
+    return _SHARED_DATA[key]
+
+def search_task(args):
+    """
+    Fit clf with given params on train part of given fold of shared data
+    and return its score on test part. The score is written to given
+    cache file, so interrupted searches can resume.
+    """
+    clf, params, fold, train, test, ddir, scorer, cfile = args
+    x_all = shared_array(ddir, 'x')
+    y_all = shared_array(ddir, 'y')
+    est = clone(clf).set_params(**params)
+    time0 = time.time()
+    if  os.path.isfile(os.path.join(ddir, 'w.npy')):
+        # sample weights in fitting and scoring
+        w_all = shared_array(ddir, 'w')
+        est.fit(x_all[train], y_all[train], sample_weight=w_all[train])
+        score = SCORERS[scorer](est, x_all[test], y_all[test], sample_weight=w_all[test])
+    else:
+        est.fit(x_all[train], y_all[train])
+        score = SCORERS[scorer](est, x_all[test], y_all[test])
+    res = {'params': params, 'fold': fold, 'score': float(score),
+           'time': time.time()-time0}
+    tmp = '%s.tmp%s' % (cfile, os.getpid())
+    with open(tmp, 'w') as ostream:
+        stdjson.dump(res, ostream)
+    os.rename(tmp, cfile)
+    return res
+
+def grid_search(clf, x_train, y_train, grid=None, nfolds=3, scorer='accuracy',
+        njobs=-1, sdir='gsearch', ofile=None, weights=None, verbose=False):
+    """
+    Evaluate clf for every parameter set of given grid with nfolds-fold
+    cross-validation, stratified for classifiers, on a pool of njobs processes (all cores if -1).
+    Train data are written once to memory-mapped .npy files in sdir, which
+    all workers share without copies. Score of every (params, fold) pair
+    is cached in sdir, so repeated or interrupted searches over same data
+    only run missing pairs. Ranked results are written to ofile, by
+    default sdir/results.csv. Without grid the current clf parameters are
+    cross-validated. Given sample weights are used to fit and to score.
+    """
+    y_all = np.asarray(y_train)
+    arrays = {'x': np.asarray(x_train, dtype=np.float64), 'y': y_all}
+    if  weights is not None:
+        arrays['w'] = np.asarray(weights, dtype=np.float64)
+    ddir = share_arrays(sdir, **arrays)
+    cdir = os.path.join(ddir, 'scores')
+    if  not os.path.isdir(cdir):
+        os.makedirs(cdir)
+
+    grid = parse_grid(grid) if grid else {}
+    candidates = list(ParameterGrid(grid))
+    if  is_classifier(clf):
+        folds = list(StratifiedKFold(y_all, n_folds=nfolds, shuffle=True, random_state=1234))
     else:
-        vals = set(xdf[col])
-    ids = []
-    for uid, val in enumerate(vals):
-        ids.append(uid)
-    dval = dict(zip(vals, ids))
-    out = []
-    for val in xdf[col]:
-        out.append(dval[val])
+        folds = list(KFold(len(y_all), n_folds=nfolds, shuffle=True, random_state=1234))
+    results = []
+    tasks = []
+    for params, (fold, (train, test)) in itertools.product(candidates, enumerate(folds)):
+        spec = repr([clf.__class__.__name__, sorted(clf.get_params().items()),
+                     sorted(params.items()), fold, nfolds, scorer])
+        cfile = os.path.join(cdir, '%s.json' % hashlib.md5(spec).hexdigest())
+        if  os.path.isfile(cfile):
+            with open(cfile) as istream:
+                results.append(stdjson.load(istream))
+        else:
+            tasks.append((clf, params, fold, train, test, ddir, scorer, cfile))
+    print "Grid search: %s candidates, %s folds, %s cached, %s to run" \
+            % (len(candidates), nfolds, len(results), len(tasks))
+
+    if  njobs < 0:
+        njobs = multiprocessing.cpu_count()
+    if  tasks:
+        if  njobs > 1:
+            pool = multiprocessing.Pool(min(njobs, len(tasks)))
+            for res in pool.imap_unordered(search_task, tasks):
+                if  verbose:
+                    print "params %s fold %s score %s" % (res['params'], res['fold'], res['score'])
+                results.append(res)
+            pool.close()
+            pool.join()
+        else:
+            for task in tasks:
+                results.append(search_task(task))
+
+    # rank parameter sets by mean score over folds
+    table = {}
+    for res in results:
+        key = stdjson.dumps(res['params'], sort_keys=True)
+        table.setdefault(key, {})[res['fold']] = res['score']
+    rows = []
+    for key, scores in table.items():
+        vals = [scores[fold] for fold in sorted(scores)]
+        rows.append({'params': key, 'mean_score': np.mean(vals),
+                     'std_score': np.std(vals), 'nfolds': len(vals)})
+    out = pd.DataFrame(rows, columns=['params', 'mean_score', 'std_score', 'nfolds'])
+    out = out.sort_values('mean_score', ascending=False)
+    out.insert(0, 'rank', range(1, len(out)+1))
+    if  not ofile:
+        ofile = os.path.join(sdir, 'results.csv')
+    out.to_csv(ofile, header=True, index=False)
+    print "Grid search results (%s), written to %s:" % (scorer, ofile)
+    print out.head(10).to_string(index=False)
     return out
 
+def compare_task(args):
+    """
+    Fit given learner on shared train data and return its predictions,
+    and probabilities of positive class if it has them, on shared new data
+    """
+    name, clf, ddir = args
+    time0 = time.time()
+    if  os.path.isfile(os.path.join(ddir, 'w.npy')):
+        clf.fit(shared_array(ddir, 'x'), shared_array(ddir, 'y'),
+                sample_weight=shared_array(ddir, 'w'))
+    else:
+        clf.fit(shared_array(ddir, 'x'), shared_array(ddir, 'y'))
+    train_time = time.time()-time0
+    x_new = shared_array(ddir, 'xnew')
+    time0 = time.time()
+    predictions = clf.predict(x_new)
+    proba = None
+    try:
+        proba = clf.predict_proba(x_new)[:, -1]
+    except (AttributeError, NotImplementedError):
+        pass
+    return {'learner': name, 'predictions': predictions, 'proba': proba,
+            'train_time': train_time, 'predict_time': time.time()-time0}
+
+def model_compare(train_file, newdata_file, idcol, tcol, learner_list,
+        drops=None, scorer=None, scaler=None, cache=None, fcols=None,
+        vdir=None, njobs=-1, sdir='gsearch', ensemble=False,
+        ofile='learners.csv', pfile='%s.predictions', where=None, sampler=None,
+        verbose=False):
+    """
+    Fit every learner of given list on same train data and predict same
+    new data. Data are read and preprocessed once and shared by a pool of
+    njobs worker processes as memory-mapped arrays in sdir. Predictions of
+    each learner go to the file of pfile pattern for it, see learner_file,
+    and if ensemble is set the mean positive class probability of all
+    learners goes to the file for ensemble. A table comparing learners, with scores of
+    given scorers if new data has the target column, is written to ofile.
+    Learners are fitted with sample weights of train data, if it has any,
+    e.g. a sample of given sampler.
+    """
+    if  isinstance(learner_list, basestring):
+        learner_list = learner_list.split(',')
+    clfs = learners()
+    for name in learner_list:
+        if  name not in clfs:
+            raise Exception("Unknown learner %s" % name)
+        setattr(clfs[name], "random_state", 123)
+    drops = drop_columns(drops, idcol)
+    xdf = read_data(train_file, drops, scaler=scaler, cache=cache, where=where, sampler=sampler)
+    weights = pop_weights(xdf, dict((name, clfs[name]) for name in learner_list))
+    if  fcols:
+        if  isinstance(fcols, basestring):
+            fcols = fcols.split(',')
+        encoder = CategoricalEncoder(vdir)
+        xdf = encoder.encode(xdf, fcols)
+        encoder.save()
+    target = xdf[tcol]
+    xdf = xdf.drop(tcol, axis=1)
+    columns = list(xdf.columns)
+    tdf = read_data(newdata_file, drops, scaler=scaler, cache=cache)
+    y_new = tdf[tcol].values if tcol in tdf.columns else None
+    datasets = tdf['dataset'].values.astype(np.int64)
+    dbses = tdf['dbs'].values.astype(np.int64)
+    if  fcols:
+        tdf = encoder.encode(tdf, fcols, update=False)
+    tdf = tdf[columns]
+    x_train = np.asarray(xdf, dtype=np.float64)
+    x_new = np.asarray(tdf, dtype=np.float64)
+    if  scaler:
+        scl = getattr(preprocessing, scaler)()
+        x_train = scl.fit_transform(x_train)
+        x_new = scl.transform(x_new)
+    arrays = {'x': x_train, 'y': np.asarray(target), 'xnew': x_new}
+    if  weights is not None:
+        arrays['w'] = np.asarray(weights, dtype=np.float64)
+    ddir = share_arrays(sdir, **arrays)
+    del x_train, x_new, xdf, tdf
+    if  verbose:
+        print "Shared data", ddir
+
+    tasks = [(name, clfs[name], ddir) for name in learner_list]
+    if  njobs < 0:
+        njobs = multiprocessing.cpu_count()
+    results = []
+    if  njobs > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(njobs, len(tasks)))
+        for res in pool.imap_unordered(compare_task, tasks):
+            print "Learner %s trained in %s sec" % (res['learner'], res['train_time'])
+            results.append(res)
+        pool.close()
+        pool.join()
+    else:
+        for task in tasks:
+            results.append(compare_task(task))
+
+    rows = []
+    scorers = (scorer or 'accuracy').split(',')
+    for res in sorted(results, key=lambda r: learner_list.index(r['learner'])):
+        out = pd.DataFrame(OrderedDict([('dataset', datasets), ('dbs', dbses),
+            ('prediction', res['predictions'])]))
+        with open_write(learner_file(pfile, res['learner'])) as ostream:
+            out.to_csv(ostream, header=True, index=False)
+        row = OrderedDict([('learner', res['learner']),
+            ('train_time', res['train_time']), ('predict_time', res['predict_time'])])
+        if  y_new is not None:
+            for scr in scorers:
+                row[scr] = score_predictions(scr, y_new, res['predictions'], res['proba'])
+        rows.append(row)
+    if  ensemble:
+        probas = [res['proba'] for res in results if res['proba'] is not None]
+        if  probas:
+            proba = np.mean(probas, axis=0)
+            out = pd.DataFrame(OrderedDict([('dataset', datasets), ('dbs', dbses),
+                ('prediction', proba)]))
+            with open_write(learner_file(pfile, 'ensemble')) as ostream:
+                out.to_csv(ostream, header=True, index=False)
+            row = OrderedDict([('learner', 'ensemble'), ('train_time', np.nan),
+                ('predict_time', np.nan)])
+            if  y_new is not None:
+                for scr in scorers:
+                    row[scr] = score_predictions(scr, y_new, (proba >= 0.5).astype(y_new.dtype), proba)
+            rows.append(row)
+        else:
+            print "No learner with probabilities, no ensemble predictions"
+    table = pd.DataFrame(rows)
+    table.to_csv(ofile, header=True, index=False)
+    print "Learner comparison, written to %s:" % ofile
+    print table.to_string(index=False)
+    return table
+
+class Precomputed(object):
+    """
+    Stand-in estimator which returns given predictions and probabilities
+    of positive class, so that predictions made elsewhere, e.g. in worker
+    processes or by an ensemble, are scored by sklearn scorers
+    """
+    def __init__(self, predictions, proba=None):
+        self.predictions = predictions
+        self.proba = proba
+
+    def predict(self, x_data):
+        "Return given predictions"
+        return self.predictions
+
+    def predict_proba(self, x_data):
+        "Return given probabilities as two columns, of negative and positive class"
+        if  self.proba is None:
+            raise NotImplementedError("No probabilities")
+        return np.column_stack([1 - self.proba, self.proba])
+
+def score_predictions(scorer, y_true, predictions, proba=None):
+    """
+    Return value of given scorer for given labels and predictions, scorers
+    which need scores use probabilities, nan if there are none
+    """
+    try:
+        return metrics.get_scorer(scorer)(Precomputed(predictions, proba), None, y_true)
+    except NotImplementedError:
+        return np.nan
+
+# version of the layout of saved model artifacts
+ARTIFACT_VERSION = 1
+
+def make_artifact(clf, learner, columns, tcol, drops, scaler=None,
+        encoder=None, fcols=None, hasher=None, method='predict'):
+    """
+    Return artifact of fitted model: the estimator and everything needed
+    to turn a new data frame into its input, i.e. columns, fitted scaler,
+    categorical encoder and feature hasher, plus versions it was built with
+    """
+    import sklearn
+    return {'version': ARTIFACT_VERSION, 'sklearn': sklearn.__version__,
+            'learner': learner, 'model': clf, 'columns': list(columns),
+            'tcol': tcol, 'drops': list(drops), 'scaler': scaler,
+            'encoder': encoder if fcols else None, 'fcols': fcols or [],
+            'hasher': hasher, 'method': method}
+
+def save_artifact(fname, art):
+    "Write given artifact to file, uncompressed so that it can be memory-mapped"
+    from sklearn.externals import joblib
+    tmp = '%s.tmp%s' % (fname, os.getpid())
+    joblib.dump(art, tmp)
+    os.rename(tmp, fname)
+    print "Model saved to", fname
+
+def load_artifact(fname, mmap_mode='r'):
+    """
+    Load artifact from file, its large arrays are memory-mapped read-only
+    unless mmap_mode is None, e.g. for a model which is trained further
+    """
+    import sklearn
+    from sklearn.externals import joblib
+    art = joblib.load(fname, mmap_mode=mmap_mode)
+    if  not isinstance(art, dict) or art.get('version') != ARTIFACT_VERSION:
+        raise Exception('Unsupported model artifact %s, expected version %s' \
+                % (fname, ARTIFACT_VERSION))
+    if  art['sklearn'] != sklearn.__version__:
+        print "WARNING: model %s was built with sklearn %s, running %s" \
+                % (fname, art['sklearn'], sklearn.__version__)
+    return art
+
+def predict_frame(art, tdf):
+    """
+    Return data frame with dataset, dbs and prediction columns for given
+    new data frame, prepared exactly as train data of given artifact
+    """
+    datasets = tdf['dataset'].values.astype(np.int64)
+    dbses = tdf['dbs'].values.astype(np.int64)
+    if  art['fcols']:
+        # values unseen in train data get the UNSEEN code
+        tdf = art['encoder'].encode(tdf, art['fcols'], update=False)
+    tdf = tdf[art['columns']]
+    if  art['hasher'] is not None:
+        tdf = hashed_matrix(tdf, art['hasher'], art['scaler'])
+    elif art['scaler'] is not None:
+        tdf = art['scaler'].transform(tdf)
+    with span('predict', merge=True, rows=len(datasets)):
+        predictions = getattr(art['model'], art['method'])(tdf)
+    if  art['method'] == 'predict_proba':
+        # probability of positive class
+        predictions = predictions[:, -1]
+    return pd.DataFrame(OrderedDict([('dataset', datasets), ('dbs', dbses),
+        ('prediction', predictions)]))
+
+def score(newdata_file, art, ofile, chunksize=100000, verbose=False):
+    """
+    Predict new data file with given artifact, reading it in chunks of
+    chunksize rows and appending predictions of every chunk to ofile, so
+    that memory does not depend on file size
+    """
+    if  isinstance(art, basestring):
+        art = load_artifact(art)
+    nrows = 0
+    time0 = time.time()
+    with span('score', file=os.path.basename(newdata_file)) as rec, \
+            open_write(ofile) as ostream:
+        chunks = read_data_chunks(newdata_file, art['drops'], chunksize,
+                art['scaler'] is not None)
+        for tdf in prefetch(chunks):
+            out = predict_frame(art, tdf)
+            out.to_csv(ostream, header=(nrows == 0), index=False)
+            nrows += len(out)
+        rec['rows'] = nrows
+    if  verbose:
+        print "Score elapsed time", time.time()-time0, "rows", nrows
+    return nrows
+
+RANKINGS = ['anova', 'chi2', 'importance']
+
+def parse_rank(rank):
+    "Return list of rankings requested by --rank value"
+    if  not rank or rank == 'none':
+        return []
+    if  rank == 'all':
+        return list(RANKINGS)
+    ranks = rank.split(',')
+    for name in ranks:
+        if  name not in RANKINGS:
+            raise Exception('Invalid ranking "%s", choose from none,all,%s' \
+                    % (name, ','.join(RANKINGS)))
+    return ranks
+
+def feature_statistics(x_train, y_train):
+    """
+    Return ANOVA F statistics, chi2 statistics and their p-values of all
+    features, as f_classif and chi2 of sklearn would, but from a single
+    pass over the data: both tests only need per-class sums of features
+    and of their squares. Chi2 is undefined (NaN) for features with
+    negative values.
+    """
+    from scipy import stats
+    xarr = np.asarray(x_train, dtype=np.float64)
+    classes, yidx = np.unique(np.asarray(y_train), return_inverse=True)
+    nrows, nclasses = xarr.shape[0], len(classes)
+    counts = np.bincount(yidx, minlength=nclasses).astype(np.float64)
+    sums = np.zeros((nclasses, xarr.shape[1]))
+    sqsums = np.zeros((nclasses, xarr.shape[1]))
+    xmin = np.full(xarr.shape[1], np.inf)
+    for begin in range(0, nrows, 100000):
+        xblk = xarr[begin:begin+100000]
+        yblk = yidx[begin:begin+100000]
+        onehot = np.zeros((len(yblk), nclasses))
+        onehot[np.arange(len(yblk)), yblk] = 1
+        sums += np.dot(onehot.T, xblk)
+        sqsums += np.dot(onehot.T, xblk**2)
+        xmin = np.minimum(xmin, xblk.min(axis=0))
+    total = sums.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # ANOVA F from between and within class sums of squares
+        sst = sqsums.sum(axis=0) - total**2/nrows
+        ssb = (sums**2/counts[:, None]).sum(axis=0) - total**2/nrows
+        dfb, dfw = nclasses - 1, nrows - nclasses
+        fstat = (ssb/dfb)/((sst - ssb)/dfw)
+        fpval = stats.f.sf(fstat, dfb, dfw)
+        # chi2 of per-class feature sums against class frequencies
+        expected = counts[:, None]*total[None, :]/nrows
+        cstat = ((sums - expected)**2/expected).sum(axis=0)
+        cstat[xmin < 0] = np.nan
+        cpval = stats.chi2.sf(cstat, dfb)
+    return fstat, fpval, cstat, cpval
+
+def ranking_table(columns, stats=None, importances=None):
+    "Return data frame with one row of ranking statistics per feature"
+    nan = np.full(len(columns), np.nan)
+    fstat, fpval, cstat, cpval = stats if stats is not None else [nan]*4
+    if  importances is None:
+        importances = nan
+    return pd.DataFrame(OrderedDict([('feature', list(columns)),
+        ('anova_f', fstat), ('anova_pvalue', fpval),
+        ('chi2', cstat), ('chi2_pvalue', cpval),
+        ('importance', importances)]))
+
+def print_ranking(title, label, values, columns, reverse=False):
+    "Print features sorted by given values"
+    indices = np.argsort(values)
+    if  reverse:
+        indices = indices[::-1]
+    print("\n Feature ranking by %s:" % title)
+    for f in range(len(columns)):
+        print("%d. %s %f, feature %s" % (f + 1, label, values[indices[f]], columns[indices[f]]))
+
 def model(train_file, newdata_file, idcol, tcol, learner, lparams=None,
         drops=None, split=0.3, scorer=None,
-        scaler=None, ofile=None, idx=0, limit=-1, gsearch=None, crossval=None, verbose=False):
+        scaler=None, ofile=None, idx=0, limit=-1, gsearch=None, crossval=None,
+        cache=None, fcols=None, vdir=None, njobs=-1, sdir='gsearch',
+        rank='all', rfile=None, model_out=None, where=None, sampler=None, verbose=False):
     """
     Build and run ML algorihtm for given train/test dataframe
     and classifier name. The learners are defined externally
-    in DCAF.ml.clf module.
+    in DCAF.ml.clf module. Requested feature rankings are computed
+    while the classifier is trained and written to rfile. The fitted
+    model is saved as an artifact to model_out, see score. Only train
+    rows satisfying where predicates are used, and only a sample of them
+    if sampler is given, fitted with the weights of the sample.
     """
     split = 0 # change by Ting to use the whole training set for training, not for validation. 
 
@@ -118,14 +896,17 @@ def model(train_file, newdata_file, idcol, tcol, learner, lparams=None,
         print "idx/limit", idx, limit
 
     # read data and normalize it
-    if  drops:
-        if  isinstance(drops, basestring):
-            drops = drops.split(',')
-        if  idcol not in drops:
-            drops += [idcol]
-    else:
-        drops = [idcol]
-    xdf = read_data(train_file, drops, idx, limit, scaler)
+    drops = drop_columns(drops, idcol)
+    xdf = read_data(train_file, drops, idx, limit, scaler, cache=cache, where=where, sampler=sampler)
+    # sample weights, of a sampler or written by select.py, are not a feature
+    weights = pop_weights(xdf, {learner: clf})
+    # encode categorical columns with persistent vocabularies
+    if  fcols:
+        if  isinstance(fcols, basestring):
+            fcols = fcols.split(',')
+        encoder = CategoricalEncoder(vdir)
+        xdf = encoder.encode(xdf, fcols)
+        encoder.save()
 
     # get target variable and exclude choice from train data
     target = xdf[tcol]
@@ -148,55 +929,79 @@ def model(train_file, newdata_file, idcol, tcol, learner, lparams=None,
         y_train = target
         x_rest = None
         y_rest = None
-    if  gsearch:
-        param_search(clf, x_train, y_train, x_rest, y_rest, gsearch)
-        sys.exit(0)
-    if  crossval:
-        crossvalidation(clf, xdf, target)
-        sys.exit(0)
+    if  gsearch or crossval:
+        # built-in search over memory-mapped train data, crossval alone
+        # cross-validates the current clf parameters
+        if  scaler:
+            x_train = getattr(preprocessing, scaler)().fit_transform(x_train)
+        nfolds = 3
+        if  crossval and str(crossval).isdigit() and int(crossval) > 1:
+            nfolds = int(crossval)
+        grid_search(clf, x_train, y_train, gsearch, nfolds=nfolds,
+                scorer=(scorer or 'accuracy').split(',')[0], njobs=njobs,
+                sdir=sdir, weights=weights if not split else None, verbose=verbose)
+        return
 
     ###############################################################################
     # add by Ting to do feature selection and measuare feature importance
-    # Univariate feature selection with F-test for feature scoring
-    # We use the default selection function: the 10% most significant features
-    from sklearn.feature_selection import SelectKBest, chi2, SelectPercentile, f_classif
-
-    selector = SelectPercentile(f_classif, percentile=100) # by F test
-    selector.fit(x_train, y_train)
-    pvs = selector.pvalues_
-    # output scores of features
-    columns = xdf.columns
-    indices = np.argsort(pvs)
-    num = len(columns) 
-    print("\n Feature ranking by ANOVA F test:")
-    for f in range(num):
-        print("%d. feature selection test p-value %f, feature %s" % (f + 1, pvs[indices[f]], columns[indices[f]]))
-
-
-    selector = SelectPercentile(chi2, percentile=10) # by chi square test
-    selector.fit(x_train, y_train)
-    pvs = selector.pvalues_
-    # output scores of features
+    # Univariate feature tests (ANOVA F and chi2) run on a thread next to
+    # the training, their statistics are cached per train file and columns
+    ranks = parse_rank(rank)
     columns = xdf.columns
-    indices = np.argsort(pvs)
-    num = len(columns) 
-    print("\n Feature ranking by Chi Squared test:")
-    for f in range(num):
-        print("%d. feature selection test p-value %f, feature %s" % (f + 1, pvs[indices[f]], columns[indices[f]]))
+    stats = None
+    pool = None
+    rcache = None
+    if  'anova' in ranks or 'chi2' in ranks:
+        # rows of a sample differ by sampler settings, their statistics are not cached
+        if  cache and not sampler:
+            key = cache_key(train_file, list(columns), (idx, limit, split, scaler, fcols), where)
+            rcache = os.path.join(cache, '%s.%s.ranking.csv' % (os.path.basename(train_file), key))
+        if  rcache and os.path.isfile(rcache):
+            cdf = pd.read_csv(rcache)
+            stats = tuple(cdf[col].values for col in ['anova_f', 'anova_pvalue', 'chi2', 'chi2_pvalue'])
+        else:
+            pool = ThreadPool(1)
+            stats = pool.apply_async(feature_statistics, (x_train, y_train))
 
-    
     ###############################################################################
 
     # preprocessing of "scaler" type
     # scaler = None  # added by ting, to ignore the standardization, but fail to do that. todo
+    # the fitted scaler is kept to transform new data with train statistics
+    scl = None
     if  scaler:
-        x_train = getattr(preprocessing, scaler)().fit_transform(x_train)
+        scl = getattr(preprocessing, scaler)()
+        x_train = scl.fit_transform(x_train)
 
     time0 = time.time()
-    fit = clf.fit(x_train, y_train)
+    with span('fit', rows=len(y_train)):
+        if  weights is not None and not split:
+            fit = clf.fit(x_train, y_train, sample_weight=weights)
+        else:
+            fit = clf.fit(x_train, y_train)
+    art = make_artifact(clf, learner, columns, tcol, drops, scl,
+            encoder if fcols else None, fcols)
+    if  model_out:
+        save_artifact(model_out, art)
     if  verbose:
         print "Train elapsed time", time.time()-time0
-        
+
+    if  pool:
+        # the time spent waiting for the feature tests after the training
+        with span('rank', rows=len(y_train)):
+            stats = stats.get()
+        pool.close()
+        if  rcache:
+            if  not os.path.isdir(cache):
+                os.makedirs(cache)
+            tmp = '%s.tmp%s' % (rcache, os.getpid())
+            ranking_table(columns, stats).to_csv(tmp, index=False)
+            os.rename(tmp, rcache)
+    if  'anova' in ranks:
+        print_ranking('ANOVA F test', 'feature selection test p-value', stats[1], columns)
+    if  'chi2' in ranks:
+        print_ranking('Chi Squared test', 'feature selection test p-value', stats[3], columns)
+
     # comment out by Ting, move it to the new test dataset
     # # for validation
     # if  split:
@@ -233,42 +1038,43 @@ def model(train_file, newdata_file, idcol, tcol, learner, lparams=None,
 
     # predict on new data set, by the learned classifier
     if  newdata_file:
-        tdf = read_data(newdata_file, drops, scaler=scaler)
+        tdf = read_data(newdata_file, drops, scaler=scaler, cache=cache)
         if  tcol in tdf.columns:
             tdf = tdf.drop(tcol, axis=1)
         if  verbose:
             print "New data file", newdata_file
             print "Columns:", ','.join(tdf.columns)
             print "test shapes:", tdf.shape
-        datasets = [int(i) for i in list(tdf['dataset'])]
-        dbses = [int(i) for i in list(tdf['dbs'])]
-        if  scaler:
-            tdf = getattr(preprocessing, scaler)().fit_transform(tdf)
-        predictions = fit.predict(tdf)
-        data = {'dataset':datasets, 'dbs': dbses, 'prediction':predictions}
-        out = pd.DataFrame(data=data)
+        out = predict_frame(art, tdf)
         if  ofile:
-            out.to_csv(ofile, header=True, index=False)
+            with open_write(ofile) as ostream:
+                out.to_csv(ostream, header=True, index=False)
 
-        try:
-            importances = clf.feature_importances_
-            if  importances.any():
-                print "\n Feature ranking by random forest classifier:"
-                columns = xdf.columns
-                indices = np.argsort(importances)[::-1]
-                # num = 9 if len(columns)>9 else len(columns)  
-                num = len(columns) # change by Ting, to output all features' importances
-                for f in range(num):
-                    print("%d. importance %f, feature %s" % (f + 1, importances[indices[f]], columns[indices[f]]))
-        except:
-            pass
+    importances = None
+    if  'importance' in ranks:
+        importances = getattr(clf, 'feature_importances_', None)
+        if  importances is not None and importances.any():
+            # num = 9 if len(columns)>9 else len(columns)
+            print_ranking('random forest classifier', 'importance', importances, columns, reverse=True)
+    if  ranks and rfile:
+        ranking_table(columns, stats, importances).to_csv(rfile, header=True, index=False)
 
 def model_iter(train_file_list, newdata_file, idcol, tcol,
-    learner, lparams=None, drops=None, split=0.1, scaler=None, ofile=None, verbose=False):
+    learner, lparams=None, drops=None, split=0.1, scaler=None, ofile=None,
+    chunksize=100000, fcols=None, vdir=None,
+    hash_cols=None, hash_cross=None, hash_bits=20, model_out=None, where=None,
+    classes=None, verbose=False):
     """
     Build and run ML algorihtm for given train/test dataframe
     and classifier name. The learners are defined externally
-    in DCAF.ml.clf module.
+    in DCAF.ml.clf module. Train files are streamed in chunks of
+    chunksize rows, each fed to partial_fit, while the next chunk
+    is read in a background thread. Columns in hash_cols and crosses
+    in hash_cross, e.g. "dataset:era;dbs:era", are hashed into a sparse
+    matrix of 2**hash_bits columns next to the other numeric columns.
+    The fitted model is saved as an artifact to model_out, see score.
+    The classes of SGDClassifier are given classes, or all values of the
+    target column found by a first pass over the train files.
     """
     if  learner not in ['SGDClassifier', 'SGDRegressor']:
         raise Exception("Unsupported learner %s" % learner)
@@ -284,68 +1090,410 @@ def model_iter(train_file_list, newdata_file, idcol, tcol,
             setattr(clf, key, val)
     print "clf:", clf
 
-    if  drops:
-        if  isinstance(drops, basestring):
-            drops = drops.split(',')
-        if  idcol not in drops:
-            drops += [idcol]
-    else:
-        drops = [idcol]
+    drops = drop_columns(drops, idcol)
+    # scaler statistics are accumulated over the chunks when the scaler supports it
+    scl = getattr(preprocessing, scaler)() if scaler else None
+    if  fcols and isinstance(fcols, basestring):
+        fcols = fcols.split(',')
+    encoder = CategoricalEncoder(vdir)
+    hasher = None
+    if  hash_cols or hash_cross:
+        if  isinstance(hash_cols, basestring):
+            hash_cols = [col for col in hash_cols.split(',') if col]
+        if  isinstance(hash_cross, basestring):
+            hash_cross = [cross.split(':') for cross in hash_cross.split(';') if cross]
+        hasher = FeatureHasher(hash_cols or [], hash_cross, hash_bits)
     fit = None
+    if  learner == 'SGDClassifier':
+        # partial_fit needs all classes on the first call, a chunk may lack some of them
+        if  isinstance(classes, basestring):
+            classes = [float(c) if '.' in c else int(c) for c in classes.split(',') if c]
+        if  classes is None or not len(classes):
+            with span('classes'):
+                classes = target_classes(train_file_list, tcol, chunksize, where)
+        classes = np.asarray(classes)
+        print "classes:", classes
+    columns = []
+    ntotal = 0
     for train_file in train_file_list:
         print "Train file", train_file
-        # read data and normalize it
-        xdf = read_data(train_file, drops, scaler=scaler)
+        scores = []
+        nrows = 0
+        time0 = time.time()
+        for xdf in prefetch(read_data_chunks(train_file, drops, chunksize, scaler, where=where)):
+            # an empty file or a chunk without rows satisfying where predicates
+            if  not len(xdf):
+                continue
+            # get target variable and exclude choice from train data
+            target = xdf[tcol]
+            xdf = xdf.drop(tcol, axis=1)
+            weights = pop_weights(xdf, {learner: clf})
+            columns = xdf.columns
+            if  fcols:
+                xdf = encoder.encode(xdf, fcols)
+            if  verbose > 1:
+                print "Columns:", ','.join(xdf.columns)
+                print "Target:", target
+
+            if  hasher is not None:
+                # sparse numeric + hashed matrix, only numeric part is scaled
+                if  scl is not None:
+                    dense = xdf.drop(hasher.hashed_columns(), axis=1).values.astype(np.float32)
+                    if  hasattr(scl, 'partial_fit'):
+                        scl.partial_fit(dense)
+                    else:
+                        scl.fit(dense)
+                xdf = hashed_matrix(xdf, hasher, scl)
+            elif scl is not None:
+                if  hasattr(scl, 'partial_fit'):
+                    xdf = scl.partial_fit(xdf).transform(xdf)
+                else:
+                    xdf = scl.fit_transform(xdf)
+            w_rest = None
+            if  split and weights is not None:
+                x_train, x_rest, y_train, y_rest, w_train, w_rest = \
+                        train_test_split(xdf, target, weights, test_size=0.1)
+            elif split:
+                x_train, x_rest, y_train, y_rest = \
+                        train_test_split(xdf, target, test_size=0.1)
+                w_train = None
+            else:
+                x_train = xdf
+                y_train = target
+                w_train = weights
+            with span('fit', merge=True, rows=len(y_train)):
+                if  learner == 'SGDClassifier':
+                    fit = clf.partial_fit(x_train, y_train, classes=classes, sample_weight=w_train)
+                else:
+                    fit = clf.partial_fit(x_train, y_train, sample_weight=w_train)
+            if  split:
+                scores.append((clf.score(x_rest, y_rest, sample_weight=w_rest), len(y_rest)))
+            nrows += len(target)
+        if  verbose:
+            print "Train elapsed time", time.time()-time0, "rows", nrows
+        if  scores:
+            print "### SCORE", sum(s*n for s, n in scores)/float(sum(n for _, n in scores))
+        ntotal += nrows
+    if  not ntotal:
+        raise Exception("No train rows in %s" % ','.join(train_file_list))
+    if  fcols:
+        encoder.save()
+
+    method = 'predict'
+    if  learner == 'SGDClassifier' and clf.loss in ('log', 'modified_huber'):
+        method = 'predict_proba'
+    art = make_artifact(clf, learner, columns, tcol, drops, scl, encoder,
+            fcols, hasher, method)
+    if  model_out:
+        save_artifact(model_out, art)
+
+    # new data for which we want to predict, streamed like train data
+    if  newdata_file and ofile:
+        score(newdata_file, art, ofile, chunksize, verbose)
+
+def age_model(clf, factor):
+    """
+    Weigh what given incrementally trained model has learned so far by
+    factor relative to the rows it sees next: SGD learners restart the
+    decrease of their learning rate as if they had seen factor times as
+    many rows, naive Bayes learners scale their counts
+    """
+    if  hasattr(clf, 't_'):
+        # t_ is 1 plus the number of rows seen
+        clf.t_ = 1. + (clf.t_ - 1.) * factor
+    for attr in ['class_count_', 'feature_count_']:
+        if  hasattr(clf, attr):
+            setattr(clf, attr, getattr(clf, attr) * factor)
+
+def prune_trees(clf, tree_weeks, latest, decay=1., ntrees=10, max_trees=0):
+    """
+    Keep round(ntrees*decay**age) trees of every week of given forest, age
+    being the number of weeks of the week before the latest one, so that
+    the votes of a week weigh decay**age relative to the latest week, and
+    then at most max_trees trees of the most recent weeks. Return weeks of
+    the kept trees.
+    """
+    tree_weeks = np.asarray(tree_weeks)
+    keep = np.zeros(len(tree_weeks), dtype=bool)
+    for week in np.unique(tree_weeks):
+        idx = np.where(tree_weeks == week)[0]
+        keep[idx[:int(round(ntrees * decay ** (latest - week)))]] = True
+    kept = np.where(keep)[0]
+    if  max_trees and len(kept) > max_trees:
+        kept = np.sort(kept[np.argsort(tree_weeks[kept], kind='mergesort')][-max_trees:])
+    if  len(kept) < len(tree_weeks):
+        clf.estimators_ = [clf.estimators_[i] for i in kept]
+        clf.n_estimators = len(kept)
+    return tree_weeks[kept].tolist()
+
+def model_rolling(train_file_list, newdata_file, idcol, tcol, learner,
+        checkpoint, lparams=None, drops=None, scaler=None, ofile=None,
+        decay=1., ntrees=10, max_trees=0, chunksize=100000, fcols=None,
+        vdir=None, classes=None, where=None, verbose=False):
+    """
+    Update model saved in checkpoint with train files of weeks it has not
+    seen yet, or build it from scratch if there is no checkpoint. The week
+    of a file is taken from the YYYYMMDD-YYYYMMDD window in its name. SGD
+    and other partial_fit learners continue with partial_fit on chunks of
+    new files, forests grow ntrees new trees per week with warm_start.
+    The age of a week is the number of weeks before the latest week the
+    model has seen in this or earlier runs, and a week weighs decay**age:
+    when the latest week moves forward, partial_fit learners are aged by
+    age_model, and rows of weeks older than it are weighted, while forests
+    keep round(ntrees*decay**age) trees of each week and at most max_trees
+    trees of the most recent weeks, see prune_trees. The scaler is fitted
+    on the whole first week only, so that inputs of earlier weeks and new
+    ones stay comparable. Only rows matching where predicates are used.
+    The updated model is saved back to checkpoint.
+    """
+    from week_calendar import get_calendar
+    calendar = get_calendar()
+    weeks = {}
+    for train_file in train_file_list:
+        try:
+            weeks[train_file] = calendar.filename_ordinal(os.path.basename(train_file))
+        except (AttributeError, KeyError):
+            raise Exception("No week window in name of train file %s" % train_file)
+    if  os.path.isfile(checkpoint):
+        art = load_artifact(checkpoint, mmap_mode=None)
+        if  art['learner'] != learner:
+            raise Exception("Checkpoint %s holds %s, not %s" \
+                    % (checkpoint, art['learner'], learner))
+        print "Checkpoint", checkpoint, "weeks", len(art['weeks'])
+        if  'tree_weeks' not in art:
+            # checkpoint written before the week of each tree was kept
+            art['tree_weeks'] = [max(art['weeks'])] * len(getattr(art['model'], 'estimators_', []))
+    else:
+        clf = learners()[learner]
+        if  lparams:
+            if  isinstance(lparams, str):
+                lparams = json.loads(lparams)
+            for key, val in lparams.items():
+                setattr(clf, key, val)
+        setattr(clf, "random_state", 123)
+        drops = drop_columns(drops, idcol)
+        if  fcols and isinstance(fcols, basestring):
+            fcols = fcols.split(',')
+        method = 'predict'
+        if  learner == 'SGDClassifier' and clf.loss in ('log', 'modified_huber'):
+            method = 'predict_proba'
+        art = make_artifact(clf, learner, [], tcol, drops,
+                getattr(preprocessing, scaler)() if scaler else None,
+                CategoricalEncoder(vdir), fcols, method=method)
+        art['weeks'] = []
+        art['classes'] = None
+        art['tree_weeks'] = []
+    clf = art['model']
+    # forests grow trees of new weeks next to earlier ones, other
+    # warm_start learners such as boosting cannot
+    if  not hasattr(clf, 'partial_fit') and not isinstance(clf, BaseForest):
+        raise Exception("Unsupported learner %s, rolling training needs partial_fit or a forest" % learner)
+    print "clf:", clf
 
-        # get target variable and exclude choice from train data
+    def prepare(xdf):
+        "Return features, in train column order and encoded, target and sample weights of given data frame"
         target = xdf[tcol]
         xdf = xdf.drop(tcol, axis=1)
-        if  verbose:
-            print "Columns:", ','.join(xdf.columns)
-            print "Target:", target
+        weights = pop_weights(xdf, {learner: clf})
+        if  not art['columns']:
+            art['columns'] = list(xdf.columns)
+        xdf = xdf[art['columns']]
+        if  art['fcols']:
+            xdf = art['encoder'].encode(xdf, art['fcols'])
+        return xdf, target, weights
 
-        if  scaler:
-            xdf = getattr(preprocessing, scaler)().fit_transform(xdf)
-        if  split:
-            x_train, x_rest, y_train, y_rest = \
-                    train_test_split(xdf, target, test_size=0.1)
-            time0 = time.time()
-            fit = clf.partial_fit(x_train, y_train)
-            if  verbose:
-                print "Train elapsed time", time.time()-time0
-            print "### SCORE", clf.score(x_rest, y_rest)
+    # only weeks the model has not seen, oldest first
+    new_files = sorted([f for f in train_file_list if weeks[f] not in art['weeks']],
+            key=lambda f: weeks[f])
+    if  not new_files:
+        print "No new weeks to train on"
+    if  new_files and learner == 'SGDClassifier' and art['classes'] is None:
+        # partial_fit needs all classes on the first call
+        if  isinstance(classes, basestring):
+            classes = [float(c) if '.' in c else int(c) for c in classes.split(',') if c]
+        if  classes is None or not len(classes):
+            with span('classes'):
+                classes = target_classes(new_files, tcol, chunksize, where=where)
+        art['classes'] = np.asarray(classes)
+    latest = max(art['weeks']) if art['weeks'] else None
+    for train_file in new_files:
+        week = weeks[train_file]
+        if  latest is not None and week > latest and decay != 1 \
+                and hasattr(clf, 'partial_fit'):
+            # the history gets older by the weeks from its latest week to this one
+            age_model(clf, decay ** (week - latest))
+        latest = week if latest is None else max(latest, week)
+        weight = decay ** (latest - week)
+        print "Train file", train_file, "weight", weight
+        time0 = time.time()
+        if  hasattr(clf, 'partial_fit'):
+            chunks = prefetch(read_data_chunks(train_file, art['drops'],
+                chunksize, art['scaler'] is not None, where=where))
         else:
-            x_train = xdf
-            y_train = target
-            time0 = time.time()
-            fit = clf.partial_fit(x_train, y_train)
-            if  verbose:
-                print "Train elapsed time", time.time()-time0
+            chunks = [read_data(train_file, art['drops'], scaler=art['scaler'] is not None, where=where)]
+        if  art['scaler'] is not None and not art['columns']:
+            # the scaler is fitted on all rows of the first week with rows before any of them is used
+            with span('scaler', file=os.path.basename(train_file)):
+                if  not hasattr(clf, 'partial_fit'):
+                    if  len(chunks[0]):
+                        art['scaler'].fit(prepare(chunks[0])[0])
+                elif hasattr(art['scaler'], 'partial_fit'):
+                    for xdf in read_data_chunks(train_file, art['drops'], chunksize, True, where=where):
+                        if  len(xdf):
+                            art['scaler'].partial_fit(prepare(xdf)[0])
+                else:
+                    xdf = read_data(train_file, art['drops'], scaler=True, where=where)
+                    if  len(xdf):
+                        art['scaler'].fit(prepare(xdf)[0])
+        nrows = 0
+        for xdf in chunks:
+            if  not len(xdf):
+                continue
+            xdf, target, weights = prepare(xdf)
+            if  art['scaler'] is not None:
+                xdf = art['scaler'].transform(xdf)
+            with span('fit', merge=True, rows=len(target)):
+                if  hasattr(clf, 'partial_fit'):
+                    kwargs = {}
+                    if  weights is not None:
+                        kwargs['sample_weight'] = weights * weight
+                    elif weight != 1:
+                        kwargs['sample_weight'] = np.full(len(target), weight)
+                    if  learner == 'SGDClassifier':
+                        kwargs['classes'] = art['classes']
+                    clf.partial_fit(xdf, target, **kwargs)
+                else:
+                    # new trees are fitted on this week only, earlier trees are kept
+                    clf.warm_start = True
+                    clf.n_estimators = len(getattr(clf, 'estimators_', [])) + ntrees
+                    clf.fit(xdf, target, sample_weight=weights)
+                    art['tree_weeks'] += [week] * (len(clf.estimators_) - len(art['tree_weeks']))
+            nrows += len(target)
+        art['weeks'].append(week)
+        if  verbose:
+            print "Train elapsed time", time.time()-time0, "rows", nrows
+    if  new_files and not hasattr(clf, 'partial_fit'):
+        art['tree_weeks'] = prune_trees(clf, art['tree_weeks'], latest,
+                decay, ntrees, max_trees)
+        print "Trees per week:", ', '.join('%s:%s' % (calendar.window(week), art['tree_weeks'].count(week)) \
+                for week in sorted(set(art['tree_weeks'])))
+    if  art['fcols']:
+        art['encoder'].save()
+    if  new_files:
+        save_artifact(checkpoint, art)
 
     # new data for which we want to predict
-    if  newdata_file:
-        tdf = read_data(newdata_file, drops, scaler=scaler)
-        if  tcol in tdf.columns:
-            tdf = tdf.drop(tcol, axis=1)
-        datasets = [int(i) for i in list(tdf['dataset'])]
-        dbses = [int(i) for i in list(tdf['dbs'])]
-        if  scaler:
-            tdf = getattr(preprocessing, scaler)().fit_transform(tdf)
-        predictions = fit.predict_proba(tdf)
-        data = {'dataset':datasets, 'dbs': dbses, 'prediction':predictions}
-        out = pd.DataFrame(data=data)
-        if  ofile:
-            out.to_csv(ofile, header=True, index=False)
+    if  newdata_file and ofile:
+        score(newdata_file, art, ofile, chunksize, verbose)
 
 def main():
     "Main function"
     optmgr = OptionParser(learners().keys(), SCORERS.keys())
+    optmgr.parser.add_option("--chunksize", action="store", type="int",
+        default=100000, dest="chunksize",
+        help="number of rows per partial_fit call when training on a list of files, default 100000")
+    optmgr.parser.add_option("--cache-dir", action="store", type="string",
+        default="", dest="cache",
+        help="directory for binary caches of parsed train/newdata files")
+    optmgr.parser.add_option("--factorize", action="store", type="string",
+        default="", dest="fcols",
+        help="comma separated list of categorical columns to encode into integer codes")
+    optmgr.parser.add_option("--vocab-dir", action="store", type="string",
+        default="", dest="vdir",
+        help="directory of persistent vocabularies of factorized columns, which keep codes stable across files and runs")
+    optmgr.parser.add_option("--hash-cols", action="store", type="string",
+        default="", dest="hash_cols",
+        help="comma separated list of columns hashed into sparse features when training on a list of files")
+    optmgr.parser.add_option("--hash-cross", action="store", type="string",
+        default="", dest="hash_cross",
+        help="semicolon separated list of column crosses hashed into sparse features, e.g. dataset:era;dbs:era")
+    optmgr.parser.add_option("--hash-bits", action="store", type="int",
+        default=20, dest="hash_bits",
+        help="number of bits of hashed feature indices, default 20")
+    optmgr.parser.add_option("--njobs", action="store", type="int",
+        default=-1, dest="njobs",
+        help="number of worker processes of grid search, default all cores")
+    optmgr.parser.add_option("--search-dir", action="store", type="string",
+        default="gsearch", dest="sdir",
+        help="directory of shared data, cached scores and results of grid search, default gsearch")
+    optmgr.parser.add_option("--rank", action="store", type="string",
+        default="all", dest="rank",
+        help="feature rankings to compute: none, all or comma separated list of anova,chi2,importance, default all")
+    optmgr.parser.add_option("--rank-file", action="store", type="string",
+        default="", dest="rfile",
+        help="output csv file of feature rankings, default <learner>.ranking.csv")
+    optmgr.parser.add_option("--model-out", action="store", type="string",
+        default="", dest="model_out",
+        help="file to save fitted model, scaler and encoders to, for later scoring")
+    optmgr.parser.add_option("--model-in", action="store", type="string",
+        default="", dest="model_in",
+        help="saved model file; with it newdata is scored in chunks without training")
+    optmgr.parser.add_option("--classes", action="store", type="string",
+        default="", dest="classes",
+        help="comma separated list of target classes of SGDClassifier trained on a list of files or rolling, default all values of the target in the train files")
+    optmgr.parser.add_option("--checkpoint", action="store", type="string",
+        default="", dest="checkpoint",
+        help="model file updated with weeks of train files it has not seen yet (rolling training)")
+    optmgr.parser.add_option("--decay", action="store", type="float",
+        default=1., dest="decay",
+        help="rolling training weight factor per week of age of the weeks a model has seen: partial_fit learners are aged by it, forests keep fewer trees of older weeks, default 1 (no decay)")
+    optmgr.parser.add_option("--ntrees", action="store", type="int",
+        default=10, dest="ntrees",
+        help="number of trees added per week to forests in rolling training, default 10")
+    optmgr.parser.add_option("--max-trees", action="store", type="int",
+        default=0, dest="max_trees",
+        help="number of most recent trees kept by forests in rolling training, default all")
+    optmgr.parser.add_option("--learners", action="store", type="string",
+        default="", dest="learners",
+        help="comma separated list of learners to fit in parallel on the same data and compare")
+    optmgr.parser.add_option("--ensemble", action="store_true",
+        default=False, dest="ensemble",
+        help="with --learners, also write mean probability of all learners to ensemble.predictions")
+    optmgr.parser.add_option("--compare-file", action="store", type="string",
+        default="learners.csv", dest="compare_file",
+        help="output csv table comparing learners, default learners.csv")
+    optmgr.parser.add_option("--profile", action="store", type="string",
+        default="", dest="profile",
+        help="JSON file for wall time, CPU time, rows, bytes and peak memory of each stage")
+    optmgr.parser.add_option("--profile-hot", action="store", type="string",
+        default="", dest="profile_hot",
+        help="name of a stage (e.g. fit) to profile with cProfile, its top functions go to the --profile file")
+    optmgr.parser.add_option("--where", action="store", type="string",
+        default="", dest="where",
+        help="comma separated predicates on train rows, e.g. tier==1,naccess>=3, pushed down to the partitions of a columnar store train input")
+    optmgr.parser.add_option("--sample-size", action="store", type="int",
+        default=0, dest="sample_size",
+        help="number of train rows sampled in one pass by reservoir sampling, fitted with weights correcting for the sampling, default 0 (all rows)")
+    optmgr.parser.add_option("--sample-ratios", action="store", type="string",
+        default="", dest="sample_ratios",
+        help="fraction of the sample of each target class, e.g. 1:0.5,0:0.5, default the ratios of the train data")
+    optmgr.parser.add_option("--sample-rate", action="store", type="float",
+        default=1., dest="sample_rate",
+        help="fraction of the (dataset, dbs) whose train rows are kept, chosen by a hash, default 1 (all)")
+    optmgr.parser.add_option("--sample-seed", action="store", type="int",
+        default=12345, dest="sample_seed",
+        help="seed of the sampling, default 12345")
     opts, _ = optmgr.options()
+    opts.where = parse_where(opts.where)
+    sampler = None
+    if  opts.sample_size or opts.sample_rate < 1:
+        sampler = Sampler(opts.sample_size, parse_ratios(opts.sample_ratios),
+                (opts.target, None), opts.sample_rate, opts.sample_seed)
+    start_profiler(opts.profile, opts.profile_hot)
     if  opts.learner_help:
         obj = learners()[opts.learner_help]
         print obj
         print obj.__doc__
         sys.exit(0)
+    if  opts.model_in and not opts.newdata:
+        optmgr.parser.error("--model-in needs --newdata to score")
+    if  opts.learners and not opts.newdata:
+        optmgr.parser.error("--learners needs --newdata to compare predictions")
+    if  opts.model_in:
+        art = load_artifact(opts.model_in)
+        ofile = opts.predict or "%s.predictions" % art['learner']
+        score(opts.newdata, art, ofile, opts.chunksize, opts.verbose)
+        return
     ofile = opts.predict
     if  not ofile:
         ofile = "%s.predictions" % opts.learner
@@ -353,20 +1501,45 @@ def main():
     if  opts.train.find(',') != -1: # list of files
         train_files = opts.train.split(',')
         model2run = 'model_iter'
-    elif os.path.isdir(opts.train): # we got directory name
+    elif os.path.isdir(opts.train) and not is_store(opts.train): # we got directory name
         for ext in ['.csv.gz', '.csv']:
             train_files = [f for f in files(opts.train, ext)]
             model2run = 'model_iter'
             if  len(train_files):
                 break
 
+    if  sampler and (model2run == 'model_iter' or opts.checkpoint):
+        optmgr.parser.error("--sample-size and --sample-rate need a single train file")
+
     random.seed(12345) 
-    if  model2run == 'model_iter':
+    if  opts.learners:
+        model_compare(train_file=opts.train, newdata_file=opts.newdata,
+                idcol=opts.idcol, tcol=opts.target, learner_list=opts.learners,
+                drops=opts.drops, scorer=opts.scorer, scaler=opts.scaler,
+                cache=opts.cache, fcols=opts.fcols, vdir=opts.vdir,
+                njobs=opts.njobs, sdir=opts.sdir, ensemble=opts.ensemble,
+                ofile=opts.compare_file, pfile=opts.predict or '%s.predictions',
+                where=opts.where, sampler=sampler, verbose=opts.verbose)
+    elif opts.checkpoint:
+        if  model2run != 'model_iter':
+            train_files = [opts.train]
+        model_rolling(train_file_list=train_files, newdata_file=opts.newdata,
+                idcol=opts.idcol, tcol=opts.target, learner=opts.learner,
+                checkpoint=opts.checkpoint, lparams=opts.lparams,
+                drops=opts.drops, scaler=opts.scaler, ofile=ofile,
+                decay=opts.decay, ntrees=opts.ntrees, max_trees=opts.max_trees,
+                chunksize=opts.chunksize, fcols=opts.fcols, vdir=opts.vdir,
+                classes=opts.classes, where=opts.where, verbose=opts.verbose)
+    elif model2run == 'model_iter':
         model_iter(train_file_list=train_files, newdata_file=opts.newdata,
                 idcol=opts.idcol, tcol=opts.target,
                 learner=opts.learner, lparams=opts.lparams,
                 drops=opts.drops, split=opts.split,
-                scaler=opts.scaler, ofile=ofile, verbose=opts.verbose)
+                scaler=opts.scaler, ofile=ofile,
+                chunksize=opts.chunksize, fcols=opts.fcols, vdir=opts.vdir,
+                hash_cols=opts.hash_cols, hash_cross=opts.hash_cross,
+                hash_bits=opts.hash_bits, model_out=opts.model_out,
+                where=opts.where, classes=opts.classes, verbose=opts.verbose)
     else:
         model(train_file=opts.train, newdata_file=opts.newdata,
                 idcol=opts.idcol, tcol=opts.target,
@@ -374,7 +1547,11 @@ def main():
                 drops=opts.drops, split=opts.split,
                 scorer=opts.scorer, scaler=opts.scaler, ofile=ofile,
                 idx=opts.idx, limit=opts.limit, gsearch=opts.gsearch,
-                crossval=opts.cv, verbose=opts.verbose)
+                crossval=opts.cv, cache=opts.cache, fcols=opts.fcols,
+                vdir=opts.vdir, njobs=opts.njobs, sdir=opts.sdir,
+                rank=opts.rank, rfile=opts.rfile or "%s.ranking.csv" % opts.learner,
+                model_out=opts.model_out, where=opts.where, sampler=sampler,
+                verbose=opts.verbose)
 
 if __name__ == '__main__':
     main()
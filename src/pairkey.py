@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Author     : Ting Li <liting0612 At gmail dot com>
+Description: Packs (dataset, dbs) pairs into single integer keys, and joins tables on these keys by sorting instead of by dicts of tuples.
+"""
+
+import numpy
+
+
+def pair_key(datasets, dbses):
+    ''' Pack dataset and dbs ids into one 64-bit integer key per row
+    input:
+    datasets: the dataset ids, as an array of non negative integers below 2**32
+    dbses: the dbs ids, as an array of non negative integers below 2**32
+    output:
+    keys: an array of int64, dataset in the high 32 bits and dbs in the low 32 bits, so that keys sort as (dataset, dbs)
+    '''
+
+    return (numpy.asarray(datasets, dtype=numpy.int64) << 32) | numpy.asarray(dbses, dtype=numpy.int64)
+
+
+def split_key(keys):
+    ''' Unpack keys made by pair_key
+    input:
+    keys: an array of int64 keys
+    output:
+    datasets, dbses: two arrays of int64
+    '''
+
+    keys = numpy.asarray(keys, dtype=numpy.int64)
+    return keys >> 32, keys & 0xffffffff
+
+
+def sorted_join(left, right):
+    ''' Find for each left key the position of the same key in the right keys, by a binary search in the sorted right keys
+    input:
+    left: an array of keys, in any order and possibly repeated
+    right: an array of unique keys, in any order
+    output:
+    index: an array of the same length as left, the position in right of each left key, -1 for the keys which are not in right
+    '''
+
+    left = numpy.asarray(left)
+    right = numpy.asarray(right)
+    index = numpy.full(len(left), -1, dtype=numpy.int64)
+    if len(right) == 0:
+        return index
+    order = numpy.argsort(right, kind='mergesort')
+    pos = numpy.searchsorted(right[order], left)
+    pos[pos == len(right)] = 0
+    found = right[order][pos] == left
+    index[found] = order[pos[found]]
+    return index
+
+
+def sum_by_key(keys, values):
+    ''' Sum values of rows with the same key
+    input:
+    keys: an array of keys
+    values: an array of values of the rows, of the same length
+    output:
+    ukeys: the sorted unique keys
+    sums: the sum of the values of each unique key, as an array of float64
+    '''
+
+    ukeys, inverse = numpy.unique(keys, return_inverse=True)
+    return ukeys, numpy.bincount(inverse, weights=numpy.asarray(values, dtype=numpy.float64), minlength=len(ukeys))
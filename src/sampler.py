@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Author     : Ting Li <liting0612 At gmail dot com>
+Description: Samples records in one pass with bounded memory: reservoir sampling of a fixed number of records per class, with target class ratios, and deterministic sampling of datasets by a hash of (dataset, dbs), with sample weights correcting for the sampling.
+"""
+
+import re
+import numpy
+import pandas
+from feature_hashing import hash_column, mix
+
+# the column of the sample weights in the sampled records
+WEIGHT = 'sample_weight'
+
+
+def parse_ratios(text):
+    ''' Parse target class ratios, such as '1:0.5,0:0.5'
+    input:
+    text: a comma separated list of <class>:<fraction of the sample>
+    output:
+    a dict of class, as a string, to fraction
+    '''
+
+    ratios = {}
+    for item in [i.strip() for i in (text or '').split(',') if i.strip()]:
+        label, fraction = item.rsplit(':', 1)
+        ratios[label] = float(fraction)
+    return ratios
+
+
+def parse_label(text):
+    ''' Parse the class of records, the value of a column such as 'target', or whether a column is above a threshold such as 'naccess>0'
+    output:
+    (column, threshold or None), or None if text is empty
+    '''
+
+    if not text:
+        return None
+    match = re.match(r'^(\w+)\s*(?:>\s*(.+))?$', text)
+    if not match:
+        raise ValueError('cannot parse class %s, expected <column> or <column>><threshold>' % text)
+    return match.group(1), float(match.group(2)) if match.group(2) is not None else None
+
+
+def column(rows, col):
+    ''' The values of a column of records, a data frame or a list of dicts, as an array '''
+
+    if isinstance(rows, pandas.DataFrame):
+        return rows[col].values
+    return numpy.array([row[col] for row in rows])
+
+
+def take(rows, positions):
+    ''' The records at some positions, of a data frame or a list '''
+
+    if isinstance(rows, pandas.DataFrame):
+        return rows.iloc[positions]
+    return [rows[i] for i in positions]
+
+
+def concat(parts):
+    ''' Concatenate data frames or lists of records '''
+
+    if parts and isinstance(parts[0], pandas.DataFrame):
+        return pandas.concat(parts, ignore_index=True)
+    return [row for part in parts for row in part]
+
+
+def hash_values(values):
+    ''' The values of an id column with the integral ones, numbers or strings, as int64 so that 5, 5.0 and '5' hash alike
+    input:
+    values: an array of numbers or strings
+    output:
+    an int64 array, or an object array when some values are not integral
+    '''
+
+    values = numpy.asarray(values)
+    if values.dtype.kind in 'biu':
+        return values.astype(numpy.int64)
+    numbers = pandas.to_numeric(pandas.Series(values), errors='coerce').values.astype(float)
+    integral = numpy.isfinite(numbers) & (numbers == numpy.floor(numbers))
+    if integral.all():
+        return numbers.astype(numpy.int64)
+    out = values.astype(object)
+    out[integral] = numbers[integral].astype(numpy.int64)
+    return out
+
+
+def hash_keep(datasets, dbses, rate, seed=0):
+    ''' Whether to keep each record, by a hash of its (dataset, dbs), so that the same datasets are kept in every file and every run
+    input:
+    datasets, dbses: the values of the dataset and dbs columns, as arrays of numbers or strings
+    rate: the fraction of the datasets to keep
+    seed: the seed of the hash, to draw another set of datasets
+    output:
+    a boolean array
+    '''
+
+    hashes = mix(mix(hash_column('dataset', hash_values(datasets)), hash_column('dbs', hash_values(dbses))), seed)
+    return hashes < rate * (1 << 32)
+
+
+class Reservoir(object):
+    ''' A uniform sample of at most capacity records of a stream, by reservoir sampling (Algorithm R) vectorized over chunks of records.
+    The records entering the reservoir are appended with their slots, and compacted to the last record of each slot when they exceed twice the capacity
+    input:
+    capacity: the size of the sample, None to keep all the records
+    rng: a numpy RandomState
+    '''
+
+    def __init__(self, capacity, rng):
+        self.capacity = capacity
+        self.rng = rng
+        self.seen = 0
+        self.parts = []
+        self.slots = []
+        self.stored = 0
+
+    def add(self, rows):
+        ''' Offer a chunk of records, a data frame or a list '''
+
+        n = len(rows)
+        if self.capacity is None:
+            self.parts.append(rows)
+            self.slots.append(numpy.arange(self.seen, self.seen + n))
+            self.seen += n
+            return
+        # the j-th record of the stream goes to slot j while the reservoir fills, then to a random slot below j + 1, if below the capacity
+        j = self.seen + numpy.arange(n)
+        slots = numpy.where(j < self.capacity, j, (self.rng.random_sample(n) * (j + 1)).astype(numpy.int64))
+        keep = numpy.where(slots < self.capacity)[0]
+        self.seen += n
+        if len(keep):
+            self.parts.append(take(rows, keep))
+            self.slots.append(slots[keep])
+            self.stored += len(keep)
+        if self.stored > 2 * self.capacity:
+            self.compact()
+
+    def compact(self):
+        ''' Keep the last record of each slot '''
+
+        if not self.parts:
+            return
+        rows = concat(self.parts)
+        slots = numpy.concatenate(self.slots)
+        ukeys, last = numpy.unique(slots[::-1], return_index=True)
+        self.parts = [take(rows, len(slots) - 1 - last)]
+        self.slots = [ukeys]
+        self.stored = len(ukeys)
+
+    def sample(self):
+        ''' The sampled records, and the number of records of the stream each of them stands for '''
+
+        self.compact()
+        rows = self.parts[0] if self.parts else []
+        weight = float(self.seen) / len(rows) if len(rows) else 1.
+        return rows, weight
+
+
+class Sampler(object):
+    ''' A one-pass sampler of records, with bounded memory when size is given
+    input:
+    size: the number of records of the sample, 0 to keep all the records (after the hash sampling)
+    ratios: a dict of class to its fraction of the sample, from parse_ratios; the records of the other classes are left out; None for one uniform sample of all the records
+    label: the class of the records, from parse_label; needed by ratios
+    rate: the fraction of the (dataset, dbs) to keep, by hash_keep, 1 to keep all
+    seed: the seed of the reservoirs and of the hash
+    '''
+
+    def __init__(self, size=0, ratios=None, label=None, rate=1., seed=12345):
+        if ratios and not label:
+            raise ValueError('class ratios need the class column of the records')
+        self.rate = rate
+        self.label = label
+        self.seed = seed
+        rng = numpy.random.RandomState(seed)
+        if ratios:
+            self.reservoirs = dict((c, Reservoir(int(round(size * f)) if size else None, rng)) for c, f in ratios.items())
+        else:
+            self.reservoirs = {None: Reservoir(size or None, rng)}
+
+    def columns(self):
+        ''' The columns the sampler needs '''
+
+        cols = ['dataset', 'dbs'] if self.rate < 1 else []
+        if self.label and self.label[0] not in cols:
+            cols.append(self.label[0])
+        return cols
+
+    def classes(self, rows):
+        ''' The class of each record, as strings '''
+
+        col, threshold = self.label
+        values = column(rows, col)
+        if threshold is not None:
+            values = (values.astype(numpy.float64) > threshold).astype(numpy.int64)
+        elif values.dtype.kind == 'f' and len(values) and (values == numpy.round(values)).all():
+            # integral classes read as floats, such as a target with missing values
+            values = values.astype(numpy.int64)
+        return values.astype(str)
+
+    def add(self, rows):
+        ''' Offer a chunk of records, a data frame or a list of dicts '''
+
+        if self.rate < 1:
+            rows = take(rows, numpy.where(hash_keep(column(rows, 'dataset'), column(rows, 'dbs'), self.rate, self.seed))[0])
+        if None in self.reservoirs:
+            self.reservoirs[None].add(rows)
+            return
+        labels = self.classes(rows)
+        for label, reservoir in self.reservoirs.items():
+            reservoir.add(take(rows, numpy.where(labels == label)[0]))
+
+    def sample(self):
+        ''' The sampled records of all the classes, and their sample weights, the numbers of records of the input each of them stands for
+        output:
+        rows: a data frame or a list of records
+        weights: an array of float64
+        '''
+
+        parts, weights = [], []
+        for label in sorted(self.reservoirs, key=str):
+            rows, weight = self.reservoirs[label].sample()
+            if len(rows):
+                parts.append(rows)
+                weights.append(numpy.full(len(rows), weight / self.rate))
+        if not parts:
+            return [], numpy.zeros(0)
+        return concat(parts), numpy.concatenate(weights)
+
+    def summary(self):
+        ''' The number of records offered and sampled of each class '''
+
+        return dict((label, (r.seen, r.stored if r.capacity is not None else r.seen)) for label, r in self.reservoirs.items())
@@ -8,25 +8,29 @@ Description: Select records from dataset access files whose attribute is some va
 import os
 import re
 import csv
-import gzip
 import argparse
-import glob
+from collections import OrderedDict
+from instrument import span, start_profiler, add_profile_arguments
+from fileio import open_read, open_write, with_codec_extension, data_files, add_codec_arguments
 # import ordereddict
 
 ''' Example:
 select.py --indir original --attr tier --attrval 2 --outdir tier2
 '''
 
-def write_dct_lst(dct_lst, attrs, filename ):
+def write_dct_lst(dct_lst, attrs, filename, codec=None, level=None, threads=0):
     ''' write a list of dictionaries with common attributes to a file, according to specified order of attributes 
     input:
     dct_lst: a list of dictionaries
     attrs: a list of attributes' names, in a specified order
     output:
     filename: output file
+    codec: the compression codec of the output file, None for that of its extension
+    level: the compression level, None for the default level of the codec
+    threads: the number of threads compressing a block gzip output, 0 for plain gzip
     '''
 
-    csvfile = gzip.open(filename, 'w')
+    csvfile = open_write(filename, codec, level, threads)
     # write header
     csvfile.write(','.join(attrs) + '\n')    
     # write data
@@ -37,39 +41,108 @@ def write_dct_lst(dct_lst, attrs, filename ):
         csvfile.write(','.join(line) + '\n')
     csvfile.close()
 
+def select_store(args):
+    ''' Select records from a columnar store of dataset access files, and write them to one file per week like the text input
+    input:
+    args: the parsed command line arguments
+    '''
+
+    # colstore is imported here, as it imports pandas, which imports the standard select module hidden by this script
+    from colstore import ColumnStore, write_csv
+    store = ColumnStore(args.indir)
+    where = [(args.attr, '==', args.attrval)]
+    # only the weeks whose column statistics allow the attribute value are read
+    candidates = set(part['window'] for part in store.partitions(where))
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+    for part in store.catalog['partitions']:
+        with span('select', file=part['source']) as rec:
+            if part['window'] in candidates:
+                data = store.read_partition(part, part['columns'], where)
+            else:
+                data = OrderedDict((col, []) for col in part['columns'])
+            rec['rows'] = len(data.values()[0]) if data else 0
+        print part['source'], rec['rows'], part['rows']
+        with span('write', file=part['source'], rows=rec['rows']):
+            write_csv(data, with_codec_extension(args.outdir + '/' + part['source'], args.codec), args.codec, args.level, args.threads)
+
+
 def main():
 
     parser = argparse.ArgumentParser(description='''Select records from dataset access files whose attribute is some value. 
     
 Example:
-select.py --indir original --attr tier --attrval 2 --outdir tier2''', formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument('--indir', dest='indir', help='a dir containing the csv.gz files for the input original dataset access data')
+select.py --indir original --attr tier --attrval 2 --outdir tier2
+select.py --indir original --attr tier --attrval 2 --outdir tier2 --sample-rate 0.1
+select.py --indir original --attr tier --attrval 2 --outdir tier2 --sample-size 100000 --sample-by naccess\>0 --sample-ratios 1:0.5,0:0.5''', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--indir', dest='indir', help='a dir containing the csv.gz files for the input original dataset access data, or a columnar store of them made by colstore.py')
     parser.add_argument('--attr', dest='attr', help='a attribute to select by')
     parser.add_argument('--attrval', dest='attrval', help='a value of the attribute to select by')
     parser.add_argument('--outdir', dest='outdir', help='a dir cotaining csv.gz files for the output selected data')
+    parser.add_argument('--sample-size', dest='sample_size', type=int, default=0, help='''the number of selected records sampled in one pass over all the files by reservoir sampling, written with their week window tstamp and their sample weight to sample.csv.gz in outdir instead of one file per week;
+0 (default) for no reservoir sampling''')
+    parser.add_argument('--sample-by', dest='sample_by', default='', help='the class of the records for --sample-ratios, the value of a column such as target, or whether a column is above a threshold such as naccess>0')
+    parser.add_argument('--sample-ratios', dest='sample_ratios', default='', help='the fraction of the sample of each class, such as 1:0.5,0:0.5; the records of the other classes are left out')
+    parser.add_argument('--sample-rate', dest='sample_rate', type=float, default=1., help='the fraction of the (dataset, dbs) whose records are kept, chosen by a hash so that the same datasets are kept in every week, with a sample_weight column; default 1 (all)')
+    parser.add_argument('--sample-seed', dest='sample_seed', type=int, default=12345, help='the seed of the sampling, default 12345')
+    add_profile_arguments(parser)
+    add_codec_arguments(parser)
     args = parser.parse_args()
+    start_profiler(args.profile, args.profile_hot)
+
+    sampling = args.sample_size > 0 or args.sample_rate < 1
+    if os.path.isfile(os.path.join(args.indir, 'catalog.json')):
+        if sampling:
+            parser.error('sampling is not supported with a columnar store input')
+        select_store(args)
+        return
+
+    if sampling:
+        # sampler is imported here, as it imports pandas, which imports the standard select module hidden by this script
+        from sampler import Sampler, parse_ratios, parse_label, hash_keep, WEIGHT
+        from week_calendar import get_calendar
+        calendar = get_calendar()
+        sampler = Sampler(args.sample_size, parse_ratios(args.sample_ratios), parse_label(args.sample_by), args.sample_rate, args.sample_seed)
     
-    dsfilenames = glob.glob(args.indir + '/dataframe*')
+    dsfilenames = data_files(args.indir + '/dataframe*')
     for filename in  dsfilenames:
 
         print filename
 
         # read in the header of dataset access file
-        csvfile = gzip.open(filename)
+        csvfile = open_read(filename)
         attrs = csvfile.readline().rstrip('\n').split(',') # a list of attribute names
         csvfile.close()
         
         # read the dataset access file:
-        csvfile = gzip.open(filename)
-        reader = csv.DictReader(csvfile)
-        indir_lst= list(reader) # a list of dicts, each for a row in the csv file
+        with span('read', file=filename) as rec:
+            csvfile = open_read(filename, args.threads)
+            reader = csv.DictReader(csvfile)
+            indir_lst= list(reader) # a list of dicts, each for a row in the csv file
+            rec['rows'] = len(indir_lst)
         # indir_lst = [ordereddict.OrderedDict(dic) for dic in indir_lst]
         csvfile.close()
 
         # select examples/dcts whose attribute has a given value.
-        select_dct_lst = [dct for dct in indir_lst if dct[args.attr] == args.attrval ]
+        with span('select', file=filename, rows=len(indir_lst)):
+            select_dct_lst = [dct for dct in indir_lst if dct[args.attr] == args.attrval ]
         print len(select_dct_lst), len(indir_lst)
 
+        # the records of all the weeks go through one reservoir, written at the end
+        if args.sample_size > 0:
+            tstamp = calendar.window(calendar.filename_ordinal(filename))
+            for dct in select_dct_lst:
+                dct['tstamp'] = tstamp
+            with span('sample', merge=True, rows=len(select_dct_lst)):
+                sampler.add(select_dct_lst)
+            continue
+        if sampling:
+            keep = hash_keep([dct['dataset'] for dct in select_dct_lst], [dct['dbs'] for dct in select_dct_lst], args.sample_rate, args.sample_seed)
+            select_dct_lst = [dct for dct, k in zip(select_dct_lst, keep) if k]
+            for dct in select_dct_lst:
+                dct[WEIGHT] = repr(1. / args.sample_rate)
+            attrs = attrs + [WEIGHT]
+
         # output to a file
 
         # directory = args.outdir + '/' + args.attr + '/' +  args.attrval
@@ -79,7 +152,8 @@ select.py --indir original --attr tier --attrval 2 --outdir tier2''', formatter_
             os.makedirs(directory)
 
         print directory  + '/'  +  os.path.basename(filename)
-        write_dct_lst(select_dct_lst, attrs, directory  + '/'  +  os.path.basename(filename))
+        with span('write', file=filename, rows=len(select_dct_lst)):
+            write_dct_lst(select_dct_lst, attrs, with_codec_extension(directory  + '/'  +  os.path.basename(filename), args.codec), args.codec, args.level, args.threads)
 
         # csvfile = gzip.open(directory  + '/'  +  os.path.basename(filename), 'wb')
         # writer = csv.DictWriter(csvfile, fieldnames=indir_lst[0].keys(), lineterminator='\n')
@@ -88,6 +162,16 @@ select.py --indir original --attr tier --attrval 2 --outdir tier2''', formatter_
         # if len(select_dct_lst) > 0:
         #     writer.writerows(select_dct_lst)
         # csvfile.close()
+
+    if args.sample_size > 0:
+        sample_lst, weights = sampler.sample()
+        for dct, weight in zip(sample_lst, weights):
+            dct[WEIGHT] = repr(weight)
+        if not os.path.exists(args.outdir):
+            os.makedirs(args.outdir)
+        print 'sampled', len(sample_lst), 'records of', sum(r.seen for r in sampler.reservoirs.values())
+        with span('write', file='sample', rows=len(sample_lst)):
+            write_dct_lst(sample_lst, attrs + ['tstamp', WEIGHT], with_codec_extension(args.outdir + '/sample.csv.gz', args.codec), args.codec, args.level, args.threads)
             
         
 if __name__ == '__main__':
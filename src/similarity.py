@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Author     : Ting Li <liting0612 At gmail dot com>
+Description: Finds the datasets whose access series are most correlated with each other, and clusters the access series, from the matrix of access series written by time_series.py.
+"""
+
+import os
+import argparse
+import numpy
+from access_matrix import load_access_matrix
+from fileio import open_write, with_codec_extension, add_codec_arguments
+from instrument import span, start_profiler, add_profile_arguments
+
+
+def znormalize(naccess):
+    ''' z-normalize each row of a matrix of access series, and scale it to unit length, so that the dot product of two rows is their correlation
+    input:
+    naccess: a 2d array, with a row for each dataset and a column for each week
+    output:
+    z: a 2d array of float32 of the same shape, with zero rows for constant series
+    nonconst: a boolean array, True for the rows which are not constant
+    '''
+
+    naccess = numpy.asarray(naccess, dtype=numpy.float64)
+    z = naccess - naccess.mean(axis=1)[:, None]
+    norms = numpy.sqrt((z ** 2).sum(axis=1))
+    nonconst = norms > 0
+    z[nonconst] /= norms[nonconst][:, None]
+    z[~nonconst] = 0
+    return z.astype(numpy.float32), nonconst
+
+
+def topk_correlated(z, k, rows=None, block=1024):
+    ''' Find the k rows most correlated with each given row, by blocked matrix products of the z-normalized series
+    input:
+    z: a 2d array of z-normalized rows of unit length, as returned by znormalize
+    k: the number of neighbours of each row
+    rows: the indices of the rows to query, all the rows if None
+    block: the number of query rows in a matrix product
+    output:
+    neighbours: a 2d array of shape (nb of query rows, k), the indices of the neighbours of each query row by decreasing correlation
+    corrs: a 2d array of the same shape, the correlations with the neighbours
+    '''
+
+    if rows is None:
+        rows = numpy.arange(z.shape[0])
+    rows = numpy.asarray(rows)
+    k = min(k, z.shape[0] - 1)
+    neighbours = numpy.empty((len(rows), k), dtype=numpy.int64)
+    corrs = numpy.empty((len(rows), k), dtype=numpy.float32)
+    for begin in range(0, len(rows), block):
+        query = rows[begin:begin + block]
+        cc = numpy.dot(z[query], z.T)
+        # a series is not its own neighbour
+        cc[numpy.arange(len(query)), query] = -numpy.inf
+        # the k largest correlations of each row, then sorted
+        part = numpy.argpartition(-cc, k - 1, axis=1)[:, :k]
+        pcc = cc[numpy.arange(len(query))[:, None], part]
+        order = numpy.argsort(-pcc, axis=1)
+        neighbours[begin:begin + block] = part[numpy.arange(len(query))[:, None], order]
+        corrs[begin:begin + block] = pcc[numpy.arange(len(query))[:, None], order]
+    return neighbours, corrs
+
+
+def cluster_series(z, nclusters, niter=100, seed=12345, block=4096):
+    ''' Cluster z-normalized series by spherical k-means, i.e. assign each series to the centroid with which it is most correlated
+    input:
+    z: a 2d array of z-normalized rows of unit length
+    nclusters: the number of clusters
+    niter: the maximum number of iterations
+    seed: the seed of the random initial centroids
+    block: the number of rows in a matrix product
+    output:
+    labels: the cluster of each row, as an array of integers
+    centroids: a 2d array with a unit length centroid series for each cluster
+    '''
+
+    rng = numpy.random.RandomState(seed)
+    centroids = z[rng.choice(z.shape[0], nclusters, replace=False)]
+    labels = numpy.full(z.shape[0], -1, dtype=numpy.int64)
+    for it in range(0, niter):
+        # assign each row to the most correlated centroid
+        new_labels = numpy.empty_like(labels)
+        for begin in range(0, z.shape[0], block):
+            new_labels[begin:begin + block] = numpy.argmax(numpy.dot(z[begin:begin + block], centroids.T), axis=1)
+        if (new_labels == labels).all():
+            break
+        labels = new_labels
+
+        # the new centroids are the normalized sums of their rows; an empty cluster keeps its centroid
+        sums = numpy.zeros_like(centroids)
+        numpy.add.at(sums, labels, z)
+        norms = numpy.sqrt((sums ** 2).sum(axis=1))
+        nonempty = norms > 0
+        centroids[nonempty] = sums[nonempty] / norms[nonempty][:, None]
+    return labels, centroids
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='''Finds the datasets whose access series are most correlated with each other, and clusters the access series, from the matrix of access series written by time_series.py.
+
+Example:
+similarity.py --inmatrix datasets/time_series_matrix.npz --topk 10 --outdir similarity
+similarity.py --inmatrix datasets/time_series_matrix.npz --topk 10 --query 123,1 --outdir similarity
+similarity.py --inmatrix datasets/time_series_matrix.npz --clusters 20 --outdir similarity
+''', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--inmatrix', dest='inmatrix', help='a .npz file for the matrix of dataset access series on the global week grid, written by time_series.py')
+    parser.add_argument('--outdir', dest='outdir', help='a dir for the output csv.gz files of the most correlated datasets and of the clusters')
+    parser.add_argument('--min-length', dest='min_length', type=int, default=10, help='only consider datasets with at least this many weeks, default 10')
+    parser.add_argument('--topk', dest='topk', type=int, default=0, help='the number of most correlated datasets to find for each dataset, skipped if 0 (default)')
+    parser.add_argument('--query', dest='query', default='', help='a semicolon separated list of dataset,dbs pairs, whose most correlated datasets are printed, instead of finding them for all datasets')
+    parser.add_argument('--clusters', dest='clusters', type=int, default=0, help='the number of clusters of the access series, skipped if 0 (default)')
+    add_profile_arguments(parser)
+    add_codec_arguments(parser)
+    args = parser.parse_args()
+    start_profiler(args.profile, args.profile_hot)
+
+    # 1. read in the access series, and z-normalize the non constant ones which are long enough
+    with span('read', file=os.path.basename(args.inmatrix)) as rec:
+        matrix = load_access_matrix(args.inmatrix)
+        rec['rows'] = len(matrix['dataset'])
+    z, nonconst = znormalize(matrix['naccess'])
+    keep = numpy.where(nonconst & (matrix['length'] >= args.min_length))[0]
+    z = z[keep]
+    datasets = matrix['dataset'][keep]
+    dbses = matrix['dbs'][keep]
+    print 'nb of datasets:', len(matrix['dataset']), ', considered:', len(keep)
+
+    # 2. the most correlated datasets, for the queried datasets or for all of them
+    if args.topk > 0:
+        if args.query:
+            index = dict(((datasets[i], dbses[i]), i) for i in range(0, len(keep)))
+            rows = [index[tuple(pair.split(','))] for pair in args.query.split(';')]
+        else:
+            rows = numpy.arange(len(keep))
+        with span('topk_correlated', rows=len(rows)):
+            neighbours, corrs = topk_correlated(z, args.topk, rows)
+
+        if args.query:
+            for i in range(0, len(rows)):
+                print '********************'
+                print 'Most correlated with dataset: %s dbs: %s' % (datasets[rows[i]], dbses[rows[i]])
+                for j in range(0, neighbours.shape[1]):
+                    print '%d. dataset: %s dbs: %s correlation: %f' % (j + 1, datasets[neighbours[i, j]], dbses[neighbours[i, j]], corrs[i, j])
+        else:
+            csvfile = open_write(with_codec_extension(args.outdir + '/most_correlated_datasets.csv.gz', args.codec), args.codec, args.level, args.threads)
+            csvfile.write('dataset,dbs,rank,neighbour_dataset,neighbour_dbs,correlation\n')
+            for i in range(0, len(rows)):
+                for j in range(0, neighbours.shape[1]):
+                    csvfile.write('{0},{1},{2},{3},{4},{5}\n'.format(datasets[rows[i]], dbses[rows[i]], j + 1,
+                                  datasets[neighbours[i, j]], dbses[neighbours[i, j]], corrs[i, j]))
+            csvfile.close()
+
+    # 3. cluster the access series
+    if args.clusters > 0:
+        with span('cluster', rows=len(keep)):
+            labels, centroids = cluster_series(z, args.clusters)
+        print '********************'
+        print 'Cluster sizes:'
+        print numpy.bincount(labels, minlength=args.clusters)
+
+        csvfile = open_write(with_codec_extension(args.outdir + '/clusters.csv.gz', args.codec), args.codec, args.level, args.threads)
+        csvfile.write('dataset,dbs,cluster,correlation\n')
+        # the correlation of each series with the centroid of its cluster
+        cc = (z * centroids[labels]).sum(axis=1)
+        for i in range(0, len(keep)):
+            csvfile.write('{0},{1},{2},{3}\n'.format(datasets[i], dbses[i], labels[i], cc[i]))
+        csvfile.close()
+
+if __name__ == '__main__':
+
+    main()
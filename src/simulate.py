@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Author     : Ting Li <liting0612 At gmail dot com>
+Description: Replays the weekly dataset access series against replica placement policies (LRU, static, model predictions, conference count lags), and reports the hit rate, the bytes moved and the queueing delay of each policy, capacity and replica count.
+"""
+
+import os
+import csv
+import argparse
+import itertools
+from collections import OrderedDict
+import numpy
+import pandas
+from access_matrix import load_access_matrix
+from week_calendar import get_calendar
+from pairkey import pair_key, sorted_join
+from fileio import open_read, read_csv
+from instrument import span, start_profiler, add_profile_arguments
+
+HOURS_PER_WEEK = 168.
+
+
+def lru_scores(naccess):
+    ''' The score of each dataset at each week under the LRU policy, i.e. the last week before it in which the dataset was accessed
+    input:
+    naccess: a 2d array, with a row for each dataset and a column for each week
+    output:
+    scores: a 2d array of the same shape, -inf before the first access of a dataset
+    '''
+
+    weeks = numpy.where(naccess > 0, numpy.arange(naccess.shape[1])[None, :], -1)
+    last = numpy.maximum.accumulate(weeks, axis=1)
+    scores = numpy.full(naccess.shape, -numpy.inf)
+    # the placement of a week only knows the accesses of the weeks before it
+    scores[:, 1:] = numpy.where(last[:, :-1] >= 0, last[:, :-1], -numpy.inf)
+    return scores
+
+
+def static_scores(naccess, warmup):
+    ''' The score of each dataset under the static policy, i.e. its total access in the first warmup weeks, for all weeks
+    input:
+    naccess: a 2d array, with a row for each dataset and a column for each week
+    warmup: the number of weeks
+    output:
+    scores: a 2d array of the same shape as naccess
+    '''
+
+    return numpy.repeat(naccess[:, :warmup].sum(axis=1)[:, None], naccess.shape[1], axis=1)
+
+
+def lag_scores(keys, grid, confct, lags_file):
+    ''' The score of each dataset at each week from the conference counts, i.e. its highest cross correlation times the conference count at the week shifted by its best lag
+    input:
+    keys: the (dataset, dbs) key of each row of the access matrix
+    grid: the week ordinals of the columns of the access matrix
+    confct: the conference count series from the first week of grid, at least as long as grid, as an array
+    lags_file: the csv file of the best lag of each dataset, written by time_series.py, with columns dataset, dbs, lag, crosscorr
+    output:
+    scores: a 2d array with a row for each dataset and a column for each week; 0 for the datasets without a lag or with a negative correlation
+    '''
+
+    lags = read_csv(lags_file)
+    index = sorted_join(keys, pair_key(lags['dataset'].values, lags['dbs'].values))
+    found = index >= 0
+    lag = numpy.zeros(len(keys), dtype=numpy.int64)
+    cc = numpy.zeros(len(keys))
+    lag[found] = lags['lag'].values[index[found]]
+    cc[found] = numpy.maximum(lags['crosscorr'].values[index[found]], 0)
+    # the access at week t goes with the conference count at week t + lag
+    shifted = numpy.arange(len(grid))[None, :] + lag[:, None]
+    valid = (shifted >= 0) & (shifted < len(confct))
+    counts = numpy.where(valid, numpy.asarray(confct)[numpy.clip(shifted, 0, len(confct) - 1)], 0)
+    return cc[:, None] * counts
+
+
+def prediction_scores(keys, grid, pred_dir):
+    ''' The score of each dataset at each week from model.py prediction files; a file whose name has the window of week w predicts week w + 1, and a week without a file keeps the scores of the week before
+    input:
+    keys: the (dataset, dbs) key of each row of the access matrix
+    grid: the week ordinals of the columns of the access matrix
+    pred_dir: a dir of prediction files with columns dataset, dbs, prediction
+    output:
+    scores: a 2d array with a row for each dataset and a column for each week; 0 for the datasets without a prediction
+    '''
+
+    calendar = get_calendar()
+    scores = numpy.full((len(keys), len(grid)), numpy.nan)
+    for fname in os.listdir(pred_dir):
+        if fname.endswith('.gzi'):
+            continue
+        try:
+            col = calendar.filename_ordinal(fname) + 1 - grid[0]
+        except (AttributeError, KeyError):
+            continue
+        if col < 0 or col >= len(grid):
+            continue
+        pred = read_csv(os.path.join(pred_dir, fname))
+        index = sorted_join(keys, pair_key(pred['dataset'].values, pred['dbs'].values))
+        scores[:, col] = 0
+        scores[index >= 0, col] = pred['prediction'].values[index[index >= 0]]
+    # forward fill the weeks without predictions
+    filled = numpy.where(numpy.isnan(scores), -1, numpy.arange(len(grid))[None, :])
+    filled = numpy.maximum.accumulate(filled, axis=1)
+    scores = numpy.where(filled >= 0, scores[numpy.arange(len(keys))[:, None], numpy.maximum(filled, 0)], 0)
+    return scores
+
+
+def replica_sites(nrows, replicas, site_weights):
+    ''' Assign the replicas of each dataset to sites, spread over the sites in proportion to their weights
+    input:
+    nrows: the number of datasets
+    replicas: the number of replicas of a dataset
+    site_weights: the relative capacity of each site, as an array
+    output:
+    sites: an array of shape (nrows, replicas), the site of each replica
+    '''
+
+    bounds = numpy.cumsum(site_weights) / float(numpy.sum(site_weights))
+    # golden ratio sequence: evenly spread positions, the replicas of a dataset being 1/replicas apart
+    pos = (numpy.arange(nrows)[:, None] * 0.6180339887 + numpy.arange(replicas)[None, :] / float(replicas)) % 1
+    return numpy.minimum(numpy.searchsorted(bounds, pos, side='right'), len(bounds) - 1)
+
+
+def simulate(naccess, sizes, scores, capacity, replicas, site_weights, service_rate, remote_delay):
+    ''' Replay the weekly accesses against the placement given by the scores: at each week, the datasets with the highest scores get replicas until the capacity is used up
+    input:
+    naccess: a 2d array, with a row for each dataset and a column for each week
+    sizes: the size of each dataset, as an array
+    scores: a 2d array of the same shape as naccess, the priority of each dataset at each week; -inf is never placed
+    capacity: the total capacity of all sites, in the unit of sizes
+    replicas: the number of replicas of a placed dataset
+    site_weights: the relative capacity of each site, as an array
+    service_rate: the number of accesses a site serves per week
+    remote_delay: the delay in hours of an access to a dataset which is not placed, or to a saturated site
+    output:
+    weekly: a data frame with a row of metrics for each week
+    '''
+
+    nrows, nweeks = naccess.shape
+    sites = replica_sites(nrows, replicas, site_weights)
+    footprint = sizes * replicas
+    placed_before = numpy.zeros(nrows, dtype=bool)
+    rows = []
+    for t in range(0, nweeks):
+        # (1) the placement of the week, by decreasing score
+        order = numpy.argsort(-scores[:, t], kind='mergesort')
+        fits = numpy.cumsum(footprint[order]) <= capacity
+        placed = numpy.zeros(nrows, dtype=bool)
+        placed[order[fits]] = True
+        placed &= scores[:, t] > -numpy.inf
+
+        # (2) the accesses served by the sites, spread evenly over the replicas of a dataset
+        acc = naccess[:, t]
+        load = numpy.bincount(sites[placed].ravel(), weights=numpy.repeat(acc[placed] / float(replicas), replicas),
+                              minlength=len(site_weights))
+        # M/M/1 queue of each site, the accesses of a saturated site go remote
+        saturated = load >= service_rate
+        with numpy.errstate(divide='ignore'):
+            delay = numpy.where(saturated, remote_delay, HOURS_PER_WEEK / (service_rate - load))
+        total = acc.sum()
+        hits = acc[placed].sum()
+        site_delay = (load * delay).sum()
+        rows.append(OrderedDict([('week', t), ('accesses', total), ('hits', hits),
+                                 ('hit_bytes', (acc * sizes)[placed].sum()), ('accessed_bytes', (acc * sizes).sum()),
+                                 ('bytes_moved', footprint[placed & ~placed_before].sum()), ('placed', placed.sum()),
+                                 ('delay', site_delay + (total - hits) * remote_delay),
+                                 ('saturated_sites', saturated.sum())]))
+        placed_before = placed
+    return pandas.DataFrame(rows)
+
+
+def summarize(weekly, warmup=0):
+    ''' Sum up the weekly metrics of a replay, leaving out the first warmup weeks, which the static policy has seen
+    input:
+    weekly: a data frame returned by simulate
+    warmup: the number of first weeks to leave out
+    output:
+    summary: an ordered dict with the hit rate, the byte hit rate, the bytes moved after the first summed week, the bytes of the first placement, the mean delay of an access and the number of saturated site-weeks
+    '''
+
+    initial = weekly['bytes_moved'].values[0] if len(weekly) else 0
+    weekly = weekly.iloc[warmup:]
+    total = weekly['accesses'].sum()
+    return OrderedDict([('hit_rate', weekly['hits'].sum() / total if total else numpy.nan),
+                        ('byte_hit_rate', weekly['hit_bytes'].sum() / weekly['accessed_bytes'].sum() if total else numpy.nan),
+                        ('bytes_moved', weekly['bytes_moved'].values[1:].sum()),
+                        ('initial_bytes', initial),
+                        ('mean_delay_hours', weekly['delay'].sum() / total if total else numpy.nan),
+                        ('saturated_site_weeks', weekly['saturated_sites'].sum())])
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='''Replays the weekly dataset access series against replica placement policies, and reports the hit rate, the bytes moved and the queueing delay of each policy, capacity and replica count.
+Policies: lru (most recently accessed first), static (most accessed in the --warmup first weeks, never changes), predicted (model.py prediction files in --pred-dir),
+lags (conference counts shifted by the best lag of each dataset, from --lags and --inconf).
+
+Example:
+simulate.py --inmatrix datasets/time_series_matrix.npz --sizes datasets/dataframe-20150301-20150307.csv.gz --policies lru,static --capacity 0.05,0.1 --replicas 1,2 --outfile simulation.csv
+simulate.py --inmatrix datasets/time_series_matrix.npz --policies lags --lags max_crosscorr_lags.csv.gz --inconf cms_conf_ct_perweek.csv.gz --outfile simulation.csv
+''', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--inmatrix', dest='inmatrix', help='a .npz file for the matrix of dataset access series on the global week grid, written by time_series.py')
+    parser.add_argument('--sizes', dest='sizes', default='', help='an optional csv(.gz) file with dataset, dbs and size columns; datasets missing from it get the median size; all sizes are 1 without it')
+    parser.add_argument('--policies', dest='policies', default='lru,static', help='a comma separated list of policies: lru, static, predicted, lags, default lru,static')
+    parser.add_argument('--pred-dir', dest='pred_dir', default='', help='a dir of weekly prediction files for the predicted policy')
+    parser.add_argument('--lags', dest='lags', default='', help='the csv.gz file of the best lag of each dataset, written by time_series.py, for the lags policy')
+    parser.add_argument('--inconf', dest='inconf', default='', help='a csv.gz file for the conference count per week data, for the lags policy')
+    parser.add_argument('--warmup', dest='warmup', type=int, default=4, help='the number of first weeks which fix the static placement; they are left out of the summary of every policy, default 4')
+    parser.add_argument('--capacity', dest='capacity', default='0.1', help='a comma separated list of total capacities, as fractions of the total size of all datasets, default 0.1')
+    parser.add_argument('--replicas', dest='replicas', default='1', help='a comma separated list of replica counts, default 1')
+    parser.add_argument('--sites', dest='sites', default='1,1,1,1,1,1,1,1,1,1', help='a comma separated list of the relative capacities of the sites, default 10 equal sites')
+    parser.add_argument('--service-rate', dest='service_rate', type=float, default=1000., help='the number of accesses a site serves per week, default 1000')
+    parser.add_argument('--remote-delay', dest='remote_delay', type=float, default=24., help='the delay in hours of an access which is not served by a site, default 24')
+    parser.add_argument('--outfile', dest='outfile', default='simulation.csv', help='the output csv file with a row for each policy, capacity and replica count')
+    parser.add_argument('--weekly-file', dest='weekly_file', default='', help='an optional output csv file with the metrics of each week of each replay')
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    start_profiler(args.profile, args.profile_hot)
+
+    # 1. read in the access series and the sizes of the datasets
+    with span('read', file=os.path.basename(args.inmatrix)) as rec:
+        matrix = load_access_matrix(args.inmatrix)
+        rec['rows'] = len(matrix['dataset'])
+    naccess = matrix['naccess'].astype(numpy.float64)
+    grid = matrix['week']
+    keys = pair_key(matrix['dataset'].astype(numpy.int64), matrix['dbs'].astype(numpy.int64))
+    sizes = numpy.ones(len(keys))
+    if args.sizes:
+        df = read_csv(args.sizes, usecols=['dataset', 'dbs', 'size'])
+        index = sorted_join(keys, pair_key(df['dataset'].values, df['dbs'].values))
+        known = index >= 0
+        sizes[known] = df['size'].values[index[known]]
+        # a size of 1 next to sizes of GBs would skew the byte metrics
+        if known.any():
+            sizes[~known] = numpy.median(sizes[known])
+        print 'nb of datasets:', len(keys), ', with sizes:', known.sum(), ', with the median size:', (~known).sum()
+    site_weights = numpy.array([float(w) for w in args.sites.split(',')])
+
+    # 2. the score matrix of each policy
+    policy_scores = OrderedDict()
+    for policy in args.policies.split(','):
+        if policy == 'lru':
+            policy_scores[policy] = lru_scores(naccess)
+        elif policy == 'static':
+            policy_scores[policy] = static_scores(naccess, args.warmup)
+        elif policy == 'predicted':
+            policy_scores[policy] = prediction_scores(keys, grid, args.pred_dir)
+        elif policy == 'lags':
+            calendar = get_calendar()
+            csvfile = open_read(args.inconf)
+            confct = dict((calendar.ordinal(dct['tstamp']), float(dct['confct'])) for dct in csv.DictReader(csvfile))
+            csvfile.close()
+            confct = numpy.array([confct.get(week, 0.) for week in range(grid[0], max(max(confct.keys()) + 1, grid[-1] + 1))])
+            policy_scores[policy] = lag_scores(keys, grid, confct, args.lags)
+        else:
+            raise Exception('Unknown policy %s' % policy)
+
+    # 3. replay every policy, capacity and replica count, scored after the warmup weeks
+    if args.warmup >= len(grid):
+        raise Exception('--warmup %s leaves no week to score out of %s' % (args.warmup, len(grid)))
+    rows = []
+    weekly_tables = []
+    for (policy, scores), capacity, replicas in itertools.product(policy_scores.items(),
+                                                                   [float(c) for c in args.capacity.split(',')],
+                                                                   [int(r) for r in args.replicas.split(',')]):
+        with span('simulate', policy=policy, capacity=capacity, replicas=replicas, rows=naccess.size):
+            weekly = simulate(naccess, sizes, scores, capacity * sizes.sum(), replicas, site_weights, args.service_rate, args.remote_delay)
+        row = OrderedDict([('policy', policy), ('capacity', capacity), ('replicas', replicas)])
+        row.update(summarize(weekly, args.warmup))
+        rows.append(row)
+        if args.weekly_file:
+            weekly.insert(0, 'replicas', replicas)
+            weekly.insert(0, 'capacity', capacity)
+            weekly.insert(0, 'policy', policy)
+            weekly['week'] = get_calendar().to_windows(grid[weekly['week'].values])
+            weekly_tables.append(weekly)
+    summary = pandas.DataFrame(rows)
+    summary.to_csv(args.outfile, index=False)
+    print summary.to_string(index=False)
+    if args.weekly_file:
+        pandas.concat(weekly_tables).to_csv(args.weekly_file, index=False)
+
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Author     : Ting Li <liting0612 At gmail dot com>
+Description: Generates seeded synthetic input data of every pipeline stage: a conference data dump in the multi-line record format of the conference database, weekly dataset access files, and train and test sets for model.py.
+"""
+
+import os
+import gzip
+import json
+import argparse
+from collections import OrderedDict
+import numpy
+import pandas
+from week_calendar import get_calendar, mine_to_gregorian
+from instrument import span, start_profiler, add_profile_arguments
+
+MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+CATEGORIES = ['CONF', 'WORKSHOP', 'SCHOOL', 'MEETING']
+COUNTRIES = ['Switzerland', 'USA', 'Italy', 'Germany', 'France', 'Japan', 'China', 'Brazil']
+
+SCHEMA = '''CONF_ID                        NOT NULL NUMBER
+PRES_ID                        NOT NULL NUMBER
+CONF_NAME                               VARCHAR2(1024)
+CONF_NAME_SHORT                         VARCHAR2(100)
+CONF_START                              DATE
+CONF_CATEGORY                           VARCHAR2(8)
+CONF_DESCRIPTION_CATEGORY               VARCHAR2(1024)
+CONF_CITY                               VARCHAR2(1024)
+COUNTRY                                 VARCHAR2(1024)
+CONF_WEB                                VARCHAR2(1024)
+PRES_TITLE                              VARCHAR2(1024)
+PRES_CATEGORY                           VARCHAR2(8)
+PRES_DESCRIPTION_CATEGORY               VARCHAR2(1024)
+'''
+
+
+def conference_counts(rng, nweeks, rate):
+    ''' Draw the number of conferences of each week, with a yearly seasonality (fewer conferences in the summer and winter breaks)
+    input:
+    rng: a numpy RandomState
+    nweeks: the number of weeks
+    rate: the mean number of conferences per week
+    output:
+    confct: an array of the number of conferences of each week
+    '''
+
+    season = 1 + 0.5 * numpy.cos(2 * numpy.pi * (numpy.arange(nweeks) % 52) / 26.)
+    return rng.poisson(rate * season)
+
+
+def write_conf_dump(rng, filename, first, confct):
+    ''' Write a conference data dump, one multi-line record per presentation, in the format parsed by cms_conf_parser.parse_dataframe_by_match_record
+    input:
+    rng: a numpy RandomState
+    filename: the output csv.gz file
+    first: the week ordinal of the first week of confct
+    confct: the number of conferences of each week
+    output:
+    nrecords: the number of records written
+    '''
+
+    calendar = get_calendar()
+    csvfile = gzip.open(filename, 'w')
+    conf_id = 0
+    pres_id = 0
+    for week in range(0, len(confct)):
+        year, wk = calendar.yearweek(first + week)
+        for c in range(0, confct[week]):
+            conf_id += 1
+            date = mine_to_gregorian(year, wk, rng.randint(1, 8))
+            start = '%02d-%s-%02d' % (date.day, MONTHS[date.month - 1], date.year % 100)
+            category = CATEGORIES[rng.randint(len(CATEGORIES))]
+            country = COUNTRIES[rng.randint(len(COUNTRIES))]
+            for p in range(0, rng.randint(1, 6)):
+                pres_id += 1
+                lines = ['%10d,%10d' % (conf_id, pres_id),
+                         'Synthetic Conference %d on High Energy Physics' % conf_id,
+                         ('SC%d' % conf_id).ljust(100) + ',' + start + ',' + category,
+                         '%s description' % category.capitalize(),
+                         'City %d' % rng.randint(100),
+                         country,
+                         'http://conf%d.example.org' % conf_id]
+                # titles may span several lines, each longer than a category field
+                lines += ['Presentation %d of conference %d, part %d' % (pres_id, conf_id, i) for i in range(0, rng.randint(1, 3))]
+                lines += ['TALK', 'Talk']
+                csvfile.write('\n'.join(lines) + '\n')
+    csvfile.close()
+    return pres_id
+
+
+def access_frames(rng, first, confct, ndatasets, nweeks, ncols, sparsity):
+    ''' Draw weekly dataset access records, whose access counts follow the conference counts with a per-dataset lag and sensitivity
+    input:
+    rng: a numpy RandomState
+    first: the week ordinal of the first week
+    confct: the number of conferences of each week, longer than nweeks by the largest lag
+    ndatasets: the number of datasets
+    nweeks: the number of weeks
+    ncols: the number of extra integer columns rel_0, rel_1, ...
+    sparsity: the probability that a dataset has no record in a week, and that an extra column is 0
+    output:
+    a generator of (week ordinal, data frame) for each week
+    '''
+
+    base = rng.lognormal(1.5, 1., ndatasets)
+    lag = rng.randint(0, 5, ndatasets)
+    alpha = rng.uniform(0, 2, ndatasets)
+    birth = rng.randint(0, max(nweeks // 2, 1), ndatasets)
+    size = rng.lognormal(20, 2, ndatasets).astype(numpy.int64)
+    tier = rng.randint(0, 10, ndatasets)
+    era = rng.randint(0, 30, ndatasets)
+    mean_conf = max(confct.mean(), 1)
+    for week in range(0, nweeks):
+        rows = numpy.where((birth <= week) & (rng.rand(ndatasets) >= sparsity))[0]
+        rate = base[rows] * (1 + alpha[rows] * confct[week + lag[rows]] / mean_conf)
+        naccess = rng.poisson(rate)
+        df = pandas.DataFrame(OrderedDict([('id', numpy.arange(len(rows))), ('dataset', rows), ('dbs', rows % 3),
+                                           ('era', era[rows]), ('tier', tier[rows]), ('size', size[rows]),
+                                           ('naccess', naccess), ('nusers', rng.binomial(naccess, 0.3)),
+                                           ('nsites', rng.randint(1, 20, len(rows)))]))
+        for i in range(0, ncols):
+            df['rel_%d' % i] = numpy.where(rng.rand(len(rows)) >= sparsity, rng.poisson(5, len(rows)), 0)
+        yield first + week, df
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='''Generates seeded synthetic input data of every pipeline stage.
+Output files in outdir:
+schema: the schema of the conference data dump
+cms_conf.csv.gz: the conference data dump
+dataframes/dataframe-YYYYMMDD-YYYYMMDD.csv.gz: the weekly dataset access files
+model/train.csv.gz, model/test.csv.gz: the records of two consecutive weeks, with a target column which is 1 if the dataset is accessed in the week after
+manifest.json: the parameters and the numbers of generated records
+
+Example:
+synth.py --outdir synthetic --datasets 1000 --weeks 156 --cols 10 --sparsity 0.3 --seed 12345
+''', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--outdir', dest='outdir', help='a dir for the output files')
+    parser.add_argument('--datasets', dest='datasets', type=int, default=1000, help='the number of datasets, default 1000')
+    parser.add_argument('--weeks', dest='weeks', type=int, default=156, help='the number of weeks, default 156')
+    parser.add_argument('--start', dest='start', default='2013,1', help='the year and week of the first week, default 2013,1')
+    parser.add_argument('--cols', dest='cols', type=int, default=0, help='the number of extra integer columns of the access files, default 0')
+    parser.add_argument('--sparsity', dest='sparsity', type=float, default=0.2, help='the probability that a dataset has no record in a week, and that an extra column is 0, default 0.2')
+    parser.add_argument('--conf-rate', dest='conf_rate', type=float, default=3., help='the mean number of conferences per week, default 3')
+    parser.add_argument('--seed', dest='seed', type=int, default=12345, help='the seed of the random generator, default 12345')
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+    start_profiler(args.profile, args.profile_hot)
+
+    rng = numpy.random.RandomState(args.seed)
+    calendar = get_calendar()
+    year, week = [int(v) for v in args.start.split(',')]
+    first = calendar.yearweek_ordinal(year, week)
+    for sub in ['dataframes', 'model']:
+        if not os.path.exists(os.path.join(args.outdir, sub)):
+            os.makedirs(os.path.join(args.outdir, sub))
+
+    # 1. the conference dump, with conferences beyond the last week for the lags of the access counts
+    confct = conference_counts(rng, args.weeks + 8, args.conf_rate)
+    with open(os.path.join(args.outdir, 'schema'), 'w') as schema:
+        schema.write(SCHEMA)
+    with span('conf_dump') as rec:
+        nrecords = write_conf_dump(rng, os.path.join(args.outdir, 'cms_conf.csv.gz'), first, confct)
+        rec['rows'] = nrecords
+
+    # 2. the weekly access files, and a train and a test set from the last weeks
+    nrows = 0
+    ml_weeks = [max(args.weeks - 3, 0) + i for i in range(0, 3)]
+    frames = {}
+    for ordinal, df in access_frames(rng, first, confct, args.datasets, args.weeks, args.cols, args.sparsity):
+        with span('write', merge=True, rows=len(df)):
+            df.to_csv(os.path.join(args.outdir, 'dataframes', 'dataframe-%s.csv.gz' % calendar.window(ordinal)), index=False, compression='gzip')
+        nrows += len(df)
+        if ordinal - first in ml_weeks:
+            frames[ordinal - first] = df
+    nml = {}
+    for name, week in [('train', ml_weeks[0]), ('test', ml_weeks[1])]:
+        if week not in frames or week + 1 not in frames:
+            continue
+        df = frames[week].copy()
+        accessed = frames[week + 1]['dataset'].values[frames[week + 1]['naccess'].values > 0]
+        df['target'] = numpy.in1d(df['dataset'].values, accessed).astype(numpy.int64)
+        df.to_csv(os.path.join(args.outdir, 'model', '%s.csv.gz' % name), index=False, compression='gzip')
+        nml[name] = len(df)
+
+    manifest = OrderedDict([('seed', args.seed), ('datasets', args.datasets), ('weeks', args.weeks), ('cols', args.cols),
+                            ('sparsity', args.sparsity), ('conf_records', nrecords), ('access_rows', nrows),
+                            ('train_rows', nml.get('train', 0)), ('test_rows', nml.get('test', 0))])
+    with open(os.path.join(args.outdir, 'manifest.json'), 'w') as ostream:
+        json.dump(manifest, ostream, indent=2)
+    print 'conference records:', nrecords, ', access records:', nrows, ', train/test records:', nml.get('train', 0), nml.get('test', 0)
+
+if __name__ == '__main__':
+
+    main()
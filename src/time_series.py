@@ -8,15 +8,18 @@ Description: Generates time series for each dataset from the dataset access data
 import os
 import re
 import csv
-import gzip
 import argparse
-import glob
 import datetime
 import math
 import numpy
 from scipy.stats.stats import pearsonr
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_pdf import PdfPages
+from access_matrix import build_access_matrix, save_access_matrix
+from week_calendar import get_calendar
+from instrument import span, start_profiler, add_profile_arguments
+from fileio import open_read, open_write, with_codec_extension, data_files, add_codec_arguments
+from colstore import ColumnStore, is_store, to_text
 
 
 def crosscorr(lst1, lst2, index_match, lags):
@@ -54,6 +57,82 @@ def crosscorr(lst1, lst2, index_match, lags):
     return cc
 
 
+def rolling_crosscorr(naccess, confct, starts, lengths, lags, window, step, block=256):
+    ''' Compute cross correlations between each dataset access series and the conference count series, over windows of weeks sliding along the global week grid, at each lag in lags.
+    The windowed sums are differences of prefix sums over the week axis, so moving a window forward costs O(1) instead of O(window), and they are vectorized over lags and over a block of datasets.
+    The series are centered before the prefix sums, and a variance within the rounding error of the prefix sums counts as 0, so that a constant window gives nan rather than a correlation of rounding errors.
+    input:
+    naccess: a 2d array, with a row for each dataset access series and a column for each week of the conference count series
+    confct: the conference count series, as a list
+    starts, lengths: the first column and the number of weeks of each dataset in naccess
+    lags: the range of lags, as a list
+    window: the length of a window in weeks, as an integer
+    step: the number of weeks a window moves forward each time, as an integer
+    block: the number of datasets processed at once, as an integer
+    output:
+    cc: a 3d array of float32 of shape (nb of datasets, nb of windows, nb of lags), nan where a window is not within the lifetime of a dataset or either series is constant in the window
+    wstarts: the column of the first week of each window, as an array of integers
+    '''
+
+    naccess = numpy.asarray(naccess, dtype=numpy.float64)
+    confct = numpy.asarray(confct, dtype=numpy.float64)
+    lags = numpy.asarray(lags)
+    nweeks = len(confct)
+    # the relative rounding error of a variance computed from prefix sums
+    tol = 64 * numpy.finfo(numpy.float64).eps
+    wstarts = numpy.arange(0, nweeks - window + 1, step)
+    wends = wstarts + window
+
+    # (1) the conference count series shifted by each lag, padded with 0 outside the series, as a (week, lag) matrix
+    index = numpy.arange(nweeks)[:, None] + lags[None, :]
+    valid = (index >= 0) & (index < nweeks)
+    shifted = numpy.where(valid, confct[numpy.clip(index, 0, nweeks - 1)], 0)
+    # a correlation does not change when a series is shifted by a constant, so the series is centered to keep the prefix sums small
+    if nweeks:
+        shifted -= confct.mean()
+
+    # (2) windowed sums of the shifted conference series, as (window, lag) matrices
+    def windowed(prefix):
+        return prefix[wends] - prefix[wstarts]
+    zeros = numpy.zeros((1, len(lags)))
+    sy = windowed(numpy.concatenate([zeros, numpy.cumsum(shifted, axis=0)]))
+    cyy = numpy.concatenate([zeros, numpy.cumsum(shifted ** 2, axis=0)])
+    syy = windowed(cyy)
+    vary = window * syy - sy ** 2
+    vary[vary <= tol * window * cyy[wends]] = 0
+
+    # (3) windowed sums of each dataset series and of its products with the shifted conference series, block by block of datasets
+    cc = numpy.empty((naccess.shape[0], len(wstarts), len(lags)), dtype=numpy.float32)
+    for begin in range(0, naccess.shape[0], block):
+        first = numpy.asarray(starts[begin:begin + block])
+        last = first + numpy.asarray(lengths[begin:begin + block])
+        # each dataset is centered on its mean over its lifetime, the weeks outside of it are masked below
+        x = naccess[begin:begin + block]
+        life = (numpy.arange(nweeks)[None, :] >= first[:, None]) & (numpy.arange(nweeks)[None, :] < last[:, None])
+        x = numpy.where(life, x - x.sum(axis=1, keepdims=True) / numpy.maximum(last - first, 1)[:, None], 0)
+        pad = numpy.zeros((x.shape[0], 1))
+        sx = windowed(numpy.concatenate([pad, numpy.cumsum(x, axis=1)], axis=1).T).T
+        cxx = numpy.concatenate([pad, numpy.cumsum(x ** 2, axis=1)], axis=1)
+        sxx = windowed(cxx.T).T
+        prod = numpy.cumsum(x[:, :, None] * shifted[None, :, :], axis=1)
+        prod = numpy.concatenate([numpy.zeros((x.shape[0], 1, len(lags))), prod], axis=1)
+        sxy = prod[:, wends, :] - prod[:, wstarts, :]
+
+        varx = window * sxx - sx ** 2
+        varx[varx <= tol * window * cxx[:, wends]] = 0
+        cov = window * sxy - sx[:, :, None] * sy[None, :, :]
+        denom = varx[:, :, None] * vary[None, :, :]
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            corr = numpy.where(denom > 0, cov / numpy.sqrt(numpy.where(denom > 0, denom, 1)), numpy.nan)
+
+        # (4) mask the windows outside the lifetime of each dataset
+        inside = (wstarts[None, :] >= first[:, None]) & (wends[None, :] <= last[:, None])
+        corr[~inside] = numpy.nan
+        cc[begin:begin + block] = corr
+
+    return cc, wstarts
+
+
 def fft_half_spectrum(signal):
     ''' Computer DFT of a time series signal in the positive half frequency range, by FFT
     Input:
@@ -75,9 +154,9 @@ def fft_half_spectrum(signal):
 def group_by_dataset_and_extract_access (dct_lst):
     ''' Convert a list of dicts (each for records), into a list of dicts (each for a dataset). In the output list of dicts, the dicts are sorted by dataset length, and the value of each key in each datset's dict is sorted by timestamp.
     input:
-    dct_lst: a list of dicts, each dict for a record
+    dct_lst: a list of dicts, each dict for a record, with the week ordinal of the record as 'tstamp'
     output:
-    lst_dataset_week_naccess: a list of dicts, each dict for a dataset and with keys 'dataset_dbs', 'length', 'tstamp', and 'naccess'
+    lst_dataset_week_naccess: a list of dicts, each dict for a dataset and with keys 'dataset_dbs', 'length', 'tstamp' (as week ordinals), and 'naccess'
     '''
 
     # (a) group the records by [dataset, dbs], 
@@ -89,55 +168,209 @@ def group_by_dataset_and_extract_access (dct_lst):
         else:
             dct_dataset[(dct['dataset'],dct['dbs'])] = [dct]
 
-    # (b) sort the datasets by their lengths, and sort the records of each dataset by timestamp
+    # (b) sort the datasets by their lengths, and sort the records of each dataset by the week ordinals of their time stamps
 
     # convert from dict to a list of lists (each for a dataset) of records (as dicts), and sort datasets by length of records i.e. dcts
     lst_dataset = dct_dataset.values()
-    def mycmp1(lst1, lst2):
-        if len(lst1) > len(lst2):
-            return -1
-        elif len(lst1) < len(lst2):
-            return 1
-        else:
-            return 0
-    lst_dataset_sorted = sorted(lst_dataset, cmp=mycmp1)
+    lst_dataset_sorted = sorted(lst_dataset, key=len, reverse=True)
 
-    # for each dataset, sort its records i.e. dcts, by their time stamps
-    def mycmp2(dct1, dct2):
-        if int(dct1['tstamp'][0:7]) > int(dct2['tstamp'][0:7]):
-            return 1
-        if int(dct1['tstamp'][0:7]) < int(dct2['tstamp'][0:7]):
-            return -1
-        else:
-            return 0
-    tmp = [sorted(lst,cmp=mycmp2) for lst in lst_dataset_sorted]
-    lst_dataset_sorted = tmp
+    # for each dataset, sort its records i.e. dcts, by their week ordinals
+    lst_dataset_sorted = [sorted(lst, key=lambda dct: dct['tstamp']) for lst in lst_dataset_sorted]
 
 
     # (c) for each dataset (dataset,dbs), extract from each record only naccess and tstamp and ignore other attributes, and add missing weeks with naccess value 0
+    # the weeks of a dataset are consecutive week ordinals from its first to its last record
     lst_dataset_week_naccess = []
     for lst in lst_dataset_sorted:
         dct={}
         dct['dataset_dbs'] = (lst[0]['dataset'], lst[0]['dbs'])
-        dct['tstamp'] = []
-        dct['naccess'] = []
         dct['length'] = len(lst)
-        for i in range(0, len(lst)):
-            dct['tstamp'].append(lst[i]['tstamp'])
-            dct['naccess'].append(float(lst[i]['naccess']))
-            # add missing weeks with naccess value 0
-            if i != len(lst)-1:
-                date1 = datetime.date(int(lst[i]['tstamp'][-8:-4]), int(lst[i]['tstamp'][-4:-2]), int(lst[i]['tstamp'][-2:]))
-                date2 = datetime.date(int(lst[i+1]['tstamp'][0:4]), int(lst[i+1]['tstamp'][4:6]), int(lst[i+1]['tstamp'][6:8]))
-                while (date2 - date1).days > 1:
-                    dct['tstamp'].append('{0}-{1}'.format((date1+datetime.timedelta(days=1)).strftime('%Y%m%d'), (date1+datetime.timedelta(days=7)).strftime('%Y%m%d')))
-                    dct['naccess'].append(0)
-                    date1 = date1 + datetime.timedelta(days=7)
+        first = lst[0]['tstamp']
+        dct['tstamp'] = range(first, lst[-1]['tstamp'] + 1)
+        dct['naccess'] = [0] * len(dct['tstamp'])
+        for rec in lst:
+            dct['naccess'][rec['tstamp'] - first] = float(rec['naccess'])
         lst_dataset_week_naccess.append(dct)
 
     return lst_dataset_week_naccess
 
 
+def group_access_series(group_week_naccess):
+    ''' Convert the weekly access counts summed over the records with each value of some attributes, into a list of dicts (each for an attribute value), in the same format as the dicts for datasets.
+    input:
+    group_week_naccess: a dict with key being an attribute, and value being a dict with key being (attribute value, week ordinal) and value being the sum of naccess of the records with the attribute value in the week
+    output:
+    lst_group_week_naccess: a list of dicts, each dict for an attribute value and with keys 'dataset_dbs' (as (attribute, value)), 'length', 'tstamp' (as week ordinals), and 'naccess', sorted by attribute and value
+    '''
+
+    lst_group_week_naccess = []
+    for attr in sorted(group_week_naccess.keys()):
+        # the weeks with records for each value of the attribute
+        value_weeks = {}
+        for (value, week) in group_week_naccess[attr].keys():
+            value_weeks.setdefault(value, []).append(week)
+        for value in sorted(value_weeks.keys()):
+            weeks = sorted(value_weeks[value])
+            dct = {}
+            dct['dataset_dbs'] = (attr, value)
+            dct['length'] = len(weeks)
+            dct['tstamp'] = range(weeks[0], weeks[-1] + 1)
+            dct['naccess'] = [0] * len(dct['tstamp'])
+            for week in weeks:
+                dct['naccess'][week - weeks[0]] = group_week_naccess[attr][(value, week)]
+            lst_group_week_naccess.append(dct)
+    return lst_group_week_naccess
+
+
+def write_series(lst_week_naccess, filename, keys, codec=None, level=None, threads=0):
+    ''' write the time series of each dataset or group to a file
+    input:
+    lst_week_naccess: a list of dicts, each for a dataset or group and with keys 'dataset_dbs', 'tstamp' (as week ordinals) and 'naccess'
+    filename: output file
+    keys: the names of the two parts of 'dataset_dbs', such as ('dataset', 'dbs')
+    codec: the compression codec of the output file, None for that of its extension
+    level: the compression level, None for the default level of the codec
+    threads: the number of threads compressing a block gzip output, 0 for plain gzip
+    '''
+
+    calendar = get_calendar()
+    csvfile = open_write(filename, codec, level, threads)
+    # write header
+    csvfile.write('Number of (' + ','.join(keys) + ')\'s: ' + str(len(lst_week_naccess)) + '\n\n')
+    # write data
+    for dct in lst_week_naccess:
+        csvfile.write('Length: '  + str(len(dct['tstamp'])) + ' ' + keys[0] + ': ' + dct['dataset_dbs'][0] + ' ' + keys[1] + ': ' + dct['dataset_dbs'][1] + '\n')
+        csvfile.write('tstamp,naccess\n')
+        windows = calendar.to_windows(dct['tstamp'])
+        for i in range(0, len(dct['tstamp'])):
+            csvfile.write(windows[i] + ',' + str(dct['naccess'][i]) + '\n')
+        csvfile.write('\n')
+    csvfile.close()
+
+
+def crosscorr_and_plot(dct, inconf_dct, index_match, lags, title, filename):
+    ''' Compute the cross correlation between an access series and the conference count series, plot it together with the two series, and find the lag with the highest cross correlation
+    input:
+    dct: a dict for a dataset or group, with keys 'naccess'
+    inconf_dct: a dict with keys 'tstamp' and 'confct' for the conference count series
+    index_match: the position of the start of the access series in the conference count series, as an integer
+    lags: the range of lags, as a list
+    title: the title of the plot
+    filename: output file for the plot
+    output:
+    (lag, (crosscorr, p-value)) with the highest cross correlation; the cross correlations are also added to dct with key 'crosscorr'
+    '''
+
+    # (1) cross correlation over a range of lags wrt the match timestamp
+    with span('pearsonr', merge=True):
+        dct['crosscorr'] = crosscorr(dct['naccess'], inconf_dct['confct'], index_match, lags)
+
+
+    # (2) plot cross correlation versus lags, and save it (already done, run just once)
+    fig = plt.figure()
+
+    ax1 = fig.add_subplot(311)
+    # lags where the shifted conference series is constant have no cross correlation
+    plags = [lag for lag in lags if lag in dct['crosscorr']]
+    cc = [dct['crosscorr'][lag][0] for lag in plags]
+    ax1.bar(plags, cc, width=0.1, edgecolor='None',color='k',align='center')
+    ax1.grid(True)
+    ax1.axhline(0, color='black', lw=2)
+    ax1.set_xlabel('Lag')
+    ax1.set_ylabel('Cross Correlation')
+    ax1.set_title(title)
+
+    # plot the two time series as well
+
+    ax2 = fig.add_subplot(312)
+    ax2.plot(range(0, len(inconf_dct['confct'])), [0] * len(inconf_dct['confct']), 'k', range(index_match, index_match + len(dct['naccess'])), dct['naccess'], 'b', lw=1)
+    ax2.grid(True)
+    ax2.axhline(0, color='black', lw=2)
+    ax2.set_xlabel('Week')
+    ax2.set_ylabel('Dataset naccess')
+    
+    ax3 = fig.add_subplot(313)
+    ax3.plot(range(0, len(inconf_dct['confct'])), inconf_dct['confct'], 'r', lw=1)
+    ax3.grid(True)
+    ax3.axhline(0, color='black', lw=2)
+    ax3.set_xlabel('Week')
+    ax3.set_ylabel('Conference Count')
+
+    # plt.xlabel('Week')
+
+    with span('pdf', merge=True):
+        pp = PdfPages(filename)
+        pp.savefig(fig)
+        pp.close()
+        plt.close(fig)
+
+
+    # (3) find the lag with the hightest cross correlation
+    lst = dct['crosscorr'].items()
+    def mycmp3(lst1, lst2):
+        # if abs(lst1[1][0]) > abs( lst2[1][0]): 
+        if lst1[1][0] > lst2[1][0]:  # consider signed correlation, instead of its magnitude.
+            return 1
+        # elif abs(lst1[1][0]) < abs(lst2[1][0]):
+        elif lst1[1][0] < lst2[1][0]:
+            return -1
+        else:
+            return 0
+    tmp = sorted(lst, cmp = mycmp3)
+    return tmp[-1]
+
+
+def fft_and_plot(dct, title, filename):
+    ''' Compute the DFT of an access series by fft, and plot it together with the series
+    input:
+    dct: a dict for a dataset or group, with keys 'naccess'
+    title: the title of the plot
+    filename: output file for the plot
+    '''
+
+    signal = dct['naccess']
+    with span('fft', merge=True):
+        [mgft, freqs] = fft_half_spectrum(signal)
+
+    fig = plt.figure()
+
+    ax1 = fig.add_subplot(211)
+    ax1.bar(freqs, mgft, width=0.001, edgecolor='None',color='k',align='center')
+    ax1.set_ylabel('DFT')
+    ax1.set_xlabel('Frequency')
+    ax1.set_title(title)
+
+    # plot the two time series as well
+    ax2 = fig.add_subplot(212)
+    ax2.plot(range(0, len(dct['naccess'])), dct['naccess'], 'b', lw=1)
+    ax2.set_xlabel('Week')
+    ax2.set_ylabel('Dataset naccess')
+
+    with span('pdf', merge=True):
+        pp = PdfPages(filename)
+        pp.savefig(fig)
+        pp.close()
+        plt.close(fig)
+
+
+def write_max_crosscorr(max_crosscorr, filename, keys, codec=None, level=None, threads=0):
+    ''' write the lag with the highest cross correlation of each dataset or group to a file
+    input:
+    max_crosscorr: a list of ((dataset, dbs), (lag, (crosscorr, p-value)))
+    filename: output file
+    keys: the names of the two parts of (dataset, dbs), such as ('dataset', 'dbs')
+    codec: the compression codec of the output file, None for that of its extension
+    level: the compression level, None for the default level of the codec
+    threads: the number of threads compressing a block gzip output, 0 for plain gzip
+    '''
+
+    csvfile = open_write(filename, codec, level, threads)
+    csvfile.write(','.join(keys) + ',lag,crosscorr,pvalue\n')
+    for (key, (lag, (cc, pvalue))) in max_crosscorr:
+        csvfile.write('{0},{1},{2},{3},{4}\n'.format(key[0], key[1], lag, cc, pvalue))
+    csvfile.close()
+
+
 
 def main():
 
@@ -145,61 +378,81 @@ def main():
 
 Example:
 time_series.py --indir original      --inconf cms_conf_ct_perweek.csv.gz   --outdir datasets
+time_series.py --indir original      --inconf cms_conf_ct_perweek.csv.gz   --outdir datasets --window 26 --step 1
+time_series.py --indir original      --inconf cms_conf_ct_perweek.csv.gz   --outdir datasets --group-by tier,dbs
 ''', formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument('--indir', dest='indir', help='a dir containing csv.gz files for the input dataset access data')
+    parser.add_argument('--indir', dest='indir', help='a dir containing csv.gz files for the input dataset access data, or a columnar store of them made by colstore.py')
     parser.add_argument('--inconf', dest='inconf', help='a csv.gz file for the input conference count data')
     parser.add_argument('--outdir', dest='outdir', help='a dir containing csv.gz files for the output time series of each dataset, and image files for the plots of cross correlation and FFT of the time series')
+    parser.add_argument('--window', dest='window', type=int, default=0, help='the length in weeks of the sliding windows for the rolling cross correlation, which is skipped if 0 (default)')
+    parser.add_argument('--step', dest='step', type=int, default=1, help='the number of weeks a sliding window moves forward each time, default 1')
+    parser.add_argument('--group-by', dest='group_by', default='', help='''a comma separated list of attributes, such as tier,dbs; for each value of each attribute, the access counts of its records are summed into a weekly series,
+which is analyzed as the series of a dataset''')
+    add_profile_arguments(parser)
+    add_codec_arguments(parser)
     args = parser.parse_args()
+    start_profiler(args.profile, args.profile_hot)
 
 ######################
 ######## 1. read in dataset access records, and group them by dataset and extract only access and timestamp info.
 
-    # (1) read all dataframe files into a list of dicts, each dict for a record (i.e. a row in a dataframe file)
+    # (1) read all dataframe files into a list of dicts, each dict for a record (i.e. a row in a dataframe file) with only its dataset, dbs, naccess and tstamp,
+    # and in the same pass, sum naccess per week over the records with each value of the group-by attributes
+    calendar = get_calendar()
+    group_by = [attr for attr in args.group_by.split(',') if attr]
+    group_week_naccess = dict((attr, {}) for attr in group_by)
     dct_lst = []
-    header = False
-    dsfilenames = glob.glob(args.indir + '/dataframe*')
+    dsfilenames = [] if is_store(args.indir) else data_files(args.indir + '/dataframe*')
+
+    # from a columnar store, only the columns used here are read, one week partition at a time
+    if is_store(args.indir):
+        store = ColumnStore(args.indir)
+        for part in store.catalog['partitions']:
+            tstamp = calendar.ordinal(part['window'])
+            with span('read', file=part['source'], rows=part['rows']):
+                data = store.read_partition(part, ['dataset', 'dbs', 'naccess'] + group_by)
+                texts = dict((col, to_text(values)) for col, values in data.items())
+                for dataset, dbs, naccess in zip(texts['dataset'], texts['dbs'], texts['naccess']):
+                    dct_lst.append({'dataset': dataset, 'dbs': dbs, 'naccess': naccess, 'tstamp': tstamp})
+                for attr in group_by:
+                    sums = group_week_naccess[attr]
+                    for value, naccess in zip(texts[attr], data['naccess'].tolist()):
+                        key = (value, tstamp)
+                        sums[key] = sums.get(key, 0.) + float(naccess)
+
     for filename in  dsfilenames:
 
         # print filename
 
-        # read the header of dataset access file into a list
-        if header == False:
-            csvfile = gzip.open(filename)
-            attrs = csvfile.readline().rstrip('\n').split(',') # a list of attribute names
-            csvfile.close()        
-            attrs.append('tstamp')
-            header = True
-        
-        # read the dataset access file:
-        csvfile = gzip.open(filename)
-        reader = csv.DictReader(csvfile)
-        indir_lst= list(reader) # a list of dicts, each for a row in the csv file
-        csvfile.close()
-
-        # add a tstamp attribute to each dict in the list
-        tstamp = re.search('\d{8}-\d{8}', filename).group()
-        for dct in indir_lst:
-            dct.update({'tstamp': tstamp})
-
-        dct_lst = dct_lst + indir_lst    
-
+        # the week ordinal of the file, as the tstamp attribute of its records
+        tstamp = calendar.filename_ordinal(filename)
 
-    # (2) group them by dataset and extract only access and timestamp info.
-    lst_dataset_week_naccess = group_by_dataset_and_extract_access (dct_lst)
-
-
-    # (3) write time series of each dataset to a file
-    csvfile = gzip.open(args.outdir + '/time_series_per_dataset.csv.gz', 'w')
-    # write header
-    csvfile.write('Number of (dataset,dbs)\'s: ' + str(len(lst_dataset_week_naccess)) + '\n\n')    
-    # write data
-    for dct in lst_dataset_week_naccess:
-        csvfile.write('Length: '  + str(len(dct['tstamp'])) + ' dataset: ' + dct['dataset_dbs'][0] + ' dbs: ' + dct['dataset_dbs'][1] + '\n')
-        csvfile.write('tstamp,naccess\n')
-        for i in range(0, len(dct['tstamp'])):
-            csvfile.write(dct['tstamp'][i] + ',' + str(dct['naccess'][i]) + '\n')
-        csvfile.write('\n')
-    csvfile.close()
+        # read the dataset access file:
+        with span('read', file=os.path.basename(filename)) as rec:
+            nrows = len(dct_lst)
+            csvfile = open_read(filename, args.threads)
+            reader = csv.DictReader(csvfile)
+            for row in reader:
+                dct_lst.append({'dataset': row['dataset'], 'dbs': row['dbs'], 'naccess': row['naccess'], 'tstamp': tstamp})
+                for attr in group_by:
+                    sums = group_week_naccess[attr]
+                    key = (row[attr], tstamp)
+                    sums[key] = sums.get(key, 0.) + float(row['naccess'])
+            csvfile.close()
+            rec['rows'] = len(dct_lst) - nrows
+
+
+    # (2) group them by dataset and extract only access and timestamp info, and convert the sums of each attribute value to a series.
+    with span('group', rows=len(dct_lst)):
+        lst_dataset_week_naccess = group_by_dataset_and_extract_access (dct_lst)
+        lst_group_week_naccess = group_access_series(group_week_naccess)
+
+
+    # (3) write time series of each dataset and of each attribute value to files
+    with span('write_series', rows=len(lst_dataset_week_naccess) + len(lst_group_week_naccess)):
+        write_series(lst_dataset_week_naccess, with_codec_extension(args.outdir + '/time_series_per_dataset.csv.gz', args.codec), ('dataset', 'dbs'), args.codec, args.level, args.threads)
+        if group_by:
+            write_series(lst_group_week_naccess, with_codec_extension(args.outdir + '/time_series_per_group.csv.gz', args.codec), ('attr', 'value'), args.codec, args.level, args.threads)
             
 
     # (4) The number of records, access count mean, and access count standard deviation of each dataset, and their statistics over all the datasets
@@ -285,14 +538,29 @@ time_series.py --indir original      --inconf cms_conf_ct_perweek.csv.gz   --out
 ################
 ########### 2. read in the conference count series
 
-    csvfile = gzip.open(args.inconf)
+    csvfile = open_read(args.inconf)
     reader = csv.DictReader(csvfile)
     inconf_lst= list(reader)  # a list of dicts, each for a row in the csv file
-    # convert the list of dicts to a dict with tstamp and confct being the key
+    # convert the list of dicts to a dict with tstamp (as week ordinals) and confct being the key
     inconf_dct = {'tstamp':[], 'confct':[]}
-    inconf_dct['tstamp'] = [dct['tstamp'] for dct in inconf_lst]
+    inconf_dct['tstamp'] = calendar.ordinals(dct['tstamp'] for dct in inconf_lst)
     inconf_dct['confct'] = [float(dct['confct']) for dct in inconf_lst]
     csvfile.close()
+    # the position of each week ordinal in the conference count series, -1 for weeks not in the series
+    conf_index = numpy.full(len(calendar), -1, dtype=numpy.int32)
+    conf_index[inconf_dct['tstamp']] = numpy.arange(len(inconf_dct['tstamp']))
+
+
+    # place all the dataset access series on the week grid of the conference count series, and save them as a matrix
+    # a dataset starting before the conference count series is clipped to the grid, one starting after it is left out of the grid
+    first_conf = inconf_dct['tstamp'][0]
+    offsets = [conf_index[dct['tstamp'][0]] for dct in lst_dataset_week_naccess]
+    offsets = [offset if offset >= 0 else dct['tstamp'][0] - first_conf if dct['tstamp'][0] < first_conf else len(inconf_dct['tstamp'])
+               for offset, dct in zip(offsets, lst_dataset_week_naccess)]
+    naccess, starts, lengths = build_access_matrix(lst_dataset_week_naccess, offsets, len(inconf_dct['tstamp']))
+    save_access_matrix(args.outdir + '/time_series_matrix.npz', naccess, inconf_dct['tstamp'],
+                       [dct['dataset_dbs'][0] for dct in lst_dataset_week_naccess],
+                       [dct['dataset_dbs'][1] for dct in lst_dataset_week_naccess], starts, lengths)
 
 
 ######################
@@ -303,66 +571,45 @@ time_series.py --indir original      --inconf cms_conf_ct_perweek.csv.gz   --out
     
     lags = range(-90,90)
     max_crosscorr = [] # (lag, (crosscorr, p-value))
+    dataset_max_crosscorr = [] # ((dataset, dbs), (lag, (crosscorr, p-value)))
     for i in range(0, len(lst_dataset_week_naccess)): # lst_dataset_week_naccess is a list of dicts, each for a dataset
         dct = lst_dataset_week_naccess[i]
 
         if dct['length'] < 10 or numpy.var(dct['naccess']) == 0: # only consider datasets with more than 10 records, to correlate with conference count series, and which has nonzero variance in naccess
             continue
 
-        # (1) match the dataset access series to the conference count series, by timestamp of the start of the dataset access series
-        index_match = inconf_dct['tstamp'].index(dct['tstamp'][0])
-        # cross correlation over a range of lags wrt the match timestamp
-        dct['crosscorr'] = crosscorr(dct['naccess'], inconf_dct['confct'], index_match, lags)
-
-
-        # (2) plot cross correlation versus lags, and save it (already done, run just once)
-        fig = plt.figure()
-
-        ax1 = fig.add_subplot(311)
-        cc = [dct['crosscorr'][lag][0] for lag in lags]
-        ax1.bar(lags, cc, width=0.1, edgecolor='None',color='k',align='center')
-        ax1.grid(True)
-        ax1.axhline(0, color='black', lw=2)
-        ax1.set_xlabel('Lag')
-        ax1.set_ylabel('Cross Correlation')
-        ax1.set_title('dataset: ' + dct['dataset_dbs'][0] + ' dbs: ' + dct['dataset_dbs'][1])
-
-        # plot the two time series as well
-
-        ax2 = fig.add_subplot(312)
-        ax2.plot(range(0, len(inconf_dct['confct'])), [0] * len(inconf_dct['confct']), 'k', range(index_match, index_match + len(dct['naccess'])), dct['naccess'], 'b', lw=1)
-        ax2.grid(True)
-        ax2.axhline(0, color='black', lw=2)
-        ax2.set_xlabel('Week')
-        ax2.set_ylabel('Dataset naccess')
-        
-        ax3 = fig.add_subplot(313)
-        ax3.plot(range(0, len(inconf_dct['confct'])), inconf_dct['confct'], 'r', lw=1)
-        ax3.grid(True)
-        ax3.axhline(0, color='black', lw=2)
-        ax3.set_xlabel('Week')
-        ax3.set_ylabel('Conference Count')
-
-        # plt.xlabel('Week')
-
-        pp = PdfPages(args.outdir + '/' + '_'.join(dct['dataset_dbs']) + '_' + str(index_match) + '.pdf')
-        pp.savefig(fig)
-        pp.close()
-
-
-        # (3) find the lag with the hightest cross correlation
-        lst = dct['crosscorr'].items()
-        def mycmp3(lst1, lst2):
-            # if abs(lst1[1][0]) > abs( lst2[1][0]): 
-            if lst1[1][0] > lst2[1][0]:  # consider signed correlation, instead of its magnitude.
-                return 1
-            # elif abs(lst1[1][0]) < abs(lst2[1][0]):
-            elif lst1[1][0] < lst2[1][0]:
-                return -1
-            else:
-                return 0
-        tmp = sorted(lst, cmp = mycmp3)
-        max_crosscorr.append(tmp[-1]) 
+        # match the dataset access series to the conference count series, by timestamp of the start of the dataset access series
+        index_match = conf_index[dct['tstamp'][0]]
+        if index_match < 0 and dct['tstamp'][0] < first_conf:
+            # a series starting before the conference count series starts at a negative position
+            index_match = dct['tstamp'][0] - first_conf
+        elif index_match < 0:
+            raise ValueError('week %s of dataset %s is not in the conference count series' % (calendar.window(dct['tstamp'][0]), dct['dataset_dbs']))
+
+        best = crosscorr_and_plot(dct, inconf_dct, index_match, lags,
+                                  'dataset: ' + dct['dataset_dbs'][0] + ' dbs: ' + dct['dataset_dbs'][1],
+                                  args.outdir + '/' + '_'.join(dct['dataset_dbs']) + '_' + str(index_match) + '.pdf')
+        max_crosscorr.append(best)
+        dataset_max_crosscorr.append((dct['dataset_dbs'], best))
+    write_max_crosscorr(dataset_max_crosscorr, with_codec_extension(args.outdir + '/max_crosscorr_lags.csv.gz', args.codec), ('dataset', 'dbs'), args.codec, args.level, args.threads)
+
+    # the same for the series of each attribute value
+    group_max_crosscorr = [] # ((attr, value), (lag, (crosscorr, p-value)))
+    for dct in lst_group_week_naccess:
+        if dct['length'] < 10 or numpy.var(dct['naccess']) == 0:
+            continue
+        index_match = conf_index[dct['tstamp'][0]]
+        if index_match < 0 and dct['tstamp'][0] < first_conf:
+            index_match = dct['tstamp'][0] - first_conf
+        elif index_match < 0:
+            raise ValueError('week %s of %s %s is not in the conference count series' % (calendar.window(dct['tstamp'][0]), dct['dataset_dbs'][0], dct['dataset_dbs'][1]))
+        best = crosscorr_and_plot(dct, inconf_dct, index_match, lags,
+                                  dct['dataset_dbs'][0] + ': ' + dct['dataset_dbs'][1],
+                                  args.outdir + '/group_' + '_'.join(dct['dataset_dbs']) + '_' + str(index_match) + '.pdf')
+        group_max_crosscorr.append((dct['dataset_dbs'], best))
+        print 'Max cross correlation for %s %s: lag %s, cross correlation %s, p-value %s' % (dct['dataset_dbs'][0], dct['dataset_dbs'][1], best[0], best[1][0], best[1][1])
+    if group_by:
+        write_max_crosscorr(group_max_crosscorr, with_codec_extension(args.outdir + '/max_crosscorr_lags_per_group.csv.gz', args.codec), ('attr', 'value'), args.codec, args.level, args.threads)
 
 
 
@@ -382,6 +629,28 @@ time_series.py --indir original      --inconf cms_conf_ct_perweek.csv.gz   --out
     pp.savefig(fig)
     pp.close()
 
+    # (4) rolling cross correlation over sliding windows, for seeing how the lags drift with time
+    if args.window > 0:
+
+        print '********************'
+        print 'Rolling cross correlation'
+
+        with span('rolling_crosscorr', rows=len(lst_dataset_week_naccess)):
+            cc, wstarts = rolling_crosscorr(naccess, inconf_dct['confct'], starts, lengths, lags, args.window, args.step)
+
+        # the lag with the highest cross correlation in each window of each dataset, with nan for windows without any correlation
+        best_lag = numpy.full(cc.shape[:2], numpy.nan, dtype=numpy.float32)
+        found = ~numpy.all(numpy.isnan(cc), axis=2)
+        best_lag[found] = numpy.asarray(lags)[numpy.nanargmax(cc[found], axis=1)]
+        print 'nb of (dataset, window) pairs with cross correlations:', found.sum(), 'out of', found.size
+
+        # a dataset x window x lag cube of cross correlations
+        numpy.savez_compressed(args.outdir + '/rolling_crosscorr_' + str(args.window) + '_' + str(args.step) + '.npz',
+                               cc=cc, best_lag=best_lag, lags=numpy.asarray(lags),
+                               window_start=calendar.to_windows(inconf_dct['tstamp'][wstarts]),
+                               dataset=numpy.asarray([dct['dataset_dbs'][0] for dct in lst_dataset_week_naccess]),
+                               dbs=numpy.asarray([dct['dataset_dbs'][1] for dct in lst_dataset_week_naccess]))
+
 ###################
 #########  4. compute FFT of conference count series, and FFT of each dataset access series. Check their periodocities from their FFTs
     
@@ -419,26 +688,16 @@ time_series.py --indir original      --inconf cms_conf_ct_perweek.csv.gz   --out
         if dct['length'] < 10 or numpy.var(dct['naccess']) == 0: # only consider datasets with more than 10 records, to correlate with conference count series, and which has non zero variance in naccess
             continue
 
-        signal = dct['naccess']
-        [mgft, freqs] = fft_half_spectrum(signal)
-
-        fig = plt.figure()
-
-        ax1 = fig.add_subplot(211)
-        ax1.bar(freqs, mgft, width=0.001, edgecolor='None',color='k',align='center')
-        ax1.set_ylabel('DFT')
-        ax1.set_xlabel('Frequency')
-        ax1.set_title('dataset: ' + dct['dataset_dbs'][0] + ' dbs: ' + dct['dataset_dbs'][1])
+        fft_and_plot(dct, 'dataset: ' + dct['dataset_dbs'][0] + ' dbs: ' + dct['dataset_dbs'][1],
+                     args.outdir + '/' + '_'.join(dct['dataset_dbs']) + '_' + str(len(dct['naccess'])) + '_fft.pdf')
 
-        # plot the two time series as well
-        ax2 = fig.add_subplot(212)
-        ax2.plot(range(0, len(dct['naccess'])), dct['naccess'], 'b', lw=1)
-        ax2.set_xlabel('Week')
-        ax2.set_ylabel('Dataset naccess')
+    # (3) the same for the series of each attribute value
+    for dct in lst_group_week_naccess:
+        if dct['length'] < 10 or numpy.var(dct['naccess']) == 0:
+            continue
 
-        pp = PdfPages(args.outdir + '/' + '_'.join(dct['dataset_dbs']) + '_' + str(len(signal)) + '_fft.pdf')
-        pp.savefig(fig)
-        pp.close()
+        fft_and_plot(dct, dct['dataset_dbs'][0] + ': ' + dct['dataset_dbs'][1],
+                     args.outdir + '/group_' + '_'.join(dct['dataset_dbs']) + '_' + str(len(dct['naccess'])) + '_fft.pdf')
 
 if __name__ == '__main__':
 
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Author     : Ting Li <liting0612 At gmail dot com>
+Description: Builds train and test sets for model.py from weekly dataset access records, with binary targets of whether a dataset is accessed at least some times in the next weeks.
+"""
+
+import os
+import argparse
+from collections import OrderedDict
+import numpy
+from pairkey import pair_key, sorted_join
+from access_matrix import load_access_matrix
+from week_calendar import get_calendar
+from history_store import weekly_columns, record_keys
+from colstore import to_text, write_csv
+from fileio import with_codec_extension, add_codec_arguments
+from instrument import span, start_profiler, add_profile_arguments
+
+
+def weekly_matrix(weekly):
+    ''' Sum the access counts of the weekly records into a matrix with a row for each (dataset, dbs) and a column for each week
+    input:
+    weekly: a list of (week ordinal, keys, naccess) of the records of each week, keys from pairkey.pair_key
+    output:
+    keys: the sorted unique keys, for the rows
+    first: the week ordinal of the first column
+    naccess: a 2d array of float64; the weeks without a file are 0
+    '''
+
+    keys = numpy.unique(numpy.concatenate([w[1] for w in weekly]))
+    first = min(w[0] for w in weekly)
+    nweeks = max(w[0] for w in weekly) - first + 1
+    rows = numpy.concatenate([numpy.searchsorted(keys, w[1]) for w in weekly])
+    cols = numpy.concatenate([numpy.full(len(w[1]), w[0] - first, dtype=numpy.int64) for w in weekly])
+    counts = numpy.concatenate([w[2] for w in weekly])
+    naccess = numpy.bincount(rows * nweeks + cols, weights=counts, minlength=len(keys) * nweeks).reshape(len(keys), nweeks)
+    return keys, first, naccess
+
+
+def matrix_from_file(filename):
+    ''' The access matrix saved by time_series.py, with its rows keyed as pairkey.pair_key and sorted
+    input:
+    filename: time_series_matrix.npz
+    output:
+    keys, first, naccess: as for weekly_matrix
+    '''
+
+    matrix = load_access_matrix(filename)
+    keys = pair_key(matrix['dataset'].astype(numpy.int64), matrix['dbs'].astype(numpy.int64))
+    order = numpy.argsort(keys, kind='mergesort')
+    return keys[order], int(matrix['week'][0]), matrix['naccess'][order].astype(numpy.float64)
+
+
+def future_sums(naccess, horizons):
+    ''' The access counts summed over the next weeks of every week, as differences of cumulative sums over the week axis
+    input:
+    naccess: a 2d array, with a row for each dataset and a column for each week
+    horizons: a list of the numbers of next weeks
+    output:
+    a dict of horizon to a 2d array of the same shape as naccess, whose column t is the sum over the weeks t+1 to t+horizon, nan if they go past the last week
+    '''
+
+    cumsum = numpy.zeros((naccess.shape[0], naccess.shape[1] + 1))
+    numpy.cumsum(naccess, axis=1, out=cumsum[:, 1:])
+    sums = {}
+    for k in horizons:
+        table = numpy.full(naccess.shape, numpy.nan)
+        inside = naccess.shape[1] - k
+        if inside > 0:
+            table[:, :inside] = cumsum[:, k + 1:] - cumsum[:, 1:inside + 1]
+        sums[k] = table
+    return sums
+
+
+def target_names(horizons, thresholds):
+    ''' The name of the target column of each horizon and threshold: target if there is a single one, target_<horizon>w_<threshold> otherwise '''
+
+    if len(horizons) == 1 and len(thresholds) == 1:
+        return OrderedDict([((horizons[0], thresholds[0]), 'target')])
+    return OrderedDict(((k, n), 'target_%dw_%s' % (k, n)) for k in horizons for n in thresholds)
+
+
+def in_range(window, span_text):
+    ''' Whether a week window starts within a range of days YYYYMMDD-YYYYMMDD, inclusive '''
+
+    if not span_text:
+        return False
+    start, end = span_text.split('-')
+    return start <= window[:8] <= end
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='''Builds train and test sets for model.py from weekly dataset access records, possibly merged with conference counts.
+The records of week t get a binary target for each horizon k and threshold n: 1 if the dataset is accessed at least n times in the weeks t+1 to t+k.
+The future access counts come from the weekly files themselves, or from the access matrix of time_series.py; the records whose next k weeks are not all in them are left out.
+
+Example:
+transform_csv.py --indir merged --train 20130506-20140430 --test 20140501-20140507 --outdir model
+transform_csv.py --indir merged --matrix time_series/time_series_matrix.npz --horizons 1,4 --thresholds 1,100 --train 20130506-20140430 --test 20140501-20140507 --drops nusers --outdir model
+''', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--indir', dest='indir', help='a dir containing the dataframe* files of the dataset access records, or a columnar store of them made by colstore.py')
+    parser.add_argument('--matrix', dest='matrix', default='', help='the access matrix time_series_matrix.npz of time_series.py, for the future access counts instead of the weekly files')
+    parser.add_argument('--horizons', dest='horizons', default='1', help='a comma separated list of the numbers of next weeks whose access counts are summed, default 1')
+    parser.add_argument('--thresholds', dest='thresholds', default='1', help='a comma separated list of the access counts a dataset needs in the next weeks to be popular, default 1')
+    parser.add_argument('--train', dest='train', default='', help='the days YYYYMMDD-YYYYMMDD in which the weeks of the train set start')
+    parser.add_argument('--test', dest='test', default='', help='the days YYYYMMDD-YYYYMMDD in which the weeks of the test set start')
+    parser.add_argument('--drops', dest='drops', default='', help='a comma separated list of columns left out of the train and test sets, such as naccess,nusers')
+    parser.add_argument('--outdir', dest='outdir', help='a dir for train.csv.gz and test.csv.gz')
+    add_profile_arguments(parser)
+    add_codec_arguments(parser)
+    args = parser.parse_args()
+    start_profiler(args.profile, args.profile_hot)
+
+    horizons = [int(k) for k in args.horizons.split(',')]
+    thresholds = [float(n) if '.' in n else int(n) for n in args.thresholds.split(',')]
+    names = target_names(horizons, thresholds)
+    drops = set(col for col in args.drops.split(',') if col)
+    calendar = get_calendar()
+    if not os.path.exists(args.outdir):
+        os.makedirs(args.outdir)
+
+    # 1. one pass over the weekly files, keeping the access counts of all the weeks and the records of the train and test weeks
+    weekly = []
+    sets = {'train': [], 'test': []}
+    for week, source, data in weekly_columns(args.indir, args.threads):
+        with span('read', merge=True) as rec:
+            keys, naccess = record_keys(data)
+            weekly.append((week, keys, naccess))
+            rec['rows'] = len(keys)
+        for name in ['train', 'test']:
+            if in_range(calendar.window(week), getattr(args, name)):
+                sets[name].append((week, keys, data))
+
+    # 2. the future access counts of every dataset and week
+    with span('future_sums') as rec:
+        if args.matrix:
+            mkeys, first, matrix = matrix_from_file(args.matrix)
+            # the matrix spans the weeks of the conference counts, which may go past the last week of the access records
+            matrix = matrix[:, :max(max(w[0] for w in weekly) - first + 1, 0)]
+        else:
+            mkeys, first, matrix = weekly_matrix(weekly)
+        sums = future_sums(matrix, horizons)
+        rec['rows'] = matrix.size
+
+    # 3. the targets of the records of each set, joined by key and week
+    for name in ['train', 'test']:
+        out = OrderedDict()
+        nrecords, nkept = 0, 0
+        with span('join', file=name) as rec:
+            for week, keys, data in sets[name]:
+                row = sorted_join(keys, mkeys)
+                col = week - first
+                targets = OrderedDict()
+                complete = row >= 0
+                for (k, n), tname in names.items():
+                    future = numpy.full(len(keys), numpy.nan)
+                    if 0 <= col < matrix.shape[1]:
+                        future[complete] = sums[k][row[complete], col]
+                    complete &= ~numpy.isnan(future)
+                    targets[tname] = (numpy.nan_to_num(future) >= n).astype(numpy.int8)
+                nrecords += len(keys)
+                nkept += complete.sum()
+                for attr, values in data.items() + targets.items():
+                    if attr in drops:
+                        continue
+                    if isinstance(values, numpy.ndarray):
+                        values = to_text(values[complete])
+                    else:
+                        values = numpy.asarray(values, dtype=object)[complete].tolist()
+                    out.setdefault(attr, []).extend(values)
+            rec['rows'] = nkept
+        if not sets[name]:
+            print 'no week of the', name, 'set'
+            continue
+        with span('write', file=name, rows=nkept):
+            write_csv(out, with_codec_extension(os.path.join(args.outdir, name + '.csv.gz'), args.codec), args.codec, args.level, args.threads)
+        print '%s set: %d weeks, %d records, %d left out without all their future weeks' % (name, len(sets[name]), nkept, nrecords - nkept)
+        for tname in names.values():
+            print '  %s: %.3f positive' % (tname, numpy.mean([int(v) for v in out[tname]]) if out.get(tname) else 0)
+
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+#pylint: disable=
+"""
+File       : vocabulary.py
+Author     : Ting <liting0612 AT gmail dot com>
+Description: Persistent vocabularies which encode categorical columns
+             into integer codes that are stable across files and runs
+"""
+
+# system modules
+import os
+import json
+
+# NumPy and pandas
+import numpy as np
+import pandas as pd
+
+# code of values which are not in a vocabulary which is not allowed to grow
+UNSEEN = -1
+
+class Vocabulary(object):
+    """
+    Mapping of the values of a categorical column to integer codes.
+    Codes are given in order of first appearance and never change, new
+    values extend the vocabulary. The vocabulary is stored as a JSON list
+    of values, the code of a value being its position in the list.
+    """
+    def __init__(self, fname=None):
+        self.fname = fname
+        values = []
+        if  fname and os.path.isfile(fname):
+            with open(fname) as istream:
+                values = json.load(istream)
+        self.index = pd.Index(values)
+
+    def __len__(self):
+        return len(self.index)
+
+    def encode(self, vals, update=True):
+        """
+        Return array of codes of given values. Values which are not in the
+        vocabulary are added to it if update is set, otherwise they get
+        the UNSEEN code.
+        """
+        vals = np.asarray(vals)
+        codes = self.index.get_indexer(vals)
+        missing = codes == UNSEEN
+        if  update and missing.any():
+            new = pd.unique(vals[missing])
+            self.index = self.index.append(pd.Index(new))
+            codes[missing] = self.index.get_indexer(vals[missing])
+        return codes
+
+    def decode(self, codes):
+        "Return values of given codes, None for UNSEEN code"
+        codes = np.asarray(codes)
+        vals = np.asarray(self.index, dtype=object)[codes]
+        vals[codes == UNSEEN] = None
+        return vals
+
+    def save(self, fname=None):
+        "Write vocabulary to given file or to the one it was read from"
+        fname = fname or self.fname
+        tmp = '%s.tmp%s' % (fname, os.getpid())
+        with open(tmp, 'w') as ostream:
+            json.dump([v.item() if isinstance(v, np.generic) else v \
+                    for v in self.index.tolist()], ostream)
+        os.rename(tmp, fname)
+
+class CategoricalEncoder(object):
+    """
+    Set of vocabularies of data frame columns, stored in given directory
+    as one <column>.json file per column. Without directory the
+    vocabularies live in memory only.
+    """
+    def __init__(self, vdir=None):
+        self.vdir = vdir
+        self.vocabs = {}
+
+    def vocab(self, col):
+        "Return vocabulary of given column"
+        if  col not in self.vocabs:
+            fname = None
+            if  self.vdir:
+                fname = os.path.join(self.vdir, '%s.json' % col)
+            self.vocabs[col] = Vocabulary(fname)
+        return self.vocabs[col]
+
+    def encode(self, xdf, cols, update=True):
+        "Replace given columns of data frame by their codes"
+        for col in cols:
+            xdf[col] = self.vocab(col).encode(xdf[col].values, update)
+        return xdf
+
+    def save(self):
+        "Write all vocabularies"
+        if  not self.vdir:
+            return
+        if  not os.path.isdir(self.vdir):
+            os.makedirs(self.vdir)
+        for vocab in self.vocabs.values():
+            vocab.save()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+"""
+Author     : Ting Li <liting0612 At gmail dot com>
+Description: A shared calendar of the self-defined weeks, converting between week windows 'YYYYMMDD-YYYYMMDD' and integer week ordinals.
+"""
+
+import re
+import datetime
+import numpy
+
+# the self-defined weeks of the years from EPOCH_YEAR to LAST_YEAR get consecutive ordinals, starting from 0 for the first week of EPOCH_YEAR
+EPOCH_YEAR = 1950
+LAST_YEAR = 2050
+WEEKS_PER_YEAR = 52
+
+
+########### self-defined weeks, where the first week in a year starts from jan 1 and the last week has more than 7 days to include Dec 31 (and 30)
+
+def mycalendar(date):
+    ''' convert from Gregorian Calendar date to (year, week, day) starting from Jan 1
+    '''
+    year = date.year
+    delta = date - datetime.date(date.year, 1, 1)
+    week = delta.days / 7 + 1
+    day = delta.days % 7 + 1
+    if week == 53: # when date is the last one or two days where there are less than 7 days left to form a week
+        week -= 1
+        day += 7
+    return (year,week,day)
+
+def mine_to_gregorian(my_year, my_week, my_day):
+    '''Gregorian calendar date for the given year, week and day starting from Jan 1'''
+    year_start = datetime.date(my_year, 1, 1)
+    return year_start + datetime.timedelta(days=my_day-1, weeks=my_week-1)
+
+def week_window(my_year, my_week):
+    ''' The week window string 'YYYYMMDD-YYYYMMDD' of the given year and self-defined week, where the last week of a year ends on Dec 31
+    '''
+    if my_week == WEEKS_PER_YEAR:
+        end = datetime.date(my_year, 12, 31)
+    else:
+        end = mine_to_gregorian(my_year, my_week, 7)
+    return '{0}-{1}'.format(mine_to_gregorian(my_year, my_week, 1).strftime('%Y%m%d'), end.strftime('%Y%m%d'))
+
+
+########### a bidirectional table between week windows and week ordinals
+
+class WeekCalendar(object):
+    ''' A table between the week windows 'YYYYMMDD-YYYYMMDD' and int32 week ordinals, built once per run.
+    The ordinal of a week is its index in the table, so ordinal to window is an array lookup, window to ordinal is a dict lookup, and consecutive weeks have consecutive ordinals.
+    '''
+
+    def __init__(self, first_year=EPOCH_YEAR, last_year=LAST_YEAR):
+        self.first_year = first_year
+        self.last_year = last_year
+        windows = [week_window(year, week) for year in range(first_year, last_year + 1) for week in range(1, WEEKS_PER_YEAR + 1)]
+        self.windows = numpy.array(windows)
+        self.index = dict(zip(windows, range(len(windows))))
+
+    def __len__(self):
+        return len(self.windows)
+
+    def ordinal(self, tstamp):
+        ''' ordinal of a week window string '''
+        return self.index[tstamp]
+
+    def ordinals(self, tstamps):
+        ''' ordinals of a sequence of week window strings, as an int32 array '''
+        return numpy.fromiter((self.index[tstamp] for tstamp in tstamps), dtype=numpy.int32)
+
+    def window(self, ordinal):
+        ''' week window string of an ordinal '''
+        return self.windows[ordinal]
+
+    def to_windows(self, ordinals):
+        ''' week window strings of a sequence of ordinals, as an array of strings '''
+        return self.windows[numpy.asarray(ordinals, dtype=numpy.int32)]
+
+    def yearweek_ordinal(self, my_year, my_week):
+        ''' ordinal of a year and a self-defined week '''
+        return (my_year - self.first_year) * WEEKS_PER_YEAR + my_week - 1
+
+    def yearweek(self, ordinal):
+        ''' year and self-defined week of an ordinal '''
+        year, week = divmod(int(ordinal), WEEKS_PER_YEAR)
+        return (self.first_year + year, week + 1)
+
+    def date_ordinal(self, date):
+        ''' ordinal of the self-defined week containing a datetime.date '''
+        (year, week, day) = mycalendar(date)
+        return self.yearweek_ordinal(year, week)
+
+    def filename_ordinal(self, filename):
+        ''' ordinal of the week window embedded in a file name, such as dataframe-20140507-20140513.csv.gz '''
+        return self.index[re.search('\d{8}-\d{8}', filename).group()]
+
+
+_calendar = None
+
+def get_calendar():
+    ''' The calendar shared by all the scripts of a run, built at the first call
+    '''
+    global _calendar
+    if _calendar is None:
+        _calendar = WeekCalendar()
+    return _calendar